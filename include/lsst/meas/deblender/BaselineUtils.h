@@ -8,6 +8,7 @@
 
 #include "lsst/afw/image/Image.h"
 #include "lsst/afw/image/MaskedImage.h"
+#include "lsst/afw/geom/SpanSet.h"
 #include "lsst/afw/detection/Footprint.h"
 #include "lsst/afw/detection/HeavyFootprint.h"
 #include "lsst/afw/detection/Peak.h"
@@ -97,6 +98,19 @@ namespace lsst {
                                          std::shared_ptr<lsst::afw::detection::Footprint>,
                                          ImagePixelT threshold);
 
+                // Union of SpanSets: all of the spans are sorted once and merged,
+                // rather than normalizing the accumulated set after each pairwise union.
+                static
+                std::shared_ptr<lsst::afw::geom::SpanSet>
+                mergeSpanSets(std::vector<std::shared_ptr<lsst::afw::geom::SpanSet> > const& spanSets);
+
+                // Fraction of the pixels of ``spans`` with any of the bits of each of ``bitmasks``
+                // set in ``mask``, computed in a single pass over the spans.
+                static
+                std::vector<double>
+                getMaskedFractions(lsst::afw::geom::SpanSet const& spans,
+                                   MaskT const& mask,
+                                   std::vector<MaskPixelT> const& bitmasks);
 
                 static
                 void
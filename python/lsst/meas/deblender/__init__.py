@@ -28,3 +28,9 @@ from .baselineUtils import *
 from .baseline import *
 from .plugins import *
 from .deblend import *
+from .tiling import *
+from .checkpoint import *
+from .bundle import *
+from .profiling import *
+from .noise import *
+from .classify import *
@@ -25,6 +25,7 @@ from builtins import object
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 from collections import OrderedDict
+import time
 import numpy as np
 
 import lsst.pex.exceptions
@@ -143,6 +144,10 @@ class DeblenderResult(object):
         # Result from multiband debender (if used)
         self.blend = None
         self.failed = False
+        # Whether the multiband templates were initialized from a saved model
+        self.warmStarted = False
+        # Per-plugin statistics (if requested in `newDeblend`)
+        self.pluginStats = None
 
     def getParentProperty(self, propertyName):
         """Get the footprint in each filter"""
@@ -155,6 +160,36 @@ class DeblenderResult(object):
             for f, templateSum in templateSums.items():
                 self.deblendedParents[f].templateSum = templateSum
 
+class PluginStats(object):
+    """Execution statistics of a single deblender plugin for a single parent
+
+    Attributes
+    ----------
+    time: `float`
+        Total wall time spent in the plugin, in seconds.
+    nCalls: `int`
+        Number of times the plugin was executed.
+    nResets: `int`
+        Number of times the plugin sent the deblender back to an earlier plugin.
+    peakMemory: `int`
+        Largest increase in allocated memory during a single execution of the plugin, in bytes.
+        This is only measured when memory tracing is requested, otherwise it is 0.
+    """
+
+    def __init__(self):
+        self.time = 0.
+        self.nCalls = 0
+        self.nResets = 0
+        self.peakMemory = 0
+
+    def __str__(self):
+        return ("<PluginStats: time={0:.6f}s, nCalls={1}, nResets={2}, peakMemory={3}>".format(
+                self.time, self.nCalls, self.nResets, self.peakMemory))
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class DeblendedParent(object):
     """Deblender result of a single parent footprint, in a single band
 
@@ -354,6 +389,10 @@ class DeblendedPeak(object):
 
         self.patched = False
 
+        # Number of scarlet iterations in which this source was updated
+        # (only set when the multiband fit tracks the convergence of each source)
+        self.scarletIterations = None
+
         # debug -- a copy of the original symmetric template
         self.origTemplate = None
         self.origFootprint = None
@@ -451,6 +490,64 @@ class DeblendedPeak(object):
         self.templateImage = image
         self.templateFootprint = footprint
 
+def makeDeblenderPlugins(fitPsfs=True, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.5,
+                         tinyFootprintSize=2, patchEdges=False, rampFluxAtEdge=False,
+                         medianSmoothTemplate=True, medianFilterHalfsize=2, monotonicTemplate=True,
+                         clipFootprintToNonzero=True, weightTemplates=False, removeDegenerateTemplates=False,
+                         maxTempDotProd=0.5, greedyDegenerateTemplates=False, clipStrayFluxFraction=0.001,
+                         assignStrayFlux=True, strayFluxAssignment='r-to-peak',
+                         strayFluxToPointSources='necessary', getTemplateSum=False, stencilQuantum=0.):
+    """Build the list of plugins that ``deblend`` runs
+
+    The parameters are the ones of `deblend` with the same names.
+
+    Returns
+    -------
+    debPlugins: list of `meas.deblender.plugins.DeblenderPlugin`
+        Plugins, in order of execution.
+    """
+    debPlugins = []
+
+    # Add activated deblender plugins
+    if fitPsfs:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.fitPsfs,
+                                                  psfChisqCut1=psfChisqCut1,
+                                                  psfChisqCut2=psfChisqCut2,
+                                                  psfChisqCut2b=psfChisqCut2b,
+                                                  tinyFootprintSize=tinyFootprintSize,
+                                                  stencilQuantum=stencilQuantum))
+    debPlugins.append(plugins.DeblenderPlugin(plugins.buildSymmetricTemplates, patchEdges=patchEdges))
+    if rampFluxAtEdge:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.rampFluxAtEdge, patchEdges=patchEdges))
+    if medianSmoothTemplate:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.medianSmoothTemplates,
+                                                  medianFilterHalfsize=medianFilterHalfsize))
+    if monotonicTemplate:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.makeTemplatesMonotonic))
+    if clipFootprintToNonzero:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.clipFootprintsToNonzero))
+    if weightTemplates:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.weightTemplates))
+    if removeDegenerateTemplates:
+        if weightTemplates:
+            onReset = len(debPlugins)-1
+        else:
+            onReset = len(debPlugins)
+        debPlugins.append(plugins.DeblenderPlugin(plugins.reconstructTemplates,
+                                                  onReset=onReset,
+                                                  maxTempDotProd=maxTempDotProd,
+                                                  greedy=greedyDegenerateTemplates,
+                                                  reweight=weightTemplates))
+    debPlugins.append(plugins.DeblenderPlugin(plugins.apportionFlux,
+                                              clipStrayFluxFraction=clipStrayFluxFraction,
+                                              assignStrayFlux=assignStrayFlux,
+                                              strayFluxAssignment=strayFluxAssignment,
+                                              strayFluxToPointSources=strayFluxToPointSources,
+                                              getTemplateSum=getTemplateSum))
+
+    return debPlugins
+
+
 def deblend(footprint, maskedImage, psf, psffwhm, filters=None,
             psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.5, fitPsfs=True,
             medianSmoothTemplate=True, medianFilterHalfsize=2,
@@ -459,7 +556,8 @@ def deblend(footprint, maskedImage, psf, psffwhm, filters=None,
             assignStrayFlux=True, strayFluxToPointSources='necessary', strayFluxAssignment='r-to-peak',
             rampFluxAtEdge=False, patchEdges=False, tinyFootprintSize=2,
             getTemplateSum=False, clipStrayFluxFraction=0.001, clipFootprintToNonzero=True,
-            removeDegenerateTemplates=False, maxTempDotProd=0.5
+            removeDegenerateTemplates=False, maxTempDotProd=0.5, greedyDegenerateTemplates=False,
+            recordPluginStats=False, tracePluginMemory=False, stencilQuantum=0.
             ):
     """Deblend a parent ``Footprint`` in a ``MaskedImageF``.
 
@@ -627,6 +725,21 @@ def deblend(footprint, maskedImage, psf, psffwhm, filters=None,
         All dot products between templates greater than ``maxTempDotProduct`` will result in one
         of the templates removed. This parameter is only used when ``removeDegenerateTempaltes==True``.
         The default is 0.5.
+    greedyDegenerateTemplates: `bool`, optional
+        If True then all of the degenerate templates are removed in a single pass, instead of
+        removing one template and restarting from ``weightTemplates`` (or the removal step itself)
+        until none is left. This parameter is only used when ``removeDegenerateTempaltes==True``.
+        The default is False.
+    recordPluginStats: `bool`, optional
+        If True then record the execution statistics of each plugin (see `newDeblend`).
+        The default is False.
+    tracePluginMemory: `bool`, optional
+        If True (and ``recordPluginStats==True``) also record the peak allocation of each plugin.
+        The default is False.
+    stencilQuantum: `float`, optional
+        If positive, the sub-pixel peak offsets used by the PSF fit are rounded to a multiple of
+        ``stencilQuantum`` so that peaks can share cached fit stencils.
+        The default is 0, which uses the exact offset of each peak.
 
     Returns
     -------
@@ -636,48 +749,25 @@ def deblend(footprint, maskedImage, psf, psffwhm, filters=None,
     """
     avgNoise = sigma1
 
-    debPlugins = []
-
-    # Add activated deblender plugins
-    if fitPsfs:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.fitPsfs,
-                                                  psfChisqCut1=psfChisqCut1,
-                                                  psfChisqCut2=psfChisqCut2,
-                                                  psfChisqCut2b=psfChisqCut2b,
-                                                  tinyFootprintSize=tinyFootprintSize))
-    debPlugins.append(plugins.DeblenderPlugin(plugins.buildSymmetricTemplates, patchEdges=patchEdges))
-    if rampFluxAtEdge:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.rampFluxAtEdge, patchEdges=patchEdges))
-    if medianSmoothTemplate:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.medianSmoothTemplates,
-                                                  medianFilterHalfsize=medianFilterHalfsize))
-    if monotonicTemplate:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.makeTemplatesMonotonic))
-    if clipFootprintToNonzero:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.clipFootprintsToNonzero))
-    if weightTemplates:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.weightTemplates))
-    if removeDegenerateTemplates:
-        if weightTemplates:
-            onReset = len(debPlugins)-1
-        else:
-            onReset = len(debPlugins)
-        debPlugins.append(plugins.DeblenderPlugin(plugins.reconstructTemplates,
-                                                  onReset=onReset,
-                                                  maxTempDotProd=maxTempDotProd))
-    debPlugins.append(plugins.DeblenderPlugin(plugins.apportionFlux,
-                                              clipStrayFluxFraction=clipStrayFluxFraction,
-                                              assignStrayFlux=assignStrayFlux,
-                                              strayFluxAssignment=strayFluxAssignment,
-                                              strayFluxToPointSources=strayFluxToPointSources,
-                                              getTemplateSum=getTemplateSum))
+    debPlugins = makeDeblenderPlugins(
+        fitPsfs=fitPsfs, psfChisqCut1=psfChisqCut1, psfChisqCut2=psfChisqCut2, psfChisqCut2b=psfChisqCut2b,
+        tinyFootprintSize=tinyFootprintSize, patchEdges=patchEdges, rampFluxAtEdge=rampFluxAtEdge,
+        medianSmoothTemplate=medianSmoothTemplate, medianFilterHalfsize=medianFilterHalfsize,
+        monotonicTemplate=monotonicTemplate, clipFootprintToNonzero=clipFootprintToNonzero,
+        weightTemplates=weightTemplates, removeDegenerateTemplates=removeDegenerateTemplates,
+        maxTempDotProd=maxTempDotProd, greedyDegenerateTemplates=greedyDegenerateTemplates,
+        clipStrayFluxFraction=clipStrayFluxFraction, assignStrayFlux=assignStrayFlux,
+        strayFluxAssignment=strayFluxAssignment, strayFluxToPointSources=strayFluxToPointSources,
+        getTemplateSum=getTemplateSum, stencilQuantum=stencilQuantum)
 
-    debResult = newDeblend(debPlugins, footprint, maskedImage, psf, psffwhm, filters, log, verbose, avgNoise)
+    debResult = newDeblend(debPlugins, footprint, maskedImage, psf, psffwhm, filters, log, verbose, avgNoise,
+                           recordPluginStats=recordPluginStats, tracePluginMemory=tracePluginMemory)
 
     return debResult
 
 def newDeblend(debPlugins, footprint, maskedImages, psfs, psfFwhms, filters=None,
-               log=None, verbose=False, avgNoise=None, maxNumberOfPeaks=0):
+               log=None, verbose=False, avgNoise=None, maxNumberOfPeaks=0,
+               recordPluginStats=False, tracePluginMemory=False):
     """Deblend a parent ``Footprint`` in a ``MaskedImageF``.
 
     Deblending assumes that ``footprint`` has multiple peaks, as it will still create a
@@ -718,6 +808,15 @@ def newDeblend(debPlugins, footprint, maskedImages, psfs, psfFwhms, filters=None
         If nonzero, the maximum number of peaks to deblend.
         If the total number of peaks is greater than ``maxNumberOfPeaks``,
         then only the first ``maxNumberOfPeaks`` sources are deblended.
+    recordPluginStats: `bool`, optional
+        If True then the wall time, number of calls and number of resets of each plugin
+        are stored in ``debResult.pluginStats``, an `OrderedDict` of `PluginStats`
+        indexed by the name of the plugin function.
+        The default is False.
+    tracePluginMemory: `bool`, optional
+        If True (and ``recordPluginStats==True``) the peak allocation of each plugin is
+        also measured with `tracemalloc`. This slows down the deblender significantly.
+        The default is False.
 
     Returns
     -------
@@ -742,24 +841,81 @@ def newDeblend(debPlugins, footprint, maskedImages, psfs, psfFwhms, filters=None
     debResult = DeblenderResult(footprint, maskedImages, psfs, psfFwhms, log, filters=filters,
                                 maxNumberOfPeaks=maxNumberOfPeaks, avgNoise=avgNoise)
 
-    step = 0
-    while step < len(debPlugins):
-        # If a failure occurs at any step,
-        # the result is flagged as `failed`
-        # and the remaining steps are skipped
-        if not debResult.failed:
-            reset = debPlugins[step].run(debResult, log)
-        else:
-            log.warn("Skipping steps {0}".format(debPlugins[step:]))
-            return debResult
-        if reset:
-            step = debPlugins[step].onReset
-        else:
-            step+=1
+    tracer = None
+    if recordPluginStats:
+        debResult.pluginStats = OrderedDict()
+        if tracePluginMemory:
+            tracer = _PluginMemoryTracer()
+
+    try:
+        step = 0
+        while step < len(debPlugins):
+            # If a failure occurs at any step,
+            # the result is flagged as `failed`
+            # and the remaining steps are skipped
+            if debResult.failed:
+                log.warn("Skipping steps {0}".format(debPlugins[step:]))
+                return debResult
+            if recordPluginStats:
+                name = debPlugins[step].func.__name__
+                stats = debResult.pluginStats.setdefault(name, PluginStats())
+                if tracer is not None:
+                    tracer.start()
+                t0 = time.time()
+                reset = debPlugins[step].run(debResult, log)
+                stats.time += time.time() - t0
+                stats.nCalls += 1
+                if tracer is not None:
+                    stats.peakMemory = max(stats.peakMemory, tracer.getPeak())
+                if reset:
+                    stats.nResets += 1
+            else:
+                reset = debPlugins[step].run(debResult, log)
+            if reset:
+                step = debPlugins[step].onReset
+            else:
+                step+=1
+    finally:
+        if tracer is not None:
+            tracer.stop()
 
     return debResult
 
 
+class _PluginMemoryTracer(object):
+    """Measure the peak allocation of a block of code with `tracemalloc`
+
+    Tracing is started on construction (unless it was already running) and must be
+    stopped with `stop`.
+    """
+
+    def __init__(self):
+        import tracemalloc
+        self.tracemalloc = tracemalloc
+        self.ownsTracing = not tracemalloc.is_tracing()
+        if self.ownsTracing:
+            tracemalloc.start()
+        self.base = 0
+
+    def start(self):
+        """Start a new measurement"""
+        if hasattr(self.tracemalloc, "reset_peak"):
+            self.tracemalloc.reset_peak()
+        self.base = self.tracemalloc.get_traced_memory()[0]
+
+    def getPeak(self):
+        """Peak allocation, in bytes, above the allocation when `start` was called
+
+        Without `tracemalloc.reset_peak` (python < 3.9) this is the peak since tracing started,
+        so it is an upper limit.
+        """
+        return max(self.tracemalloc.get_traced_memory()[1] - self.base, 0)
+
+    def stop(self):
+        if self.ownsTracing:
+            self.tracemalloc.stop()
+
+
 class CachingPsf(object):
     """Cache the PSF models
 
@@ -783,3 +939,141 @@ class CachingPsf(object):
             im = self.psf.computeImage()
         self.cache[(cx, cy)] = im
         return im
+
+
+class CachingPsfKernels(object):
+    """Cache the PSF kernel cubes used for the multiband PSF convolution
+
+    The kernels of each band are computed once per cell of a ``gridSize`` x ``gridSize`` pixel
+    grid (at the center of the cell), and stacked into a read-only (bands, height, width) array.
+    With ``gridSize <= 0`` the kernels are computed once, at the average position of each PSF.
+
+    The kernels are stored for the ``maxPsfs`` sets of PSFs used most recently (e.g. the PSFs of
+    the exposures of the current run); the kernels of older PSFs are dropped, so a long lived
+    task does not accumulate the PSFs and kernels of every exposure it has processed.  The cache
+    holds a reference to the PSFs it stores kernels for, to keep their ids unique.
+    """
+
+    def __init__(self, gridSize=0, maxPsfs=1):
+        self.gridSize = gridSize
+        self.maxPsfs = max(maxPsfs, 1)
+        # ids of the PSFs -> (PSFs, {cell: kernels}), from the least to the most recently used
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        """Number of kernel cubes in the cache"""
+        return sum(len(cells) for psfs, cells in self.cache.values())
+
+    def clear(self):
+        """Drop all of the PSFs and kernels"""
+        self.cache.clear()
+
+    def _getCell(self, position):
+        if self.gridSize <= 0 or position is None:
+            return None
+        return (int(np.floor(position.getX()/self.gridSize)), int(np.floor(position.getY()/self.gridSize)))
+
+    def getKernels(self, psfs, position=None):
+        """PSF kernel images of all bands near ``position``
+
+        Parameters
+        ----------
+        psfs: list of `afw.detection.Psf`
+            Psf in each band.
+        position: `afw.geom.Point2D`, optional
+            Position at which the kernels are needed (e.g. the center of the parent).
+
+        Returns
+        -------
+        kernels: `numpy.ndarray`
+            Read-only array with shape (bands, height, width).
+        """
+        cell = self._getCell(position)
+        key = tuple(id(psf) for psf in psfs)
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            while len(self.cache) >= self.maxPsfs:
+                self.cache.popitem(last=False)
+            entry = (list(psfs), {})
+        self.cache[key] = entry
+        cells = entry[1]
+        if cell in cells:
+            return cells[cell]
+        if cell is None:
+            images = [psf.computeKernelImage().getArray() for psf in psfs]
+        else:
+            center = afwGeom.Point2D((cell[0] + 0.5)*self.gridSize, (cell[1] + 0.5)*self.gridSize)
+            images = []
+            for psf in psfs:
+                try:
+                    images.append(psf.computeKernelImage(center).getArray())
+                except lsst.pex.exceptions.Exception:
+                    images.append(psf.computeKernelImage().getArray())
+        kernels = np.array(images)
+        kernels.flags.writeable = False
+        cells[cell] = kernels
+        return kernels
+
+
+class CachingFitStencil(object):
+    """Cache the coordinate and radial-weight stencils used by the PSF fit
+
+    For every peak, ``_fitPsf`` needs the squared radius of each pixel in
+    the fitting stamp, the disk of pixels within ``R1`` and the ramp weights
+    that fall from 1 at ``R0`` to 0 at ``R1``.  These only depend on ``R0``,
+    ``R1`` and the sub-pixel offset of the peak, and ``R0``, ``R1`` are fixed
+    by the PSF FWHM for a whole band, so we compute them once per
+    (``R0``, ``R1``, offset) and hand out slices.
+    """
+
+    def __init__(self, quantum=0.):
+        """Create an empty stencil cache
+
+        Parameters
+        ----------
+        quantum: `float`, optional
+            If positive, sub-pixel peak offsets are rounded to a multiple of
+            ``quantum`` before looking up a stencil, so that peaks with nearly
+            identical offsets share a stencil.  The default is 0, which uses
+            the exact offset (peaks at integer positions all share one stencil).
+        """
+        self.cache = {}
+        self.quantum = quantum
+
+    def _quantize(self, f):
+        if self.quantum > 0:
+            f = np.round(f/self.quantum)*self.quantum
+        return f
+
+    def getStencil(self, R0, R1, cx, cy):
+        """Return the stencil for a peak at (``cx``, ``cy``)
+
+        Returns
+        -------
+        stencil: `tuple`
+            ``(xlo, ylo, RR, rw, disk)`` where ``xlo``, ``ylo`` are the (unclipped)
+            lower-left pixel of the fitting stamp in image coordinates, ``RR``
+            is the squared distance of each stamp pixel to the peak,
+            ``rw`` the ramp weights and ``disk`` the boolean array ``RR <= R1**2``.
+            The arrays are shared between peaks and must not be modified.
+        """
+        ix, iy = int(np.floor(cx)), int(np.floor(cy))
+        fx, fy = self._quantize(cx - ix), self._quantize(cy - iy)
+        key = (R0, R1, fx, fy)
+        stencil = self.cache.get(key, None)
+        if stencil is None:
+            x0, x1 = int(np.floor(fx - R1)), int(np.ceil(fx + R1))
+            y0, y1 = int(np.floor(fy - R1)), int(np.ceil(fy + R1))
+            xx, yy = np.arange(x0, x1+1), np.arange(y0, y1+1)
+            RR = ((xx - fx)**2)[np.newaxis, :] + ((yy - fy)**2)[:, np.newaxis]
+            # Ramp weights -- from 1 at R0 down to 0 at R1.
+            rw = np.ones_like(RR)
+            ii = (RR > R0**2)
+            rw[ii] = np.maximum(0, 1. - ((np.sqrt(RR[ii]) - R0)/(R1 - R0)))
+            disk = (RR <= R1**2)
+            for arr in (RR, rw, disk):
+                arr.flags.writeable = False
+            stencil = (x0, y0, RR, rw, disk)
+            self.cache[key] = stencil
+        x0, y0, RR, rw, disk = stencil
+        return (x0 + ix, y0 + iy, RR, rw, disk)
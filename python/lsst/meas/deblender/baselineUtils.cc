@@ -24,6 +24,7 @@
 
 #include "lsst/afw/image/Image.h"
 #include "lsst/afw/image/MaskedImage.h"
+#include "lsst/afw/geom/SpanSet.h"
 #include "lsst/afw/detection/Footprint.h"
 #include "lsst/afw/detection/Peak.h"
 
@@ -92,6 +93,8 @@ void declareBaselineUtils(py::module& mod, const std::string& suffix) {
                    "thresh"_a);
     cls.def_static("getSignificantEdgePixels", &Class::getSignificantEdgePixels, "img"_a, "sfoot"_a,
                    "thresh"_a);
+    cls.def_static("mergeSpanSets", &Class::mergeSpanSets, "spanSets"_a);
+    cls.def_static("getMaskedFractions", &Class::getMaskedFractions, "spans"_a, "mask"_a, "bitmasks"_a);
     // There appears to be an issue binding to a static const member of a templated type, so for now
     // we just use the values constants
     cls.attr("ASSIGN_STRAYFLUX") = py::cast(Class::ASSIGN_STRAYFLUX);
@@ -0,0 +1,508 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Performance benchmarks of the deblender on synthetic blended fields
+
+A field is a set of blends of Gaussian sources convolved with a Gaussian PSF, with Gaussian
+noise, in one or more bands.  The benchmarks time `lsst.meas.deblender.baseline.deblend`,
+`lsst.meas.deblender.baseline.newDeblend` (with the time spent in each plugin), and the
+`SourceDeblendTask` and `MultibandDeblendTask` end to end, and write the throughput
+(parents/s and peaks/s), the bands used and the peak RSS of each benchmark (measured in a
+separate process) to a JSON file, e.g.::
+
+    python -m lsst.meas.deblender.benchmark --nParents 50 --nBands 3 --output bench.json
+"""
+from __future__ import print_function, division
+from builtins import range
+from collections import OrderedDict
+import argparse
+import json
+import math
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import lsst.afw.detection as afwDet
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+
+__all__ = ["SyntheticField", "makeSyntheticField", "runBenchmarks", "measurePeakRss",
+           "writeBenchmarks"]
+
+
+class SyntheticField(object):
+    """Exposures and detected parents of a synthetic field
+
+    Attributes
+    ----------
+    exposures: `OrderedDict`
+        `afw.image.ExposureF` in each band, indexed by the band name.
+    sources: `afw.table.SourceCatalog`
+        Parents detected on the sum of the exposures (with the minimal schema).
+    sigma1: `float`
+        Noise level of each exposure.
+    params: `dict`
+        Parameters used to generate the field.
+    """
+
+    def __init__(self, exposures, sources, sigma1, params):
+        self.exposures = exposures
+        self.sources = sources
+        self.sigma1 = sigma1
+        self.params = params
+
+    def getBlends(self):
+        """Parents with more than one peak"""
+        return _getBlends(self.sources)
+
+
+def makeSyntheticField(width=512, height=512, nParents=20, peaksPerParent=3, blendSize=6.,
+                       nBands=1, psfSigma=2., sourceSigma=1.5, edgeFraction=0., edgeDistance=5,
+                       flux=5000., sigma1=1., seed=1):
+    """Generate a synthetic blended field
+
+    Parameters
+    ----------
+    width, height: `int`, optional
+        Size of the images.
+    nParents: `int`, optional
+        Number of blends.
+    peaksPerParent: `int`, optional
+        Number of sources in each blend (the peak density).
+    blendSize: `float`, optional
+        Standard deviation, in pixels, of the offsets of the sources from the blend center.
+    nBands: `int`, optional
+        Number of bands.  Each source has a random color.
+    psfSigma: `float`, optional
+        Standard deviation of the Gaussian PSF.
+    sourceSigma: `float`, optional
+        Maximum intrinsic standard deviation of the sources; each source gets a random size
+        between 0 (a point source) and ``sourceSigma``.
+    edgeFraction: `float`, optional
+        Fraction of the blends centered within ``edgeDistance`` pixels of the image edge.
+    edgeDistance: `int`, optional
+        Distance to the edge of the blends selected by ``edgeFraction``.
+    flux: `float`, optional
+        Mean flux of each source.
+    sigma1: `float`, optional
+        Standard deviation of the noise.
+    seed: `int`, optional
+        Seed of the random number generator.
+
+    Returns
+    -------
+    field: `SyntheticField`
+    """
+    params = dict(width=width, height=height, nParents=nParents, peaksPerParent=peaksPerParent,
+                  blendSize=blendSize, nBands=nBands, psfSigma=psfSigma, sourceSigma=sourceSigma,
+                  edgeFraction=edgeFraction, edgeDistance=edgeDistance, flux=flux, sigma1=sigma1,
+                  seed=seed)
+    rng = np.random.RandomState(seed)
+    bands = ["b%d" % i for i in range(nBands)]
+
+    psfSize = int(2*math.ceil(5*psfSigma) + 1)
+    psf = afwDet.GaussianPsf(psfSize, psfSize, psfSigma)
+
+    arrays = OrderedDict((band, np.zeros((height, width), dtype=np.float32)) for band in bands)
+    yy, xx = np.mgrid[:height, :width]
+    margin = 3*blendSize + 5*psfSigma
+    nEdge = int(round(edgeFraction*nParents))
+    for i in range(nParents):
+        if i < nEdge:
+            # put the blend center close to one of the four edges
+            side = rng.randint(4)
+            x = rng.uniform(edgeDistance, width - edgeDistance)
+            y = rng.uniform(edgeDistance, height - edgeDistance)
+            if side == 0:
+                x = edgeDistance
+            elif side == 1:
+                x = width - 1 - edgeDistance
+            elif side == 2:
+                y = edgeDistance
+            else:
+                y = height - 1 - edgeDistance
+        else:
+            x = rng.uniform(margin, width - margin)
+            y = rng.uniform(margin, height - margin)
+        for j in range(peaksPerParent):
+            cx = x + rng.normal(0, blendSize)
+            cy = y + rng.normal(0, blendSize)
+            sigma = math.sqrt(psfSigma**2 + rng.uniform(0, sourceSigma)**2)
+            half = int(math.ceil(5*sigma))
+            x0, x1 = max(int(cx) - half, 0), min(int(cx) + half + 1, width)
+            y0, y1 = max(int(cy) - half, 0), min(int(cy) + half + 1, height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            dx = xx[y0:y1, x0:x1] - cx
+            dy = yy[y0:y1, x0:x1] - cy
+            profile = np.exp(-0.5*(dx**2 + dy**2)/sigma**2)/(2*math.pi*sigma**2)
+            sed = rng.uniform(0.5, 1.5, size=nBands)
+            sourceFlux = flux*rng.uniform(0.5, 1.5)
+            for band, weight in zip(bands, sed):
+                arrays[band][y0:y1, x0:x1] += sourceFlux*weight*profile
+
+    exposures = OrderedDict()
+    detection = afwImage.MaskedImageF(width, height)
+    for band in bands:
+        mi = afwImage.MaskedImageF(width, height)
+        mi.getImage().getArray()[:] = arrays[band] + rng.normal(0, sigma1, size=(height, width))
+        mi.getVariance().set(sigma1**2)
+        detection.getImage().getArray()[:] += mi.getImage().getArray()
+        exposure = afwImage.makeExposure(mi)
+        exposure.setPsf(psf)
+        exposures[band] = exposure
+    detection.getVariance().set(nBands*sigma1**2)
+
+    threshold = afwDet.Threshold(5*sigma1*math.sqrt(nBands))
+    footprints = afwDet.FootprintSet(detection, threshold, "DETECTED", 5)
+    sources = afwTable.SourceCatalog(afwTable.SourceTable.makeMinimalSchema())
+    footprints.makeSources(sources)
+
+    return SyntheticField(exposures, sources, sigma1, params)
+
+
+def _getPeakRss():
+    """Peak resident set size of the process, in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on linux and in bytes on macOS
+    if sys.platform == "darwin":
+        rss /= 1024
+    return rss/1024
+
+
+def _makeResult(name, elapsed, nParents, nPeaks, bands, **kwargs):
+    result = dict(name=name, time=elapsed, nParents=nParents, nPeaks=nPeaks, bands=list(bands),
+                  parentsPerSecond=nParents/elapsed if elapsed > 0 else float("nan"),
+                  peaksPerSecond=nPeaks/elapsed if elapsed > 0 else float("nan"))
+    result.update(kwargs)
+    return result
+
+
+def _copyFootprint(footprint):
+    """Copy a footprint and its peaks, so the deblender cannot modify the original"""
+    peaks = footprint.getPeaks()
+    copy = afwDet.Footprint(footprint.getSpans(), peaks.getSchema())
+    copy.getPeaks().extend(peaks, deep=True)
+    return copy
+
+
+def _copySources(field, mapper=None):
+    """Copy the field's parents, and their footprints
+
+    The deblender modifies the footprints of the parents it deblends (e.g. clipping their
+    spans), so each benchmark runs on its own copy of the parents.
+    """
+    if mapper is None:
+        sources = afwTable.SourceCatalog(field.sources.schema)
+        sources.extend(field.sources, deep=True)
+    else:
+        sources = afwTable.SourceCatalog(mapper.getOutputSchema())
+        sources.extend(field.sources, mapper=mapper)
+    for src in sources:
+        src.setFootprint(_copyFootprint(src.getFootprint()))
+    return sources
+
+
+def _getBlends(sources):
+    """Parents with more than one peak"""
+    return [src for src in sources if len(src.getFootprint().getPeaks()) > 1]
+
+
+def _makeTask(TaskClass, field, config):
+    """Create a deblender task and a copy of the field's parents with the task's schema"""
+    mapper = afwTable.SchemaMapper(field.sources.schema)
+    mapper.addMinimalSchema(field.sources.schema, True)
+    task = TaskClass(mapper.getOutputSchema(), config=config)
+    return task, _copySources(field, mapper)
+
+
+def benchmarkDeblend(field, **kwargs):
+    """Time `lsst.meas.deblender.baseline.deblend` on each blend of the first band
+
+    Parameters
+    ----------
+    field: `SyntheticField`
+        Field to deblend.
+    **kwargs
+        Passed to `lsst.meas.deblender.baseline.deblend`.
+
+    Returns
+    -------
+    result: `dict`
+    """
+    from .baseline import deblend
+
+    band, exposure = list(field.exposures.items())[0]
+    psf = exposure.getPsf()
+    psfFwhm = psf.computeShape().getDeterminantRadius()*2.35
+    blends = _getBlends(_copySources(field))
+    nPeaks = 0
+    t0 = time.time()
+    for src in blends:
+        fp = src.getFootprint()
+        nPeaks += len(fp.getPeaks())
+        deblend(fp, exposure.getMaskedImage(), psf, psfFwhm, sigma1=field.sigma1, **kwargs)
+    return _makeResult("baseline.deblend", time.time() - t0, len(blends), nPeaks, [band])
+
+
+def benchmarkNewDeblend(field, debPlugins=None):
+    """Time `lsst.meas.deblender.baseline.newDeblend`, and each of its plugins, on all bands
+
+    Parameters
+    ----------
+    field: `SyntheticField`
+        Field to deblend.
+    debPlugins: list of `lsst.meas.deblender.plugins.DeblenderPlugin`, optional
+        Plugins to run. The default is `lsst.meas.deblender.baseline.DEFAULT_PLUGINS`.
+
+    Returns
+    -------
+    result: `dict`
+        The ``plugins`` entry contains the total time, number of calls and number of resets
+        of each plugin.
+    """
+    from .baseline import newDeblend, DEFAULT_PLUGINS
+
+    if debPlugins is None:
+        debPlugins = DEFAULT_PLUGINS
+    bands = list(field.exposures.keys())
+    maskedImages = [exp.getMaskedImage() for exp in field.exposures.values()]
+    psfs = [exp.getPsf() for exp in field.exposures.values()]
+    psfFwhms = [psf.computeShape().getDeterminantRadius()*2.35 for psf in psfs]
+    avgNoise = [field.sigma1]*len(bands)
+
+    blends = _getBlends(_copySources(field))
+    plugins = {}
+    nPeaks = 0
+    t0 = time.time()
+    for src in blends:
+        fp = src.getFootprint()
+        nPeaks += len(fp.getPeaks())
+        for plugin in debPlugins:
+            plugin.iterations = 0
+        result = newDeblend(debPlugins, fp, maskedImages, psfs, psfFwhms, filters=bands,
+                            avgNoise=avgNoise, recordPluginStats=True)
+        for name, stats in result.pluginStats.items():
+            total = plugins.setdefault(name, dict(time=0., nCalls=0, nResets=0))
+            total["time"] += stats.time
+            total["nCalls"] += stats.nCalls
+            total["nResets"] += stats.nResets
+    return _makeResult("baseline.newDeblend", time.time() - t0, len(blends), nPeaks, bands,
+                       plugins=plugins)
+
+
+def benchmarkSourceDeblendTask(field, config=None):
+    """Time `SourceDeblendTask` end to end on the first band
+
+    Parameters
+    ----------
+    field: `SyntheticField`
+        Field to deblend.
+    config: `SourceDeblendConfig`, optional
+        Configuration of the task.
+
+    Returns
+    -------
+    result: `dict`
+    """
+    from .deblend import SourceDeblendTask
+
+    task, sources = _makeTask(SourceDeblendTask, field, config)
+    band, exposure = list(field.exposures.items())[0]
+    blends = _getBlends(sources)
+    nPeaks = sum(len(src.getFootprint().getPeaks()) for src in blends)
+    t0 = time.time()
+    task.run(exposure, sources)
+    return _makeResult("SourceDeblendTask", time.time() - t0, len(blends), nPeaks, [band],
+                       nChildren=len(sources) - len(field.sources))
+
+
+def benchmarkMultibandDeblendTask(field, config=None):
+    """Time `MultibandDeblendTask` end to end on all bands
+
+    Parameters
+    ----------
+    field: `SyntheticField`
+        Field to deblend.
+    config: `MultibandDeblendConfig`, optional
+        Configuration of the task.
+
+    Returns
+    -------
+    result: `dict`
+    """
+    from .deblend import MultibandDeblendTask
+
+    task, sources = _makeTask(MultibandDeblendTask, field, config)
+    blends = _getBlends(sources)
+    nPeaks = sum(len(src.getFootprint().getPeaks()) for src in blends)
+    t0 = time.time()
+    task.run(field.exposures, sources)
+    return _makeResult("MultibandDeblendTask", time.time() - t0, len(blends), nPeaks,
+                       list(field.exposures.keys()))
+
+
+BENCHMARKS = [
+    ("baseline.deblend", benchmarkDeblend),
+    ("baseline.newDeblend", benchmarkNewDeblend),
+    ("SourceDeblendTask", benchmarkSourceDeblendTask),
+    ("MultibandDeblendTask", benchmarkMultibandDeblendTask),
+]
+
+
+def _reportPeakRss(name, params):
+    """Run a benchmark on a new field and print the peak RSS before and after it, as JSON
+
+    This is run in the process started by `measurePeakRss`.
+    """
+    field = makeSyntheticField(**params)
+    fieldRss = _getPeakRss()
+    dict(BENCHMARKS)[name](field)
+    print(json.dumps(dict(fieldRss=fieldRss, peakRss=_getPeakRss())))
+
+
+def measurePeakRss(field, name):
+    """Measure the peak memory of a benchmark in a separate process
+
+    The peak RSS of a process (``ru_maxrss``) never decreases, so each benchmark is run in a new
+    process, on a field generated again from ``field.params``.  This includes the memory of the
+    C++ objects (images, footprints) that python tools such as `tracemalloc` do not see.
+
+    Parameters
+    ----------
+    field: `SyntheticField`
+        Field to deblend.
+    name: `str`
+        Name of the benchmark (see `BENCHMARKS`).
+
+    Returns
+    -------
+    memory: `dict`
+        ``peakRss``: peak RSS of the process, in MB;
+        ``rssIncrease``: increase of the peak RSS during the benchmark, i.e. above the memory used
+        by the imports and the field, in MB.
+    """
+    script = "from lsst.meas.deblender.benchmark import _reportPeakRss; _reportPeakRss(%r, %r)" % (
+        name, field.params)
+    output = subprocess.check_output([sys.executable, "-c", script])
+    memory = json.loads(output.decode().strip().splitlines()[-1])
+    return dict(peakRss=memory["peakRss"], rssIncrease=memory["peakRss"] - memory["fieldRss"])
+
+
+def runBenchmarks(field, names=None, log=None, measureMemory=True):
+    """Run the benchmarks on a field
+
+    Parameters
+    ----------
+    field: `SyntheticField`
+        Field to deblend.
+    names: list of `str`, optional
+        Names of the benchmarks to run (see `BENCHMARKS`). The default runs all of them.
+    log: `lsst.log.Log`, optional
+        Logger used to report the results.
+    measureMemory: `bool`, optional
+        After timing each benchmark, run it again in a separate process to measure its peak
+        memory (see `measurePeakRss`).  The timings are not affected by this measurement.
+
+    Returns
+    -------
+    results: list of `dict`
+        One entry per benchmark, with the ``bands`` it deblended and, if ``measureMemory``,
+        its ``peakRss`` and ``rssIncrease`` in MB. Benchmarks that could not run (for example
+        because ``scarlet`` is not installed) have an ``error`` entry instead of timings.
+    """
+    results = []
+    for name, func in BENCHMARKS:
+        if names is not None and name not in names:
+            continue
+        try:
+            result = func(field)
+        except ImportError as e:
+            result = dict(name=name, error=str(e))
+        if measureMemory and "error" not in result:
+            result.update(measurePeakRss(field, name))
+        if log is not None:
+            if "error" in result:
+                log.warn("%s: skipped (%s)" % (name, result["error"]))
+            else:
+                message = "%s (bands %s): %.1f parents/s, %.1f peaks/s" % (
+                    name, ",".join(result["bands"]), result["parentsPerSecond"], result["peaksPerSecond"])
+                if len(result["bands"]) < len(field.exposures):
+                    message += " (first band only)"
+                if "peakRss" in result:
+                    message += ", peak RSS %.0f MB (+%.0f MB)" % (result["peakRss"], result["rssIncrease"])
+                log.info(message)
+        results.append(result)
+    return results
+
+
+def writeBenchmarks(filename, field, results):
+    """Write the benchmark results, and the parameters of the field, to a JSON file"""
+    output = dict(
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        host=platform.node(),
+        python=platform.python_version(),
+        field=field.params,
+        nBlends=len(field.getBlends()),
+        results=results,
+    )
+    with open(filename, "w") as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="deblender-benchmark.json", help="output JSON file")
+    parser.add_argument("--benchmark", action="append", dest="names", default=None,
+                        choices=[name for name, func in BENCHMARKS],
+                        help="benchmark to run (may be repeated; default: all)")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--nParents", type=int, default=20, help="number of blends")
+    parser.add_argument("--peaksPerParent", type=int, default=3, help="number of sources per blend")
+    parser.add_argument("--blendSize", type=float, default=6., help="rms offset of the sources in a blend")
+    parser.add_argument("--nBands", type=int, default=1)
+    parser.add_argument("--psfSigma", type=float, default=2.)
+    parser.add_argument("--edgeFraction", type=float, default=0.,
+                        help="fraction of the blends close to the image edge")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--noMemory", action="store_false", dest="measureMemory",
+                        help="do not measure the peak memory of each benchmark in a separate process")
+    args = parser.parse_args(argv)
+
+    import lsst.log
+    log = lsst.log.Log.getLogger("meas.deblender.benchmark")
+
+    field = makeSyntheticField(width=args.width, height=args.height, nParents=args.nParents,
+                               peaksPerParent=args.peaksPerParent, blendSize=args.blendSize,
+                               nBands=args.nBands, psfSigma=args.psfSigma,
+                               edgeFraction=args.edgeFraction, seed=args.seed)
+    log.info("Generated %d blends" % len(field.getBlends()))
+    results = runBenchmarks(field, args.names, log, args.measureMemory)
+    writeBenchmarks(args.output, field, results)
+
+
+if __name__ == "__main__":
+    main()
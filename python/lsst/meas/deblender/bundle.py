@@ -0,0 +1,301 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Self-contained inputs of the deblender for a single parent
+
+A blend bundle is a directory containing everything needed to deblend a single parent without
+the data repository it came from::
+
+    footprint.fits             parent footprint, with its peaks
+    image-<band>.fits          padded parent cutout of the masked image in each band
+                               (see `lsst.meas.deblender.tiling`)
+    psf-<band>-<n>.fits        PSF kernel images on a grid of pixels over the cutout
+    config.py                  configuration of the deblender task
+    bundle.json                parent id, bands, noise levels, PSF widths and PSF grid positions
+
+A bundle is replayed with ``newDeblend`` (through `lsst.meas.deblender.baseline.deblend` for a
+`SourceDeblendConfig`), e.g.::
+
+    python -m lsst.meas.deblender.bundle parent-1234 --repeat 5
+
+Bundles only store PSF images, so the PSF used for the replay is the grid image closest to the
+center of the parent, which is constant over the parent.
+"""
+from __future__ import print_function, division
+from builtins import range, object
+from collections import OrderedDict
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import lsst.pex.exceptions
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.afw.table as afwTable
+import lsst.meas.algorithms as measAlg
+
+from .deblend import SourceDeblendConfig, SourceDeblendTask, MultibandDeblendConfig
+from .tiling import makeParentCutout
+
+__all__ = ["BlendBundle", "makeBlendBundle"]
+
+
+class BlendBundle(object):
+    """Inputs of the deblender for a single parent
+
+    Attributes
+    ----------
+    parentId: `int`
+        Id of the parent.
+    footprint: `afw.detection.Footprint`
+        Parent footprint, with its peaks.
+    maskedImages: `OrderedDict`
+        Padded cutout of the parent in each band.
+    psfGrids: `dict`
+        For each band, a list of ``(x, y, image)`` tuples: the PSF kernel image at each
+        (integer) grid position.
+    sigmas: `dict`
+        Noise level (``sigma1``/``avgNoise``) in each band.
+    psfFwhms: `dict`
+        FWHM of the PSF in each band.
+    config: `SourceDeblendConfig` or `MultibandDeblendConfig`
+        Configuration of the deblender task.
+    """
+
+    def __init__(self, parentId, footprint, maskedImages, psfGrids, sigmas, psfFwhms, config):
+        self.parentId = parentId
+        self.footprint = footprint
+        self.maskedImages = maskedImages
+        self.psfGrids = psfGrids
+        self.sigmas = sigmas
+        self.psfFwhms = psfFwhms
+        self.config = config
+
+    @property
+    def bands(self):
+        return list(self.maskedImages.keys())
+
+    def getPsf(self, band):
+        """PSF of a band, from the grid image closest to the center of the parent
+
+        Returns
+        -------
+        psf: `lsst.meas.algorithms.KernelPsf`
+        """
+        center = afwGeom.Box2D(self.footprint.getBBox()).getCenter()
+        x, y, image = min(self.psfGrids[band],
+                          key=lambda g: (g[0] - center.getX())**2 + (g[1] - center.getY())**2)
+        kernel = afwMath.FixedKernel(image)
+        return measAlg.KernelPsf(kernel, afwGeom.Point2D(x, y))
+
+    def write(self, dirName):
+        """Write the bundle to directory ``dirName``"""
+        if not os.path.exists(dirName):
+            os.makedirs(dirName)
+        self.footprint.writeFits(os.path.join(dirName, "footprint.fits"))
+        psfGrids = {}
+        for band in self.bands:
+            self.maskedImages[band].writeFits(os.path.join(dirName, "image-%s.fits" % band))
+            positions = []
+            for n, (x, y, image) in enumerate(self.psfGrids[band]):
+                image.writeFits(os.path.join(dirName, "psf-%s-%d.fits" % (band, n)))
+                positions.append([x, y])
+            psfGrids[band] = positions
+        self.config.save(os.path.join(dirName, "config.py"))
+        info = dict(
+            parentId=int(self.parentId),
+            bands=self.bands,
+            sigmas=self.sigmas,
+            psfFwhms=self.psfFwhms,
+            psfGrids=psfGrids,
+            multiband=isinstance(self.config, MultibandDeblendConfig),
+        )
+        with open(os.path.join(dirName, "bundle.json"), "w") as f:
+            json.dump(info, f, indent=2)
+
+    @classmethod
+    def read(cls, dirName):
+        """Read a bundle written by `write`"""
+        with open(os.path.join(dirName, "bundle.json")) as f:
+            info = json.load(f)
+        footprint = afwDet.Footprint.readFits(os.path.join(dirName, "footprint.fits"))
+        maskedImages = OrderedDict()
+        psfGrids = {}
+        for band in info["bands"]:
+            maskedImages[band] = afwImage.MaskedImageF(os.path.join(dirName, "image-%s.fits" % band))
+            psfGrids[band] = [(x, y, afwImage.ImageD(os.path.join(dirName, "psf-%s-%d.fits" % (band, n))))
+                              for n, (x, y) in enumerate(info["psfGrids"][band])]
+        if info["multiband"]:
+            config = MultibandDeblendConfig()
+        else:
+            config = SourceDeblendConfig()
+        config.load(os.path.join(dirName, "config.py"))
+        return cls(info["parentId"], footprint, maskedImages, psfGrids, info["sigmas"], info["psfFwhms"],
+                   config)
+
+    def replay(self, log=None):
+        """Deblend the parent
+
+        The plugin statistics are always recorded (see `lsst.meas.deblender.baseline.newDeblend`).
+
+        Parameters
+        ----------
+        log: `lsst.log.Log`, optional
+            Logger passed to the deblender.
+
+        Returns
+        -------
+        debResult: `lsst.meas.deblender.baseline.DeblenderResult`
+            Result of the deblender.
+        runtime: `float`
+            Wall time of the deblender, in ms.
+        """
+        from .baseline import deblend, newDeblend
+
+        footprint = afwDet.Footprint(self.footprint)
+        bands = self.bands
+        if isinstance(self.config, MultibandDeblendConfig):
+            from .deblend import MultibandDeblendTask
+            task = MultibandDeblendTask(afwTable.SourceTable.makeMinimalSchema(), config=self.config)
+            for plugin in task.plugins:
+                plugin.iterations = 0
+            t0 = time.time()
+            debResult = newDeblend(task.plugins, footprint,
+                                   [self.maskedImages[band] for band in bands],
+                                   [self.getPsf(band) for band in bands],
+                                   [self.psfFwhms[band] for band in bands],
+                                   filters=bands, log=log,
+                                   avgNoise=[self.sigmas[band] for band in bands],
+                                   maxNumberOfPeaks=self.config.maxNumberOfPeaks,
+                                   recordPluginStats=True,
+                                   tracePluginMemory=self.config.tracePluginMemory)
+        else:
+            task = SourceDeblendTask(afwTable.SourceTable.makeMinimalSchema(), config=self.config)
+            kwargs = task.getDeblendKwargs()
+            kwargs["recordPluginStats"] = True
+            band = bands[0]
+            t0 = time.time()
+            debResult = deblend(footprint, self.maskedImages[band], self.getPsf(band),
+                                self.psfFwhms[band], filters=[band], sigma1=self.sigmas[band], log=log,
+                                **kwargs)
+        return debResult, (time.time() - t0)*1000
+
+
+def makeBlendBundle(parentId, footprint, maskedImages, psfs, sigmas, psfFwhms, config, gridSize=3):
+    """Extract the bundle of a parent from the full images
+
+    Parameters
+    ----------
+    parentId: `int`
+        Id of the parent.
+    footprint: `afw.detection.Footprint`
+        Parent footprint, with its peaks, before it is deblended.
+    maskedImages: `dict`
+        Full masked image in each band.
+    psfs: `dict`
+        `afw.detection.Psf` in each band.
+    sigmas: `dict`
+        Noise level in each band.
+    psfFwhms: `dict`
+        FWHM of the PSF in each band.
+    config: `SourceDeblendConfig` or `MultibandDeblendConfig`
+        Configuration of the deblender task.
+    gridSize: `int`, optional
+        The PSF is evaluated on a ``gridSize`` x ``gridSize`` grid over the cutout.
+
+    Returns
+    -------
+    bundle: `BlendBundle`
+    """
+    # Only keep the fields of the base config (and not of a subclass, e.g. a profiling task's),
+    # so that the bundle can be read without the code of the subclass
+    if isinstance(config, MultibandDeblendConfig):
+        baseConfig = MultibandDeblendConfig()
+    else:
+        baseConfig = SourceDeblendConfig()
+    baseConfig.update(**{name: getattr(config, name) for name in baseConfig.keys()})
+    config = baseConfig
+
+    footprint = afwDet.Footprint(footprint)
+    rampFluxAtEdge = config.edgeHandling == 'ramp'
+    psfFwhm = max(psfFwhms.values())
+    cutouts = OrderedDict()
+    psfGrids = {}
+    for band, mi in maskedImages.items():
+        cutout = makeParentCutout(mi, footprint, psfFwhm, rampFluxAtEdge, deep=True)
+        cutouts[band] = cutout
+        bbox = cutout.getBBox()
+        grid = []
+        # Sample the PSF at integer pixel positions, with the kernel image (centered on the
+        # middle pixel) rather than the image shifted to a sub-pixel position
+        for y in np.linspace(bbox.getMinY(), bbox.getMaxY(), gridSize).round().astype(int):
+            for x in np.linspace(bbox.getMinX(), bbox.getMaxX(), gridSize).round().astype(int):
+                try:
+                    image = psfs[band].computeKernelImage(afwGeom.Point2D(int(x), int(y)))
+                except lsst.pex.exceptions.Exception:
+                    image = psfs[band].computeKernelImage()
+                grid.append((int(x), int(y), image))
+        psfGrids[band] = grid
+    sigmas = {band: float(sigma) for band, sigma in sigmas.items()}
+    psfFwhms = {band: float(fwhm) for band, fwhm in psfFwhms.items()}
+    return BlendBundle(parentId, footprint, cutouts, psfGrids, sigmas, psfFwhms, config)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the deblender on a blend bundle")
+    parser.add_argument("bundle", help="directory of the blend bundle")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to deblend the parent")
+    parser.add_argument("--profile", default=None,
+                        help="run the first repetition with cProfile and write the statistics to this file")
+    args = parser.parse_args(argv)
+
+    import lsst.log
+    log = lsst.log.Log.getLogger("meas.deblender.bundle")
+
+    bundle = BlendBundle.read(args.bundle)
+    print("Parent %d: %d peaks, bbox %s, bands %s" %
+          (bundle.parentId, len(bundle.footprint.getPeaks()), bundle.footprint.getBBox(), bundle.bands))
+    runtimes = []
+    for i in range(args.repeat):
+        if i == 0 and args.profile is not None:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+            debResult, runtime = bundle.replay(log)
+            profile.disable()
+            profile.dump_stats(args.profile)
+        else:
+            debResult, runtime = bundle.replay(log)
+        runtimes.append(runtime)
+    print("Runtime: min %.1f ms, median %.1f ms over %d runs (failed: %s)" %
+          (min(runtimes), np.median(runtimes), len(runtimes), debResult.failed))
+    for name, stats in debResult.pluginStats.items():
+        print("  %-25s %8.1f ms  calls %3d  resets %3d" %
+              (name, stats.time*1000, stats.nCalls, stats.nResets))
+
+
+if __name__ == "__main__":
+    main()
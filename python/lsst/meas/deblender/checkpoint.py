@@ -0,0 +1,224 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Parent-level checkpointing for the deblender tasks
+
+A checkpoint is an index file (``checkpointFile``), which lists the completed blocks, and one
+SourceCatalog per block and per output catalog, written next to it.  Each block contains the
+families (a parent record followed by its children) of the parents deblended since the previous
+block was written.  Blocks are only added to the index once all of their catalogs have been
+written, so a crash while writing a block only loses that block.
+
+The first line of the index holds a signature of the input catalog and of the configuration
+(see `getCheckpointSignature`), and a checkpoint written for a different input is refused, rather
+than attaching the children it holds to the wrong parents.
+"""
+from builtins import object
+from collections import defaultdict
+import hashlib
+import os
+import zlib
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+
+__all__ = ["DeblendCheckpoint", "getCheckpointSignature"]
+
+SIGNATURE_PREFIX = "signature "
+
+
+def getCheckpointSignature(sources, config):
+    """Signature of the input of a deblender run
+
+    Parameters
+    ----------
+    sources: `afw.table.SourceCatalog`
+        Input catalog of the deblender, before any child is added.
+    config: `lsst.pex.config.Config`
+        Configuration of the deblender task.  The ``checkpoint*`` fields are ignored.
+
+    Returns
+    -------
+    signature: `str`
+        Length of the catalog, checksum of its parent ids and hash of the configuration.
+    """
+    parentIds = np.array([src.getId() for src in sources if src.getParent() == 0], dtype=np.int64)
+    values = [(name, value) for name, value in config.toDict().items() if not name.startswith("checkpoint")]
+    configHash = hashlib.sha1(repr(sorted(values)).encode("utf-8")).hexdigest()[:16]
+    return "%d_%08x_%s" % (len(sources), zlib.crc32(parentIds.tobytes()) & 0xffffffff, configHash)
+
+
+class DeblendCheckpoint(object):
+    """Record completed parents and their children so that a deblend can be resumed
+    """
+
+    def __init__(self, filename, interval=100, log=None, signature=None):
+        """Create a checkpoint
+
+        Parameters
+        ----------
+        filename: `str`
+            Name of the checkpoint index file.
+        interval: `int`, optional
+            Number of completed parents between writes of the checkpoint.
+        log: `lsst.log.Log`, optional
+            Logger used to report the checkpoint progress.
+        signature: `str`, optional
+            Signature of the input of the deblender (see `getCheckpointSignature`).
+
+        Raises
+        ------
+        RuntimeError
+            Raised if ``filename`` exists and was written with a different signature.
+        """
+        self.filename = filename
+        self.interval = interval
+        self.log = log
+        self.signature = signature
+        self.nParents = 0
+        self.pending = {}
+        savedSignature, self.blocks = self._readIndex()
+        if os.path.exists(self.filename) and savedSignature != signature:
+            raise RuntimeError("Checkpoint %s was written for a different input catalog or configuration "
+                               "(signature %s, expected %s); remove it to deblend from scratch" %
+                               (self.filename, savedSignature, signature))
+
+    def _readIndex(self):
+        if not os.path.exists(self.filename):
+            return None, []
+        signature = None
+        blocks = []
+        with open(self.filename) as f:
+            for line in f:
+                if line.startswith(SIGNATURE_PREFIX):
+                    signature = line[len(SIGNATURE_PREFIX):].strip()
+                elif line.strip():
+                    blocks.append(int(line))
+        return signature, blocks
+
+    def getBlockFilename(self, name, block):
+        """Name of the file holding catalog ``name`` for block number ``block``"""
+        root, ext = os.path.splitext(self.filename)
+        return "%s-%s-%04d.fits" % (root, name, block)
+
+    def load(self, name):
+        """Read the families saved for a single output catalog
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the output catalog.
+
+        Returns
+        -------
+        families: `dict`
+            Keys are the parent ids and values are lists of records: the parent,
+            followed by its children in the order they were created.
+            Children whose parent is not in the checkpoint are dropped.
+        """
+        parents = {}
+        children = defaultdict(list)
+        for block in self.blocks:
+            filename = self.getBlockFilename(name, block)
+            if not os.path.exists(filename):
+                # no parent in this block produced records for this catalog
+                continue
+            cat = afwTable.SourceCatalog.readFits(filename)
+            for record in cat:
+                if record.getParent() == 0:
+                    parents[record.getId()] = record
+                else:
+                    children[record.getParent()].append(record)
+        families = {parentId: [parent] + children.pop(parentId, []) for parentId, parent in parents.items()}
+        if children and self.log is not None:
+            self.log.warn("Ignoring %d children of %d parents missing from checkpoint %s" %
+                          (sum(len(records) for records in children.values()), len(children), self.filename))
+        if self.log is not None:
+            self.log.info("Loaded %d completed parents for '%s' from checkpoint %s" %
+                          (len(families), name, self.filename))
+        return families
+
+    def addFamily(self, name, records):
+        """Add the parent and children of a completed parent to an output catalog
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the output catalog.
+        records: list of `afw.table.SourceRecord`
+            The parent record, followed by its children.
+        """
+        if not records:
+            return
+        if name not in self.pending:
+            self.pending[name] = afwTable.SourceCatalog(records[0].getTable())
+        for record in records:
+            self.pending[name].append(record)
+
+    def parentDone(self):
+        """Mark a parent as completed, writing a block once ``interval`` parents are done"""
+        self.nParents += 1
+        if self.nParents >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write the pending families as a new block"""
+        if self.nParents > 0:
+            block = self.blocks[-1] + 1 if self.blocks else 0
+            for name, cat in self.pending.items():
+                filename = self.getBlockFilename(name, block)
+                cat.writeFits(filename + ".tmp")
+                os.rename(filename + ".tmp", filename)
+            newIndex = not os.path.exists(self.filename)
+            with open(self.filename, "a") as f:
+                if newIndex and self.signature is not None:
+                    f.write("%s%s\n" % (SIGNATURE_PREFIX, self.signature))
+                f.write("%d\n" % block)
+            self.blocks.append(block)
+            if self.log is not None:
+                self.log.info("Checkpointed %d parents to %s" % (self.nParents, self.filename))
+        self.pending = {}
+        self.nParents = 0
+
+    @staticmethod
+    def restoreFamily(catalog, records, parent=None):
+        """Add a family loaded from a checkpoint to a catalog
+
+        The records are added with ``addNew`` so that the catalog's IdFactory advances exactly
+        as it would have if the parent had been deblended again.
+
+        Parameters
+        ----------
+        catalog: `afw.table.SourceCatalog`
+            Catalog to add the records to.
+        records: list of `afw.table.SourceRecord`
+            The parent record, followed by its children.
+        parent: `afw.table.SourceRecord`, optional
+            Existing parent record in ``catalog`` to update.
+            If ``None`` a new parent record is added to ``catalog``.
+        """
+        if parent is None:
+            parent = catalog.addNew()
+        parent.assign(records[0])
+        for record in records[1:]:
+            child = catalog.addNew()
+            child.assign(record)
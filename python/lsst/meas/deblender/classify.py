@@ -0,0 +1,270 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Classification of the parents of a catalog before they are deblended
+
+`classifyParents` gathers the area, bounding box size, axis ratio, number of peaks and masked
+fractions of every parent of a catalog into arrays, and applies the skipping conditions of the
+deblender tasks to all of them at once.  The result gives the list of parents that will be deblended,
+and the reason each other parent is skipped, before any deblending starts, e.g. to schedule the
+parents, estimate the cost of a catalog or report progress.
+"""
+from builtins import object
+
+import numpy as np
+
+import lsst.afw.geom.ellipses as afwEll
+import lsst.afw.table as afwTable
+
+from .baselineUtils import BaselineUtilsF as butils
+
+__all__ = ["ParentClassification", "classifyParents", "logClassification", "isLargeFootprint", "isMasked",
+           "SKIP_SINGLE_PEAK", "SKIP_TOO_BIG", "SKIP_MASKED"]
+
+SKIP_SINGLE_PEAK = "singlePeak"
+SKIP_TOO_BIG = "tooBig"
+SKIP_MASKED = "masked"
+
+
+class ParentClassification(object):
+    """Properties of the parents of a catalog, and the reason each skipped parent is skipped
+
+    Each array has one entry per record of the catalog, in catalog order.
+
+    Attributes
+    ----------
+    ids: `numpy.ndarray`
+        Id of each parent.
+    area: `numpy.ndarray`
+        Number of pixels of each footprint.
+    width, height: `numpy.ndarray`
+        Size of the bounding box of each footprint.
+    nPeaks: `numpy.ndarray`
+        Number of peaks of each footprint.
+    axisRatio: `numpy.ndarray`
+        Ratio of the minor to the major axis of each footprint.  The moments of a footprint are only
+        computed when a minimum axis ratio is given and the parent is not already skipped, so this is
+        NaN for the other parents.
+    maskedFractions: `dict`
+        Fraction of the pixels of each footprint with each mask plane of the mask limits set, keyed by
+        mask plane name.  Only computed for parents that are not already skipped, NaN otherwise.
+    skipReasons: `numpy.ndarray`
+        Why each parent is skipped (`SKIP_SINGLE_PEAK`, `SKIP_TOO_BIG` or `SKIP_MASKED`), or an empty
+        string for parents that are deblended.
+    tooManyPeaks: `numpy.ndarray`
+        Whether each parent has more peaks than the maximum number of peaks that are deblended.
+    """
+
+    def __init__(self, ids, area, width, height, nPeaks, axisRatio, maskedFractions, skipReasons,
+                 tooManyPeaks):
+        self.ids = ids
+        self.area = area
+        self.width = width
+        self.height = height
+        self.nPeaks = nPeaks
+        self.axisRatio = axisRatio
+        self.maskedFractions = maskedFractions
+        self.skipReasons = skipReasons
+        self.tooManyPeaks = tooManyPeaks
+
+    def __len__(self):
+        return len(self.ids)
+
+    def getWorkList(self):
+        """Indices, in the catalog, of the parents that are deblended"""
+        return np.flatnonzero(self.skipReasons == "")
+
+    def getSkipCounts(self):
+        """Number of parents skipped for each reason
+
+        Returns
+        -------
+        counts: `dict`
+            Number of parents for each of `SKIP_SINGLE_PEAK`, `SKIP_TOO_BIG` and `SKIP_MASKED`.
+        """
+        return {reason: int(np.sum(self.skipReasons == reason))
+                for reason in (SKIP_SINGLE_PEAK, SKIP_TOO_BIG, SKIP_MASKED)}
+
+
+def _getAxisRatio(footprint):
+    """Ratio of the minor to the major axis of the second moments of a footprint"""
+    axes = afwEll.Axes(footprint.getShape())
+    if axes.getA() <= 0:
+        return np.nan
+    return axes.getB()/axes.getA()
+
+
+def classifyParents(sources, mask, maxFootprintArea=0, maxFootprintSize=0, minFootprintAxisRatio=0.,
+                    maskLimits=None, maxNumberOfPeaks=0, processSingles=False):
+    """Compute the properties of every parent of a catalog and whether it is deblended
+
+    The conditions are the ones of the deblender tasks, applied in the same order: a parent with a
+    single peak is skipped (unless ``processSingles``), then a parent that is too large, then a parent
+    with too many masked pixels.  The expensive properties (the moments and the masked fractions) are
+    only computed for the parents that are not skipped by an earlier condition.
+
+    Parameters
+    ----------
+    sources: `lsst.afw.table.SourceCatalog`
+        Catalog of parents.
+    mask: `lsst.afw.image.MaskX` or `None`
+        Mask used to compute the masked fractions.  If `None` the mask limits are not applied,
+        e.g. when the pixels are only read later, one parent at a time.
+    maxFootprintArea: `int`, optional
+        Parents with a larger area are too large (non-positive: no threshold).
+    maxFootprintSize: `int`, optional
+        Parents with a larger bounding box width or height are too large (non-positive: no threshold).
+    minFootprintAxisRatio: `float`, optional
+        Parents with a smaller axis ratio are too large (non-positive: no threshold).
+    maskLimits: `dict`, optional
+        Maximum fraction of masked pixels, keyed by mask plane name.
+    maxNumberOfPeaks: `int`, optional
+        Maximum number of peaks that are deblended, used to set ``tooManyPeaks``.
+    processSingles: `bool`, optional
+        If True, parents with a single peak are not skipped.
+
+    Returns
+    -------
+    classification: `ParentClassification`
+    """
+    n = len(sources)
+    ids = np.zeros(n, dtype=np.int64)
+    area = np.zeros(n, dtype=np.int64)
+    width = np.zeros(n, dtype=np.int32)
+    height = np.zeros(n, dtype=np.int32)
+    nPeaks = np.zeros(n, dtype=np.int32)
+    footprints = []
+    for i, src in enumerate(sources):
+        fp = src.getFootprint()
+        bbox = fp.getBBox()
+        ids[i] = src.getId()
+        area[i] = fp.getArea()
+        width[i] = bbox.getWidth()
+        height[i] = bbox.getHeight()
+        nPeaks[i] = len(fp.getPeaks())
+        footprints.append(fp)
+
+    skipReasons = np.zeros(n, dtype="U%d" % max(len(SKIP_SINGLE_PEAK), len(SKIP_TOO_BIG), len(SKIP_MASKED)))
+    if not processSingles:
+        skipReasons[nPeaks < 2] = SKIP_SINGLE_PEAK
+
+    tooBig = np.zeros(n, dtype=bool)
+    if maxFootprintArea > 0:
+        tooBig |= area > maxFootprintArea
+    if maxFootprintSize > 0:
+        tooBig |= np.maximum(width, height) > maxFootprintSize
+    axisRatio = np.empty(n, dtype=float)
+    axisRatio[:] = np.nan
+    if minFootprintAxisRatio > 0:
+        for i in np.flatnonzero((skipReasons == "") & ~tooBig):
+            axisRatio[i] = _getAxisRatio(footprints[i])
+        # NaN (not computed, or a single pixel) never compares as too elongated
+        with np.errstate(invalid="ignore"):
+            tooBig |= axisRatio < minFootprintAxisRatio
+    skipReasons[(skipReasons == "") & tooBig] = SKIP_TOO_BIG
+
+    maskNames = list(maskLimits.keys()) if maskLimits else []
+    maskedFractions = {}
+    for maskName in maskNames:
+        maskedFractions[maskName] = np.empty(n, dtype=float)
+        maskedFractions[maskName][:] = np.nan
+    if maskNames and mask is not None:
+        bitmasks = [mask.getPlaneBitMask(maskName) for maskName in maskNames]
+        limits = np.array([maskLimits[maskName] for maskName in maskNames])
+        for i in np.flatnonzero(skipReasons == ""):
+            fractions = np.array(butils.getMaskedFractions(footprints[i].spans, mask, bitmasks))
+            for maskName, fraction in zip(maskNames, fractions):
+                maskedFractions[maskName][i] = fraction
+            if np.any(fractions > limits):
+                skipReasons[i] = SKIP_MASKED
+
+    tooManyPeaks = nPeaks > maxNumberOfPeaks
+    return ParentClassification(ids, area, width, height, nPeaks, axisRatio, maskedFractions, skipReasons,
+                                tooManyPeaks)
+
+
+def logClassification(classification, log):
+    """Log the number of parents that will be deblended, and the number skipped for each reason
+
+    Parameters
+    ----------
+    classification: `ParentClassification`
+        Classification of the parents of a catalog.
+    log: `lsst.log.Log`
+        Logger.
+    """
+    workList = classification.getWorkList()
+    counts = classification.getSkipCounts()
+    log.info("Deblending %d of %d parents (%d peaks, %d pixels); skipping %d single-peak, "
+             "%d large and %d masked parents" %
+             (len(workList), len(classification), classification.nPeaks[workList].sum(),
+              classification.area[workList].sum(), counts[SKIP_SINGLE_PEAK], counts[SKIP_TOO_BIG],
+              counts[SKIP_MASKED]))
+
+
+def _classifyFootprint(footprint, mask=None, **kwargs):
+    """Skip reason of a single footprint, ignoring its number of peaks"""
+    catalog = afwTable.SourceCatalog(afwTable.SourceTable.makeMinimalSchema())
+    catalog.addNew().setFootprint(footprint)
+    return classifyParents(catalog, mask, processSingles=True, **kwargs).skipReasons[0]
+
+
+def isLargeFootprint(footprint, maxFootprintArea=0, maxFootprintSize=0, minFootprintAxisRatio=0.):
+    """Whether a single footprint is too large to be deblended
+
+    This applies the conditions of `classifyParents` to a single footprint; use `classifyParents`
+    to classify all of the parents of a catalog.
+
+    Parameters
+    ----------
+    footprint: `lsst.afw.detection.Footprint`
+        Footprint of the parent.
+    maxFootprintArea, maxFootprintSize, minFootprintAxisRatio: optional
+        Thresholds (see `classifyParents`).
+
+    Returns
+    -------
+    isLarge: `bool`
+    """
+    return _classifyFootprint(footprint, maxFootprintArea=maxFootprintArea, maxFootprintSize=maxFootprintSize,
+                              minFootprintAxisRatio=minFootprintAxisRatio) == SKIP_TOO_BIG
+
+
+def isMasked(footprint, mask, maskLimits):
+    """Whether a single footprint has too many masked pixels to be deblended
+
+    This applies the mask limits of `classifyParents` to a single footprint; use `classifyParents`
+    to classify all of the parents of a catalog.
+
+    Parameters
+    ----------
+    footprint: `lsst.afw.detection.Footprint`
+        Footprint of the parent.
+    mask: `lsst.afw.image.MaskX`
+        Mask used to compute the masked fractions.
+    maskLimits: `dict`
+        Maximum fraction of masked pixels, keyed by mask plane name.
+
+    Returns
+    -------
+    isMasked: `bool`
+    """
+    return _classifyFootprint(footprint, mask, maskLimits=maskLimits) == SKIP_MASKED
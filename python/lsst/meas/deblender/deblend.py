@@ -22,22 +22,119 @@
 import math
 import numpy as np
 import time
+import warnings
 
 import lsst.log
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
-import lsst.afw.math as afwMath
 import lsst.afw.geom as afwGeom
-import lsst.afw.geom.ellipses as afwEll
 import lsst.afw.image as afwImage
 import lsst.afw.detection as afwDet
 import lsst.afw.table as afwTable
 
+from .baselineUtils import BaselineUtilsF as butils
+from .classify import (classifyParents, logClassification, isLargeFootprint, isMasked,
+                       SKIP_SINGLE_PEAK, SKIP_TOO_BIG, SKIP_MASKED)
+
 logger = lsst.log.Log.getLogger("meas.deblender.deblend")
 
 __all__ = 'SourceDeblendConfig', 'SourceDeblendTask', 'MultibandDeblendConfig', 'MultibandDeblendTask'
 
 
+def _makeTemplateHeavyFootprint(footprint, image):
+    """HeavyFootprint of a template image
+
+    Equivalent to ``makeHeavyFootprint(footprint, MaskedImageF(image))``, but the pixels of the
+    footprint are copied directly from ``image``, without first copying the whole template into a
+    masked image (with empty mask and variance planes) for every peak and band.
+
+    Parameters
+    ----------
+    footprint: `afw.detection.Footprint`
+        Template footprint, with its peak.
+    image: `afw.image.ImageF`
+        Template image.
+
+    Returns
+    -------
+    heavy: `afw.detection.HeavyFootprintF`
+        Template pixels, with zero mask and variance.
+    """
+    heavy = afwDet.HeavyFootprintF(footprint)
+    heavy.getImageArray()[:] = footprint.spans.flatten(image.getArray(), image.getXY0())
+    return heavy
+
+
+class _PluginStatsRecorder(object):
+    """Store the per-plugin statistics of each parent in a catalog, and accumulate their totals
+
+    See `lsst.meas.deblender.baseline.PluginStats`.
+    """
+
+    def __init__(self, schema, pluginNames, traceMemory=False):
+        self.keys = {}
+        self.totals = {}
+        self.pluginNames = []
+        for name in pluginNames:
+            if name in self.keys:
+                continue
+            self.pluginNames.append(name)
+            prefix = 'deblend_%s_' % name
+            keys = dict(
+                time=schema.addField(prefix + 'time', type=np.float32,
+                                     doc='Wall time spent in the %s plugin, in ms' % name),
+                nCalls=schema.addField(prefix + 'nCalls', type=np.int32,
+                                       doc='Number of executions of the %s plugin' % name),
+                nResets=schema.addField(prefix + 'nResets', type=np.int32,
+                                        doc='Number of deblender resets caused by the %s plugin' % name),
+            )
+            if traceMemory:
+                keys['peakMemory'] = schema.addField(
+                    prefix + 'peakMemory', type=np.int64,
+                    doc='Peak allocation of a single execution of the %s plugin, in bytes' % name)
+            self.keys[name] = keys
+        self.reset()
+
+    def reset(self):
+        """Clear the totals"""
+        self.nParents = 0
+        self.totals = {name: dict(time=0., nCalls=0, nResets=0, peakMemory=0) for name in self.pluginNames}
+
+    def record(self, source, pluginStats):
+        """Set the statistics of a single parent in ``source`` and add them to the totals"""
+        self.nParents += 1
+        for name, stats in pluginStats.items():
+            if name not in self.keys:
+                continue
+            keys = self.keys[name]
+            totals = self.totals[name]
+            source.set(keys['time'], stats.time*1000)
+            source.set(keys['nCalls'], stats.nCalls)
+            source.set(keys['nResets'], stats.nResets)
+            totals['time'] += stats.time*1000
+            totals['nCalls'] += stats.nCalls
+            totals['nResets'] += stats.nResets
+            if 'peakMemory' in keys:
+                source.set(keys['peakMemory'], stats.peakMemory)
+                totals['peakMemory'] = max(totals['peakMemory'], stats.peakMemory)
+
+    def updateMetadata(self, metadata, log=None):
+        """Store the totals in the task metadata, and log the plugins ordered by their total time"""
+        metadata.set('pluginStatsNParents', self.nParents)
+        for name in self.pluginNames:
+            totals = self.totals[name]
+            metadata.set('%s_time' % name, totals['time'])
+            metadata.set('%s_nCalls' % name, totals['nCalls'])
+            metadata.set('%s_nResets' % name, totals['nResets'])
+            if 'peakMemory' in self.keys[name]:
+                metadata.set('%s_peakMemory' % name, totals['peakMemory'])
+        if log is not None:
+            for name in sorted(self.pluginNames, key=lambda n: -self.totals[n]['time']):
+                totals = self.totals[name]
+                log.info('Plugin %s: %.1f ms in %d calls (%d resets) for %d parents' %
+                         (name, totals['time'], totals['nCalls'], totals['nResets'], self.nParents))
+
+
 class SourceDeblendConfig(pexConfig.Config):
 
     edgeHandling = pexConfig.ChoiceField(
@@ -108,6 +205,10 @@ class SourceDeblendConfig(pexConfig.Config):
     tinyFootprintSize = pexConfig.RangeField(dtype=int, default=2, min=2, inclusiveMin=True,
                                            doc=('Footprints smaller in width or height than this value will '
                                                 'be ignored; minimum of 2 due to PSF gradient calculation.'))
+    stencilQuantum = pexConfig.RangeField(dtype=float, default=0., min=0., inclusiveMin=True,
+                                          doc=('Sub-pixel peak offsets are rounded to a multiple of this '
+                                               '(pixels) when looking up the cached PSF fit stencils, so '
+                                               'that peaks can share them; 0 uses the exact offsets.'))
 
     propagateAllPeaks = pexConfig.Field(dtype=bool, default=False,
                                       doc=('Guarantee that all peaks produce a child source.'))
@@ -134,8 +235,44 @@ class SourceDeblendConfig(pexConfig.Config):
                                         "degenerate).  If one of the objects has been labeled as a PSF it "
                                         "will be removed, otherwise the template with the lowest value will "
                                         "be removed."))
+    greedyDegenerateTemplates = pexConfig.Field(dtype=bool, default=False,
+                                                doc=("Remove all of the degenerate templates in a single "
+                                                     "pass, from the most to the least degenerate pair, "
+                                                     "instead of removing one template at a time and "
+                                                     "computing all of the template dot products again"))
     medianSmoothTemplate = pexConfig.Field(dtype=bool, default=True,
                                          doc="Apply a smoothing filter to all of the template images")
+    useParentCutouts = pexConfig.Field(dtype=bool, default=False,
+                                       doc=("Deblend each parent on the minimal padded cutout of the exposure "
+                                            "(see lsst.meas.deblender.tiling) instead of the full image. "
+                                            "The results are identical."))
+    checkpointFile = pexConfig.Field(dtype=str, default=None, optional=True,
+                                     doc=("If set, periodically save the completed parents and their children "
+                                          "to this file (see lsst.meas.deblender.checkpoint), and skip the "
+                                          "parents already saved there when the deblender is rerun"))
+    checkpointInterval = pexConfig.Field(dtype=int, default=100,
+                                         doc="Number of deblended parents between checkpoint writes")
+    noiseSubsample = pexConfig.Field(dtype=int, default=1,
+                                     doc=("Estimate the noise level (sigma1) from every Nth pixel of the "
+                                          "variance plane in each direction; 1 uses every pixel"))
+    cacheNoiseEstimate = pexConfig.Field(dtype=bool, default=False,
+                                         doc=("Reuse the noise level cached in the exposure metadata if the "
+                                              "variance and mask planes are unchanged, and cache it there "
+                                              "when it is computed (see lsst.meas.deblender.noise).  The "
+                                              "cache is written to the header if the exposure is saved"))
+    useNoiseMap = pexConfig.Field(dtype=bool, default=False,
+                                  doc=("Use the local noise level of each parent, from a binned map of the "
+                                       "variance plane (see lsst.meas.deblender.noise.NoiseMap), instead of "
+                                       "a single noise level for the whole image"))
+    noiseMapBinSize = pexConfig.Field(dtype=int, default=256,
+                                      doc="Size, in pixels, of the bins of the noise map")
+    recordPluginStats = pexConfig.Field(dtype=bool, default=False,
+                                        doc=("Record the wall time, number of calls and number of resets of "
+                                             "each deblender plugin in 'deblend_<plugin>_*' columns for each "
+                                             "parent, and their totals in the task metadata"))
+    tracePluginMemory = pexConfig.Field(dtype=bool, default=False,
+                                        doc=("Also record the peak allocation of each deblender plugin "
+                                             "(with tracemalloc; slow). Requires recordPluginStats"))
 
 ## \addtogroup LSST_task_documentation
 ## \{
@@ -185,6 +322,59 @@ class SourceDeblendTask(pipeBase.Task):
                     schema.addField(item.field)
             assert schema == self.peakSchemaMapper.getOutputSchema(), "Logic bug mapping schemas"
         self.addSchemaKeys(schema)
+        if self.config.recordPluginStats:
+            self.pluginStatsRecorder = _PluginStatsRecorder(schema, self.getPluginNames(),
+                                                            self.config.tracePluginMemory)
+        else:
+            self.pluginStatsRecorder = None
+
+    def getDeblendKwargs(self):
+        """!
+        Keyword arguments of lsst.meas.deblender.baseline.deblend for this config.
+
+        @return dict of keyword arguments
+        """
+        kwargs = self.getPluginKwargs()
+        kwargs.update(
+            maxNumberOfPeaks=self.config.maxNumberOfPeaks,
+            recordPluginStats=self.config.recordPluginStats,
+            tracePluginMemory=self.config.tracePluginMemory,
+        )
+        return kwargs
+
+    def getPluginKwargs(self):
+        """!
+        Keyword arguments of lsst.meas.deblender.baseline.makeDeblenderPlugins for this config.
+
+        @return dict of keyword arguments
+        """
+        return dict(
+            psfChisqCut1=self.config.psfChisq1,
+            psfChisqCut2=self.config.psfChisq2,
+            psfChisqCut2b=self.config.psfChisq2b,
+            strayFluxToPointSources=self.config.strayFluxToPointSources,
+            assignStrayFlux=self.config.assignStrayFlux,
+            strayFluxAssignment=self.config.strayFluxRule,
+            rampFluxAtEdge=(self.config.edgeHandling == 'ramp'),
+            patchEdges=(self.config.edgeHandling == 'noclip'),
+            tinyFootprintSize=self.config.tinyFootprintSize,
+            stencilQuantum=self.config.stencilQuantum,
+            clipStrayFluxFraction=self.config.clipStrayFluxFraction,
+            weightTemplates=self.config.weightTemplates,
+            removeDegenerateTemplates=self.config.removeDegenerateTemplates,
+            maxTempDotProd=self.config.maxTempDotProd,
+            greedyDegenerateTemplates=self.config.greedyDegenerateTemplates,
+            medianSmoothTemplate=self.config.medianSmoothTemplate,
+        )
+
+    def getPluginNames(self):
+        """!
+        Names of the plugin functions that lsst.meas.deblender.baseline.deblend runs with this config.
+
+        @return list of names, in order of execution
+        """
+        from lsst.meas.deblender.baseline import makeDeblenderPlugins
+        return [plugin.func.__name__ for plugin in makeDeblenderPlugins(**self.getPluginKwargs())]
 
     def addSchemaKeys(self, schema):
         self.nChildKey = schema.addField('deblend_nChild', type=np.int32,
@@ -241,166 +431,256 @@ class SourceDeblendTask(pipeBase.Task):
         psf = exposure.getPsf()
         self.deblend(exposure, sources, psf)
 
+    def estimateSigma1(self, maskedImage):
+        """!
+        Estimate the noise level of an image: the sqrt of the median of its unmasked variance.
+
+        @param[in] maskedImage  MaskedImage to estimate the noise of
+
+        @return sigma1
+        """
+        from lsst.meas.deblender.noise import estimateSigma1
+        return estimateSigma1(maskedImage, self.config.maskPlanes, self.config.noiseSubsample)
+
+    def getSigma1(self, exposure):
+        """!
+        Noise level of an exposure, reusing (and otherwise setting) the value cached in its metadata
+        when cacheNoiseEstimate is True.
+
+        @param[in] exposure  Exposure to estimate the noise of
+
+        @return sigma1
+        """
+        from lsst.meas.deblender.noise import getSigma1
+        return getSigma1(exposure, self.config.maskPlanes, self.config.noiseSubsample,
+                         self.config.cacheNoiseEstimate, self.log)
+
     def _getPsfFwhm(self, psf, bbox):
         # It should be easier to get a PSF's fwhm;
         # https://dev.lsstcorp.org/trac/ticket/3030
         return psf.computeShape().getDeterminantRadius() * 2.35
 
     @pipeBase.timeMethod
-    def deblend(self, exposure, srcs, psf):
+    def deblend(self, exposure, srcs, psf, sigma1=None):
         """!
         Deblend.
 
         @param[in]     exposure Exposure to process
         @param[in,out] srcs     SourceCatalog containing sources detected on this exposure.
         @param[in]     psf      PSF
+        @param[in]     sigma1   Median noise level of the exposure; if None it is computed from
+                                the variance plane of `exposure` (for each parent if useNoiseMap).
+                                This must be given when `exposure` is only a cutout of the full image.
 
         @return None
         """
         self.log.info("Deblending %d sources" % len(srcs))
 
-        from lsst.meas.deblender.baseline import deblend
+        from lsst.meas.deblender.checkpoint import DeblendCheckpoint, getCheckpointSignature
+        from lsst.meas.deblender.noise import NoiseMap
+
+        checkpoint = None
+        if self.config.checkpointFile:
+            checkpoint = DeblendCheckpoint(self.config.checkpointFile, self.config.checkpointInterval,
+                                           self.log, getCheckpointSignature(srcs, self.config))
+            completed = checkpoint.load("sources")
 
-        # find the median stdev in the image...
         mi = exposure.getMaskedImage()
-        statsCtrl = afwMath.StatisticsControl()
-        statsCtrl.setAndMask(mi.getMask().getPlaneBitMask(self.config.maskPlanes))
-        stats = afwMath.makeStatistics(mi.getVariance(), mi.getMask(), afwMath.MEDIAN, statsCtrl)
-        sigma1 = math.sqrt(stats.getValue(afwMath.MEDIAN))
-        self.log.trace('sigma1: %g', sigma1)
+        noiseMap = None
+        if sigma1 is None:
+            if self.config.useNoiseMap:
+                noiseMap = NoiseMap(mi, self.config.maskPlanes, self.config.noiseMapBinSize)
+            else:
+                sigma1 = self.getSigma1(exposure)
+                self.log.trace('sigma1: %g', sigma1)
+
+        if self.pluginStatsRecorder is not None:
+            self.pluginStatsRecorder.reset()
 
         n0 = len(srcs)
+        classification = self.classifyParents(srcs, mi.getMask())
+        logClassification(classification, self.log)
         nparents = 0
-        for i, src in enumerate(srcs):
+        for i in range(n0):
             #t0 = time.clock()
-
-            fp = src.getFootprint()
-            pks = fp.getPeaks()
+            src = srcs[i]
 
             # Since we use the first peak for the parent object, we should propagate its flags
             # to the parent source.
-            src.assign(pks[0], self.peakSchemaMapper)
+            src.assign(src.getFootprint().getPeaks()[0], self.peakSchemaMapper)
 
-            if len(pks) < 2:
+            if self.flagSkippedParent(src, classification.skipReasons[i], mi.getMask()):
                 continue
 
-            if self.isLargeFootprint(fp):
-                src.set(self.tooBigKey, True)
-                self.skipParent(src, mi.getMask())
-                self.log.trace('Parent %i: skipping large footprint', int(src.getId()))
+            nparents += 1
+            if checkpoint is not None and src.getId() in completed:
+                self.log.trace('Parent %i: restoring from checkpoint', int(src.getId()))
+                checkpoint.restoreFamily(srcs, completed[src.getId()], parent=src)
                 continue
-            if self.isMasked(fp, exposure.getMaskedImage().getMask()):
-                src.set(self.maskedKey, True)
-                self.skipParent(src, mi.getMask())
-                self.log.trace('Parent %i: skipping masked footprint', int(src.getId()))
+
+            if noiseMap is not None:
+                sigma1 = noiseMap.getSigmaForBBox(src.getFootprint().getBBox())
+                self.log.trace('Parent %i: local sigma1: %g', int(src.getId()), sigma1)
+
+            kids = self.deblendParent(exposure, srcs, i, psf, sigma1, bool(classification.tooManyPeaks[i]))
+            #print 'Deblending parent id', src.getId(), 'took', time.clock() - t0
+            if kids is None:
                 continue
 
-            nparents += 1
-            bb = fp.getBBox()
-            psf_fwhm = self._getPsfFwhm(psf, bb)
+            if checkpoint is not None:
+                checkpoint.addFamily("sources", [src] + kids)
+                checkpoint.parentDone()
 
-            self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(pks))
+        if checkpoint is not None:
+            checkpoint.flush()
+        if self.pluginStatsRecorder is not None:
+            self.pluginStatsRecorder.updateMetadata(self.metadata, self.log)
 
-            self.preSingleDeblendHook(exposure, srcs, i, fp, psf, psf_fwhm, sigma1)
-            npre = len(srcs)
+        n1 = len(srcs)
+        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children, total %i sources'
+                      % (n0, nparents, n1-n0, n1))
 
-            # This should really be set in deblend, but deblend doesn't have access to the src
-            src.set(self.tooManyPeaksKey, len(fp.getPeaks()) > self.config.maxNumberOfPeaks)
+    def flagSkippedParent(self, src, skipReason, mask):
+        """!
+        Flag a parent that is not deblended, and set the notDeblendedMask on its pixels
 
-            try:
-                res = deblend(
-                    fp, mi, psf, psf_fwhm, sigma1=sigma1,
-                    psfChisqCut1=self.config.psfChisq1,
-                    psfChisqCut2=self.config.psfChisq2,
-                    psfChisqCut2b=self.config.psfChisq2b,
-                    maxNumberOfPeaks=self.config.maxNumberOfPeaks,
-                    strayFluxToPointSources=self.config.strayFluxToPointSources,
-                    assignStrayFlux=self.config.assignStrayFlux,
-                    strayFluxAssignment=self.config.strayFluxRule,
-                    rampFluxAtEdge=(self.config.edgeHandling == 'ramp'),
-                    patchEdges=(self.config.edgeHandling == 'noclip'),
-                    tinyFootprintSize=self.config.tinyFootprintSize,
-                    clipStrayFluxFraction=self.config.clipStrayFluxFraction,
-                    weightTemplates=self.config.weightTemplates,
-                    removeDegenerateTemplates=self.config.removeDegenerateTemplates,
-                    maxTempDotProd=self.config.maxTempDotProd,
-                    medianSmoothTemplate=self.config.medianSmoothTemplate
-                )
-                if self.config.catchFailures:
-                    src.set(self.deblendFailedKey, False)
-            except Exception as e:
-                if self.config.catchFailures:
-                    self.log.warn("Unable to deblend source %d: %s" % (src.getId(), e))
-                    src.set(self.deblendFailedKey, True)
-                    import traceback
-                    traceback.print_exc()
-                    continue
-                else:
-                    raise
+        @param[in,out] src         The parent source
+        @param[in]     skipReason  Why the parent is skipped, from classifyParents
+                                   (an empty string if it is deblended)
+        @param[in,out] mask        The mask to update, or None if the pixels are not in memory
 
-            kids = []
-            nchild = 0
-            for j, peak in enumerate(res.deblendedParents[0].peaks):
-                heavy = peak.getFluxPortion()
-                if heavy is None or peak.skip:
-                    src.set(self.deblendSkippedKey, True)
-                    if not self.config.propagateAllPeaks:
-                        # Don't care
-                        continue
-                    # We need to preserve the peak: make sure we have enough info to create a minimal
-                    # child src
-                    self.log.trace("Peak at (%i,%i) failed.  Using minimal default info for child.",
-                                      pks[j].getIx(), pks[j].getIy())
-                    if heavy is None:
-                        # copy the full footprint and strip out extra peaks
-                        foot = afwDet.Footprint(src.getFootprint())
-                        peakList = foot.getPeaks()
-                        peakList.clear()
-                        peakList.append(peak.peak)
-                        zeroMimg = afwImage.MaskedImageF(foot.getBBox())
-                        heavy = afwDet.makeHeavyFootprint(foot, zeroMimg)
-                    if peak.deblendedAsPsf:
-                        if peak.psfFitFlux is None:
-                            peak.psfFitFlux = 0.0
-                        if peak.psfFitCenter is None:
-                            peak.psfFitCenter = (peak.peak.getIx(), peak.peak.getIy())
-
-                assert(len(heavy.getPeaks()) == 1)
-
-                src.set(self.deblendSkippedKey, False)
-                child = srcs.addNew()
-                nchild += 1
-                child.assign(heavy.getPeaks()[0], self.peakSchemaMapper)
-                child.setParent(src.getId())
-                child.setFootprint(heavy)
-                child.set(self.psfKey, peak.deblendedAsPsf)
-                child.set(self.hasStrayFluxKey, peak.strayFlux is not None)
-                if peak.deblendedAsPsf:
-                    (cx, cy) = peak.psfFitCenter
-                    child.set(self.psfCenterKey, afwGeom.Point2D(cx, cy))
-                    child.set(self.psfFluxKey, peak.psfFitFlux)
-                child.set(self.deblendRampedTemplateKey, peak.hasRampedTemplate)
-                child.set(self.deblendPatchedTemplateKey, peak.patched)
-                kids.append(child)
+        @return True if the parent is skipped
+        """
+        if skipReason == SKIP_SINGLE_PEAK:
+            return True
+        if skipReason == SKIP_TOO_BIG:
+            src.set(self.tooBigKey, True)
+            self.skipParent(src, mask)
+            self.log.trace('Parent %i: skipping large footprint', int(src.getId()))
+            return True
+        if skipReason == SKIP_MASKED:
+            src.set(self.maskedKey, True)
+            self.skipParent(src, mask)
+            self.log.trace('Parent %i: skipping masked footprint', int(src.getId()))
+            return True
+        return False
 
-            # Child footprints may extend beyond the full extent of their parent's which
-            # results in a failure of the replace-by-noise code to reinstate these pixels
-            # to their original values.  The following updates the parent footprint
-            # in-place to ensure it contains the full union of itself and all of its
-            # children's footprints.
-            spans = src.getFootprint().spans
-            for child in kids:
-                spans = spans.union(child.getFootprint().spans)
-            src.getFootprint().setSpans(spans)
+    def deblendParent(self, exposure, srcs, i, psf, sigma1, tooManyPeaks):
+        """!
+        Deblend a single parent and add its children to the catalog
 
-            src.set(self.nChildKey, nchild)
+        This is the part of deblend() run for every parent; it does not check whether the parent
+        should be skipped (see classifyParents and flagSkippedParent).
 
-            self.postSingleDeblendHook(exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma1, res)
-            #print 'Deblending parent id', src.getId(), 'took', time.clock() - t0
+        @param[in]     exposure      Exposure containing the parent; it may be a cutout of the full image
+                                     as long as it contains the padded bounding box of the parent
+                                     (see lsst.meas.deblender.tiling)
+        @param[in,out] srcs          SourceCatalog containing the parent; the children are added to it
+        @param[in]     i             Index of the parent in srcs
+        @param[in]     psf           PSF
+        @param[in]     sigma1        Noise level for this parent
+        @param[in]     tooManyPeaks  Whether the parent has more than maxNumberOfPeaks peaks
 
-        n1 = len(srcs)
-        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children, total %i sources'
-                      % (n0, nparents, n1-n0, n1))
+        @return the list of children, or None if the deblender failed and catchFailures is set
+        """
+        from lsst.meas.deblender.baseline import deblend
+        from lsst.meas.deblender.tiling import makeParentCutout
+
+        mi = exposure.getMaskedImage()
+        src = srcs[i]
+        fp = src.getFootprint()
+        pks = fp.getPeaks()
+
+        bb = fp.getBBox()
+        psf_fwhm = self._getPsfFwhm(psf, bb)
+        self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(pks))
+
+        self.preSingleDeblendHook(exposure, srcs, i, fp, psf, psf_fwhm, sigma1)
+        npre = len(srcs)
+
+        # This should really be set in deblend, but deblend doesn't have access to the src
+        src.set(self.tooManyPeaksKey, tooManyPeaks)
+
+        if self.config.useParentCutouts:
+            parentImage = makeParentCutout(mi, fp, psf_fwhm,
+                                           rampFluxAtEdge=(self.config.edgeHandling == 'ramp'))
+        else:
+            parentImage = mi
+
+        try:
+            res = deblend(fp, parentImage, psf, psf_fwhm, sigma1=sigma1, **self.getDeblendKwargs())
+            if self.config.catchFailures:
+                src.set(self.deblendFailedKey, False)
+            if self.pluginStatsRecorder is not None:
+                self.pluginStatsRecorder.record(src, res.pluginStats)
+        except Exception as e:
+            if self.config.catchFailures:
+                self.log.warn("Unable to deblend source %d: %s" % (src.getId(), e))
+                src.set(self.deblendFailedKey, True)
+                import traceback
+                traceback.print_exc()
+                return None
+            else:
+                raise
+
+        kids = []
+        nchild = 0
+        for j, peak in enumerate(res.deblendedParents[0].peaks):
+            heavy = peak.getFluxPortion()
+            if heavy is None or peak.skip:
+                src.set(self.deblendSkippedKey, True)
+                if not self.config.propagateAllPeaks:
+                    # Don't care
+                    continue
+                # We need to preserve the peak: make sure we have enough info to create a minimal
+                # child src
+                self.log.trace("Peak at (%i,%i) failed.  Using minimal default info for child.",
+                                  pks[j].getIx(), pks[j].getIy())
+                if heavy is None:
+                    # copy the full footprint and strip out extra peaks
+                    foot = afwDet.Footprint(src.getFootprint())
+                    peakList = foot.getPeaks()
+                    peakList.clear()
+                    peakList.append(peak.peak)
+                    zeroMimg = afwImage.MaskedImageF(foot.getBBox())
+                    heavy = afwDet.makeHeavyFootprint(foot, zeroMimg)
+                if peak.deblendedAsPsf:
+                    if peak.psfFitFlux is None:
+                        peak.psfFitFlux = 0.0
+                    if peak.psfFitCenter is None:
+                        peak.psfFitCenter = (peak.peak.getIx(), peak.peak.getIy())
+
+            assert(len(heavy.getPeaks()) == 1)
+
+            src.set(self.deblendSkippedKey, False)
+            child = srcs.addNew()
+            nchild += 1
+            child.assign(heavy.getPeaks()[0], self.peakSchemaMapper)
+            child.setParent(src.getId())
+            child.setFootprint(heavy)
+            child.set(self.psfKey, peak.deblendedAsPsf)
+            child.set(self.hasStrayFluxKey, peak.strayFlux is not None)
+            if peak.deblendedAsPsf:
+                (cx, cy) = peak.psfFitCenter
+                child.set(self.psfCenterKey, afwGeom.Point2D(cx, cy))
+                child.set(self.psfFluxKey, peak.psfFitFlux)
+            child.set(self.deblendRampedTemplateKey, peak.hasRampedTemplate)
+            child.set(self.deblendPatchedTemplateKey, peak.patched)
+            kids.append(child)
+
+        # Child footprints may extend beyond the full extent of their parent's which
+        # results in a failure of the replace-by-noise code to reinstate these pixels
+        # to their original values.  The following updates the parent footprint
+        # in-place to ensure it contains the full union of itself and all of its
+        # children's footprints.
+        spans = butils.mergeSpanSets([src.getFootprint().spans] +
+                                     [child.getFootprint().spans for child in kids])
+        src.getFootprint().setSpans(spans)
+
+        src.set(self.nChildKey, nchild)
+
+        self.postSingleDeblendHook(exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma1, res)
+        return kids
 
     def preSingleDeblendHook(self, exposure, srcs, i, fp, psf, psf_fwhm, sigma1):
         pass
@@ -408,37 +688,44 @@ class SourceDeblendTask(pipeBase.Task):
     def postSingleDeblendHook(self, exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma1, res):
         pass
 
-    def isLargeFootprint(self, footprint):
-        """Returns whether a Footprint is large
+    def classifyParents(self, srcs, mask):
+        """!
+        Compute the properties of all of the parents, and whether each one is deblended
 
-        'Large' is defined by thresholds on the area, size and axis ratio.
-        These may be disabled independently by configuring them to be non-positive.
+        @param[in] srcs  SourceCatalog of the parents.
+        @param[in] mask  Mask used for the mask limits.
 
-        This is principally intended to get rid of satellite streaks, which the
-        deblender or other downstream processing can have trouble dealing with
-        (e.g., multiple large HeavyFootprints can chew up memory).
+        @return a lsst.meas.deblender.classify.ParentClassification
         """
-        if self.config.maxFootprintArea > 0 and footprint.getArea() > self.config.maxFootprintArea:
-            return True
-        if self.config.maxFootprintSize > 0:
-            bbox = footprint.getBBox()
-            if max(bbox.getWidth(), bbox.getHeight()) > self.config.maxFootprintSize:
-                return True
-        if self.config.minFootprintAxisRatio > 0:
-            axes = afwEll.Axes(footprint.getShape())
-            if axes.getB() < self.config.minFootprintAxisRatio*axes.getA():
-                return True
-        return False
+        return classifyParents(srcs, mask,
+                               maxFootprintArea=self.config.maxFootprintArea,
+                               maxFootprintSize=self.config.maxFootprintSize,
+                               minFootprintAxisRatio=self.config.minFootprintAxisRatio,
+                               maskLimits=self.config.maskLimits,
+                               maxNumberOfPeaks=self.config.maxNumberOfPeaks)
+
+    def isLargeFootprint(self, footprint):
+        """!
+        Returns whether a Footprint is large
+
+        Deprecated: the parents are classified all at once by classifyParents;
+        see lsst.meas.deblender.classify.isLargeFootprint.
+        """
+        warnings.warn("SourceDeblendTask.isLargeFootprint is deprecated; use classifyParents",
+                      DeprecationWarning, stacklevel=2)
+        return isLargeFootprint(footprint, self.config.maxFootprintArea, self.config.maxFootprintSize,
+                                self.config.minFootprintAxisRatio)
 
     def isMasked(self, footprint, mask):
-        """Returns whether the footprint violates the mask limits"""
-        size = float(footprint.getArea())
-        for maskName, limit in self.config.maskLimits.items():
-            maskVal = mask.getPlaneBitMask(maskName)
-            unmaskedSpan = footprint.spans.intersectNot(mask, maskVal) # spanset of unmasked pixels
-            if (size - unmaskedSpan.getArea())/size > limit:
-                return True
-        return False
+        """!
+        Returns whether the footprint violates the mask limits
+
+        Deprecated: the parents are classified all at once by classifyParents;
+        see lsst.meas.deblender.classify.isMasked.
+        """
+        warnings.warn("SourceDeblendTask.isMasked is deprecated; use classifyParents",
+                      DeprecationWarning, stacklevel=2)
+        return isMasked(footprint, mask, self.config.maskLimits)
 
     def skipParent(self, source, mask):
         """Indicate that the parent source is not being deblended
@@ -446,12 +733,12 @@ class SourceDeblendTask(pipeBase.Task):
         We set the appropriate flags and mask.
 
         @param source  The source to flag as skipped
-        @param mask  The mask to update
+        @param mask  The mask to update, or None if the pixels are not in memory
         """
         fp = source.getFootprint()
         source.set(self.deblendSkippedKey, True)
         source.set(self.nChildKey, len(fp.getPeaks())) # It would have this many if we deblended them all
-        if self.config.notDeblendedMask:
+        if self.config.notDeblendedMask and mask is not None:
             mask.addMaskPlane(self.config.notDeblendedMask)
             fp.spans.setMask(mask, mask.getPlaneBitMask(self.config.notDeblendedMask))
 
@@ -470,6 +757,28 @@ class MultibandDeblendConfig(pexConfig.Config):
                               doc=("Maximum number of iterations to deblend a single parent"))
     relativeError = pexConfig.Field(dtype=float, default=1e-3,
                                     doc=("Relative error to use when determining stopping criteria"))
+    warmStartFile = pexConfig.Field(dtype=str, default=None, optional=True,
+                                    doc=("If set, the converged models of each parent are saved to this "
+                                         "file, and used as the initial models of the same parents when "
+                                         "the deblender is rerun (see lsst.meas.deblender.warmStart)"))
+    warmStartMaxIter = pexConfig.Field(dtype=int, default=20,
+                                       doc="Maximum number of iterations for a parent initialized from "
+                                           "a saved model")
+    warmStartRelativeError = pexConfig.Field(dtype=float, default=1e-3,
+                                             doc="Relative error used as stopping criterion for a parent "
+                                                 "initialized from a saved model")
+    perSourceConvergence = pexConfig.Field(dtype=bool, default=False,
+                                           doc=("Stop updating each source once the relative change of its "
+                                                "SED and morphology is below sourceRelativeError, instead of "
+                                                "updating all of the sources until the whole blend has "
+                                                "converged. The number of iterations of each source is "
+                                                "recorded in deblend_scarletIterations"))
+    sourceRelativeError = pexConfig.Field(dtype=float, default=1e-3,
+                                          doc=("Relative change of the SED and morphology of a source below "
+                                               "which it is no longer updated (if perSourceConvergence)"))
+    convergenceCheckInterval = pexConfig.Field(dtype=int, default=10,
+                                               doc=("Number of iterations between two checks of the "
+                                                    "convergence of each source (if perSourceConvergence)"))
 
     # Blend Configuration options
     minTranslation = pexConfig.Field(dtype=float, default=1e-3,
@@ -534,8 +843,19 @@ class MultibandDeblendConfig(pexConfig.Config):
                                         doc=("Whether or not to convolve the morphology with the"
                                              "PSF in each band or use the same morphology"
                                              "in all bands"))
+    psfCacheGridSize = pexConfig.Field(dtype=int, default=0,
+                                       doc=("Size, in pixels, of the grid cells on which the PSF kernels "
+                                            "used for the convolution are computed and cached for the "
+                                            "lifetime of the task. If <= 0 a single kernel per band, at "
+                                            "the average position of the PSF, is used"))
     saveTemplates = pexConfig.Field(dtype=bool, default=True,
                                     doc="Whether or not to save the SEDs and templates")
+    singleOutputCatalog = pexConfig.Field(dtype=bool, default=False,
+                                          doc=("Add a single record per child, with the columns shared by "
+                                               "all bands, to the input catalog (as SourceDeblendTask does), "
+                                               "and only store the HeavyFootprint of each child in each band "
+                                               "in minimal per-band side tables, instead of cloning the "
+                                               "input catalog for every band"))
     processSingles = pexConfig.Field(dtype=bool, default=False,
                                      doc="Whether or not to process isolated sources in the deblender")
     badMask = pexConfig.Field(dtype=str, default="BAD,CR,NO_DATA,SAT,SUSPECT",
@@ -572,7 +892,8 @@ class MultibandDeblendConfig(pexConfig.Config):
         itemtype=float,
         default={},
         doc=("Mask planes with the corresponding limit on the fraction of masked pixels. "
-             "Sources violating this limit will not be deblended."),
+             "Sources violating this limit will not be deblended. "
+             "The limits are applied to the mask of the first band only."),
     )
 
     edgeHandling = pexConfig.ChoiceField(
@@ -632,6 +953,33 @@ class MultibandDeblendConfig(pexConfig.Config):
                                      doc=("As part of the flux calculation, the sum of the templates is"
                                           "calculated. If 'getTemplateSum==True' then the sum of the"
                                           "templates is stored in the result (a 'PerFootprint')."))
+    checkpointFile = pexConfig.Field(dtype=str, default=None, optional=True,
+                                     doc=("If set, periodically save the completed parents and their children "
+                                          "to this file (see lsst.meas.deblender.checkpoint), and skip the "
+                                          "parents already saved there when the deblender is rerun"))
+    checkpointInterval = pexConfig.Field(dtype=int, default=100,
+                                         doc="Number of deblended parents between checkpoint writes")
+    noiseSubsample = pexConfig.Field(dtype=int, default=1,
+                                     doc=("Estimate the noise level (sigma1) from every Nth pixel of the "
+                                          "variance plane in each direction; 1 uses every pixel"))
+    cacheNoiseEstimate = pexConfig.Field(dtype=bool, default=False,
+                                         doc=("Reuse the noise level cached in the exposure metadata if the "
+                                              "variance and mask planes are unchanged, and cache it there "
+                                              "when it is computed (see lsst.meas.deblender.noise).  The "
+                                              "cache is written to the header if the exposure is saved"))
+    useNoiseMap = pexConfig.Field(dtype=bool, default=False,
+                                  doc=("Use the local noise level of each parent, from a binned map of the "
+                                       "variance plane (see lsst.meas.deblender.noise.NoiseMap), instead of "
+                                       "a single noise level for the whole image"))
+    noiseMapBinSize = pexConfig.Field(dtype=int, default=256,
+                                      doc="Size, in pixels, of the bins of the noise map")
+    recordPluginStats = pexConfig.Field(dtype=bool, default=False,
+                                        doc=("Record the wall time, number of calls and number of resets of "
+                                             "each deblender plugin in 'deblend_<plugin>_*' columns for each "
+                                             "parent, and their totals in the task metadata"))
+    tracePluginMemory = pexConfig.Field(dtype=bool, default=False,
+                                        doc=("Also record the peak allocation of each deblender plugin "
+                                             "(with tracemalloc; slow). Requires recordPluginStats"))
 
 class MultibandDeblendTask(pipeBase.Task):
     """MultibandDeblendTask
@@ -661,6 +1009,8 @@ class MultibandDeblendTask(pipeBase.Task):
             Passed to Task.__init__.
         """
         from lsst.meas.deblender import plugins
+        from lsst.meas.deblender.warmStart import ScarletWarmStart
+        from lsst.meas.deblender.baseline import CachingPsfKernels
         import scarlet
 
         pipeBase.Task.__init__(self, **kwargs)
@@ -729,6 +1079,13 @@ class MultibandDeblendTask(pipeBase.Task):
             if ~np.isnan(self.config.tvyThresh):
                 constraints = constraints & scarlet.constraints.TVyConstraint(self.config.tvyThresh)
 
+        if self.config.warmStartFile:
+            self.warmStart = ScarletWarmStart(self.config.warmStartFile)
+            self.log.info("Loaded the models of %d parents from %s" %
+                          (len(self.warmStart), self.config.warmStartFile))
+        else:
+            self.warmStart = None
+
         multiband_plugin = plugins.DeblenderPlugin(
             plugins.buildMultibandTemplates,
             useWeights=self.config.useWeights,
@@ -739,6 +1096,13 @@ class MultibandDeblendTask(pipeBase.Task):
             bgScale=self.config.bgScale,
             relativeError=self.config.relativeError,
             badMask=self.config.badMask.split(","),
+            psfCache=CachingPsfKernels(self.config.psfCacheGridSize),
+            warmStart=self.warmStart,
+            warmStartMaxIter=self.config.warmStartMaxIter,
+            warmStartRelativeError=self.config.warmStartRelativeError,
+            perSourceConvergence=self.config.perSourceConvergence,
+            sourceRelativeError=self.config.sourceRelativeError,
+            convergenceCheckInterval=self.config.convergenceCheckInterval,
         )
         self.plugins = [multiband_plugin]
 
@@ -762,6 +1126,11 @@ class MultibandDeblendTask(pipeBase.Task):
                                                 strayFluxToPointSources=self.config.strayFluxToPointSources,
                                                 getTemplateSum=self.config.getTemplateSum))
 
+        if self.config.recordPluginStats:
+            self.pluginStatsRecorder = _PluginStatsRecorder(
+                schema, [plugin.func.__name__ for plugin in self.plugins], self.config.tracePluginMemory)
+        else:
+            self.pluginStatsRecorder = None
 
     def _addSchemaKeys(self, schema):
         """Add deblender specific keys to the schema
@@ -805,6 +1174,13 @@ class MultibandDeblendTask(pipeBase.Task):
             'deblend_hasStrayFlux', type='Flag',
             doc=('This source was assigned some stray flux'))
 
+        if self.config.perSourceConvergence:
+            self.scarletIterationsKey = schema.addField(
+                'deblend_scarletIterations', type=np.int32,
+                doc='Number of iterations in which scarlet updated this source')
+        else:
+            self.scarletIterationsKey = None
+
         self.log.trace('Added keys to schema: %s', ", ".join(str(x) for x in (
                     self.nChildKey, self.psfKey, self.psfCenterKey, self.psfFluxKey,
                     self.tooManyPeaksKey, self.tooBigKey)))
@@ -839,6 +1215,10 @@ class MultibandDeblendTask(pipeBase.Task):
             These are catalogs with heavy footprints that are the templates
             created by the multiband templates.
             If `self.config.saveTemplates` is `False`, then this item will be None
+
+        If `self.config.singleOutputCatalog` is `True` the children are instead added to
+        ``sources``, and ``flux_catalogs`` and ``template_catalogs`` are side tables with a minimal
+        schema that only hold the id, parent and HeavyFootprint of each record in each band.
         """
         psfs = {B:exp.getPsf() for B, exp in exposures.items()}
         return self.deblend(exposures, sources, psfs)
@@ -864,8 +1244,122 @@ class MultibandDeblendTask(pipeBase.Task):
         src.set(self.deblendRampedTemplateKey, peak.hasRampedTemplate)
         src.set(self.deblendPatchedTemplateKey, peak.patched)
         src.set(self.runtimeKey, 0)
+        if self.scarletIterationsKey is not None and peak.scarletIterations is not None:
+            src.set(self.scarletIterationsKey, peak.scarletIterations)
         return src
 
+    def _addSingleCatalogFamily(self, parent, result, bands, sources, flux_catalogs, template_catalogs):
+        """Add the children of a parent with the ``singleOutputCatalog`` layout
+
+        Each child gets a single record in ``sources``, whose footprint is the union of its
+        footprints in all bands (without pixels) and whose flags are set if they are set in any
+        band. The HeavyFootprint of the child in each band is stored in a record of the side
+        table of that band with the same id. The side tables also get a parent record, whose
+        footprint contains the peaks and spans of all of the children in that band.
+
+        Parameters
+        ----------
+        parent: `lsst.afw.table.source.source.SourceRecord`
+            Parent record in ``sources``.
+        result: `lsst.meas.deblender.baseline.DeblenderResult`
+            Result of the deblender.
+        bands: list of str
+            Names of the bands.
+        sources: `lsst.afw.table.source.source.SourceCatalog`
+            Catalog of the parents, to which the children are added.
+        flux_catalogs: dict or None
+            Side table of the flux-conserved HeavyFootprints in each band.
+        template_catalogs: dict or None
+            Side table of the template HeavyFootprints in each band.
+        """
+        parentId = parent.getId()
+        peakSchema = parent.getFootprint().getPeaks().getSchema()
+        sideTables = []
+        if self.config.saveTemplates:
+            sideTables.append(("template", template_catalogs))
+        if self.config.conserveFlux:
+            sideTables.append(("flux", flux_catalogs))
+
+        sideParents = {}
+        sideSpans = {}
+        for kind, catalogs in sideTables:
+            for band in bands:
+                sideParent = catalogs[band].addNew()
+                sideParent.setId(parentId)
+                sideParent.setFootprint(afwDet.Footprint(afwGeom.SpanSet(), peakSchema))
+                sideParents[kind, band] = sideParent
+                sideSpans[kind, band] = []
+
+        nchild = 0
+        childSpans = [parent.getFootprint().spans]
+        for multiPeak in result.peaks:
+            peaks = [multiPeak.deblendedPeaks[band] for band in bands]
+            fluxPortions = [peak.getFluxPortion() for peak in peaks]
+            # Same criterion as the layout with a catalog per band
+            if all(heavy is None for heavy in fluxPortions) or all(peak.skip for peak in peaks):
+                parent.set(self.deblendSkippedKey, True)
+                if not self.config.propagateAllPeaks:
+                    continue
+                msg = "Peak at {0} failed deblending.  Using minimal default info for child."
+                self.log.trace(msg.format(multiPeak.x, multiPeak.y))
+                pfoot = afwDet.Footprint(parent.getFootprint())
+                pfoot.getPeaks().clear()
+                pfoot.addPeak(multiPeak.x, multiPeak.y, 0)
+                zeroMimg = afwImage.MaskedImageF(pfoot.getBBox())
+                heavies = {(kind, band): afwDet.makeHeavyFootprint(pfoot, zeroMimg)
+                           for kind, catalogs in sideTables for band in bands}
+                firstPeak = pfoot.getPeaks()[0]
+                allSpans = [pfoot.getSpans()]
+            else:
+                parent.set(self.deblendSkippedKey, False)
+                heavies = {}
+                for band, peak, heavy in zip(bands, peaks, fluxPortions):
+                    if self.config.saveTemplates and peak.templateFootprint is not None:
+                        heavies["template", band] = _makeTemplateHeavyFootprint(peak.templateFootprint,
+                                                                               peak.templateImage)
+                    if self.config.conserveFlux and heavy is not None:
+                        heavies["flux", band] = heavy
+                fluxPortions = [heavy for heavy in fluxPortions if heavy is not None]
+                firstPeak = fluxPortions[0].getPeaks()[0]
+                allSpans = ([heavy.getSpans() for heavy in fluxPortions] +
+                            [heavy.getSpans() for heavy in heavies.values()])
+
+            # Shared record, with the footprint of the child in all bands
+            spans = butils.mergeSpanSets(allSpans)
+            footprint = afwDet.Footprint(spans, peakSchema)
+            footprint.getPeaks().append(firstPeak)
+            child = sources.addNew()
+            child.assign(firstPeak, self.peakSchemaMapper)
+            child.setParent(parentId)
+            child.setFootprint(footprint)
+            child.set(self.psfKey, any(peak.deblendedAsPsf for peak in peaks))
+            child.set(self.hasStrayFluxKey, any(peak.strayFlux is not None for peak in peaks))
+            child.set(self.deblendRampedTemplateKey, any(peak.hasRampedTemplate for peak in peaks))
+            child.set(self.deblendPatchedTemplateKey, any(peak.patched for peak in peaks))
+            child.set(self.runtimeKey, 0)
+            if self.scarletIterationsKey is not None and peaks[0].scarletIterations is not None:
+                child.set(self.scarletIterationsKey, peaks[0].scarletIterations)
+            childSpans.append(footprint.spans)
+
+            # Pixels of the child in each band
+            for (kind, band), heavy in heavies.items():
+                record = (template_catalogs if kind == "template" else flux_catalogs)[band].addNew()
+                record.setId(child.getId())
+                record.setParent(parentId)
+                record.setFootprint(heavy)
+                _peak = heavy.getPeaks()[0]
+                sideParents[kind, band].getFootprint().addPeak(_peak.getFx(), _peak.getFy(),
+                                                               _peak.getPeakValue())
+                sideSpans[kind, band].append(heavy.getSpans())
+            nchild += 1
+
+        for key, sideParent in sideParents.items():
+            sideParent.getFootprint().setSpans(butils.mergeSpanSets(sideSpans[key]))
+        # Child footprints may extend beyond the parent footprint
+        # (see SourceDeblendTask.deblend)
+        parent.getFootprint().setSpans(butils.mergeSpanSets(childSpans))
+        parent.set(self.nChildKey, nchild)
+
     @pipeBase.timeMethod
     def deblend(self, exposures, sources, psfs, bands=None):
         """Deblend a data cube of multiband images
@@ -902,8 +1396,14 @@ class MultibandDeblendTask(pipeBase.Task):
             These are catalogs with heavy footprints that are the templates
             created by the multiband templates.
             If `self.config.saveTemplates` is `False`, then this item will be None
+
+        If `self.config.singleOutputCatalog` is `True` the children are instead added to
+        ``sources``, and ``flux_catalogs`` and ``template_catalogs`` are side tables with a minimal
+        schema that only hold the id, parent and HeavyFootprint of each record in each band.
         """
         from lsst.meas.deblender.baseline import newDeblend
+        from lsst.meas.deblender.checkpoint import DeblendCheckpoint, getCheckpointSignature
+        from lsst.meas.deblender.noise import getSigma1, NoiseMap
         import deblender
 
         if bands is None:
@@ -913,29 +1413,57 @@ class MultibandDeblendTask(pipeBase.Task):
 
         # find the median stdev in each image
         sigmas = {}
+        noiseMaps = {} if self.config.useNoiseMap else None
         for f, exposure in exposures.items():
-            mi = exposure.getMaskedImage()
-            statsCtrl = afwMath.StatisticsControl()
-            statsCtrl.setAndMask(mi.getMask().getPlaneBitMask(self.config.maskPlanes))
-            stats = afwMath.makeStatistics(mi.getVariance(), mi.getMask(), afwMath.MEDIAN, statsCtrl)
-            sigma1 = math.sqrt(stats.getValue(afwMath.MEDIAN))
+            if noiseMaps is not None:
+                noiseMaps[f] = NoiseMap(exposure.getMaskedImage(), self.config.maskPlanes,
+                                        self.config.noiseMapBinSize)
+                continue
+            sigma1 = getSigma1(exposure, self.config.maskPlanes, self.config.noiseSubsample,
+                               self.config.cacheNoiseEstimate, self.log)
             self.log.trace('Exposure {0}, sigma1: {1}'.format(f, sigma1))
             sigmas[f] = sigma1
 
         # Create the output catalogs
+        if self.config.singleOutputCatalog:
+            # Side tables with only the id, parent and footprint of each record
+            sideSchema = afwTable.SourceTable.makeMinimalSchema()
+            makeCatalog = lambda: afwTable.SourceCatalog(sideSchema)
+        else:
+            makeCatalog = lambda: afwTable.SourceCatalog(sources.clone())
         if self.config.conserveFlux:
-            flux_catalogs = {band:afwTable.SourceCatalog(sources.clone()) for band in bands}
+            flux_catalogs = {band:makeCatalog() for band in bands}
         else:
             flux_catalogs = None
         if self.config.saveTemplates:
-            template_catalogs = {band:afwTable.SourceCatalog(sources.clone()) for band in bands}
+            template_catalogs = {band:makeCatalog() for band in bands}
         else:
             template_catalogs = None
 
+        # Output catalogs saved in the checkpoint, with the name used for them in the checkpoint
+        outputCatalogs = [("sources", sources)]
+        if self.config.saveTemplates:
+            outputCatalogs += [("template-{0}".format(band), template_catalogs[band]) for band in bands]
+        if self.config.conserveFlux:
+            outputCatalogs += [("flux-{0}".format(band), flux_catalogs[band]) for band in bands]
+        checkpoint = None
+        if self.config.checkpointFile:
+            checkpoint = DeblendCheckpoint(self.config.checkpointFile, self.config.checkpointInterval,
+                                           self.log, getCheckpointSignature(sources, self.config))
+            completed = {name: checkpoint.load(name) for name, cat in outputCatalogs}
+
+        if self.pluginStatsRecorder is not None:
+            self.pluginStatsRecorder.reset()
+
         n0 = len(sources)
         nparents = 0
         maskedImages = {band: exp.getMaskedImage() for band, exp in exposures.items()}
-        for pk, src in enumerate(sources):
+        masks = [maskedImages[band].getMask() for band in bands]
+        # the mask limits are only applied to the mask of the first band
+        classification = self.classifyParents(sources, masks[0])
+        logClassification(classification, self.log)
+        for pk in range(n0):
+            src = sources[pk]
             foot = src.getFootprint()
             logger.info("id: {0}".format(src["id"]))
             peaks = foot.getPeaks()
@@ -945,7 +1473,10 @@ class MultibandDeblendTask(pipeBase.Task):
             src.assign(peaks[0], self.peakSchemaMapper)
 
             # Block of Skipping conditions
-            if len(peaks) < 2 and not self.config.processSingles:
+            skipReason = classification.skipReasons[pk]
+            if skipReason == SKIP_SINGLE_PEAK:
+                if self.config.singleOutputCatalog:
+                    continue
                 for band in bands:
                     if self.config.saveTemplates:
                         tsrc = template_catalogs[band].addNew()
@@ -958,24 +1489,33 @@ class MultibandDeblendTask(pipeBase.Task):
                         tsrc.set(self.runtimeKey, 0)
                         fluxParents[band] = tsrc
                 continue
-            if self.isLargeFootprint(foot):
+            if skipReason == SKIP_TOO_BIG:
                 src.set(self.tooBigKey, True)
-                self.skipParent(src, [mi.getMask() for mi in maskedImages])
+                self.skipParent(src, masks)
                 self.log.trace('Parent %i: skipping large footprint', int(src.getId()))
                 continue
-            if self.isMasked(foot, exposure.getMaskedImage().getMask()):
+            if skipReason == SKIP_MASKED:
                 src.set(self.maskedKey, True)
-                self.skipParent(src, mi.getMask())
+                self.skipParent(src, masks)
                 self.log.trace('Parent %i: skipping masked footprint', int(src.getId()))
                 continue
-            if len(peaks) > self.config.maxNumberOfPeaks:
+            if classification.tooManyPeaks[pk]:
                 src.set(self.tooManyPeaksKey, True)
                 msg = 'Parent {0}: Too many peaks, using the first {1} peaks'
                 self.log.trace(msg.format(int(src.getId()), self.config.maxNumberOfPeaks))
 
             nparents += 1
+            if checkpoint is not None and src.getId() in completed["sources"]:
+                self.log.trace('Parent %i: restoring from checkpoint', int(src.getId()))
+                checkpoint.restoreFamily(sources, completed["sources"][src.getId()], parent=src)
+                for name, cat in outputCatalogs[1:]:
+                    checkpoint.restoreFamily(cat, completed[name][src.getId()])
+                continue
+
             bbox = foot.getBBox()
             psf_fwhms = {band:self._getPsfFwhm(psf, bbox) for band, psf in psfs.items()}
+            if noiseMaps is not None:
+                sigmas = {band: noiseMap.getSigmaForBBox(bbox) for band, noiseMap in noiseMaps.items()}
             self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(peaks))
             self.preSingleDeblendHook(exposures, sources, pk, foot, psfs, psf_fwhms, sigmas)
             npre = len(sources)
@@ -997,10 +1537,14 @@ class MultibandDeblendTask(pipeBase.Task):
                                     psfFwhms=fwhm_list,
                                     filters=bands,
                                     avgNoise=avgNoise,
-                                    maxNumberOfPeaks=self.config.maxNumberOfPeaks
+                                    maxNumberOfPeaks=self.config.maxNumberOfPeaks,
+                                    recordPluginStats=self.config.recordPluginStats,
+                                    tracePluginMemory=self.config.tracePluginMemory,
                 )
                 tf=time.time()
                 runtime = (tf-t0)*1000
+                if self.pluginStatsRecorder is not None:
+                    self.pluginStatsRecorder.record(src, result.pluginStats)
                 if result.failed:
                     src.set(self.deblendFailedKey, False)
                     src.set(self.runtimeKey, 0)
@@ -1016,6 +1560,20 @@ class MultibandDeblendTask(pipeBase.Task):
                 else:
                     raise
 
+            # Number of records in each output catalog before this parent was added
+            npreOutput = [len(cat) for name, cat in outputCatalogs]
+
+            if self.config.singleOutputCatalog:
+                self._addSingleCatalogFamily(src, result, bands, sources, flux_catalogs, template_catalogs)
+                self.postSingleDeblendHook(exposure, flux_catalogs, template_catalogs,
+                                           pk, npre, foot, psfs, psf_fwhms, sigmas, result)
+                if checkpoint is not None:
+                    checkpoint.addFamily("sources", [src] + [sources[i] for i in range(npre, len(sources))])
+                    for (name, cat), n in zip(outputCatalogs[1:], npreOutput[1:]):
+                        checkpoint.addFamily(name, [cat[i] for i in range(n, len(cat))])
+                    checkpoint.parentDone()
+                continue
+
             # Add the merged source as a parent in the catalog for each band
             templateParents = {}
             fluxParents = {}
@@ -1041,8 +1599,8 @@ class MultibandDeblendTask(pipeBase.Task):
                     fluxParents[band] = tsrc
 
             # Add each source to the catalogs in each band
-            templateSpans = {band:afwGeom.SpanSet() for band in bands}
-            fluxSpans = {band:afwGeom.SpanSet() for band in bands}
+            templateSpans = {band:[] for band in bands}
+            fluxSpans = {band:[] for band in bands}
             nchild = 0
             for j, multiPeak in enumerate(result.peaks):
                 heavy = {band:peak.getFluxPortion() for band, peak in multiPeak.deblendedPeaks.items()}
@@ -1076,9 +1634,7 @@ class MultibandDeblendTask(pipeBase.Task):
                     peak = multiPeak.deblendedPeaks[band]
                     if self.config.saveTemplates:
                         cat = template_catalogs[band]
-                        tfoot = peak.templateFootprint
-                        timg  = afwImage.MaskedImageF(peak.templateImage)
-                        tHeavy = afwDet.makeHeavyFootprint(tfoot, timg)
+                        tHeavy = _makeTemplateHeavyFootprint(peak.templateFootprint, peak.templateImage)
                         child = self._addChild(parentId, peak, cat, tHeavy)
                         if parentId==0:
                             child.setId(src.getId())
@@ -1087,7 +1643,7 @@ class MultibandDeblendTask(pipeBase.Task):
                             _peak = tHeavy.getPeaks()[0]
                             templateParents[band].getFootprint().addPeak(_peak.getFx(), _peak.getFy(),
                                                                          _peak.getPeakValue())
-                            templateSpans[band] = templateSpans[band].union(tHeavy.getSpans())
+                            templateSpans[band].append(tHeavy.getSpans())
                     if self.config.conserveFlux:
                         cat = flux_catalogs[band]
                         child = self._addChild(parentId, peak, cat, heavy[band])
@@ -1098,7 +1654,7 @@ class MultibandDeblendTask(pipeBase.Task):
                             _peak = heavy[band].getPeaks()[0]
                             fluxParents[band].getFootprint().addPeak(_peak.getFx(), _peak.getFy(),
                                                                      _peak.getPeakValue())
-                            fluxSpans[band] = fluxSpans[band].union(heavy[band].getSpans())
+                            fluxSpans[band].append(heavy[band].getSpans())
                     nchild += 1
 
             # Child footprints may extend beyond the full extent of their parent's which
@@ -1109,14 +1665,27 @@ class MultibandDeblendTask(pipeBase.Task):
             for band in bands:
                 if self.config.saveTemplates:
                     templateParents[band].set(self.nChildKey, nchild)
-                    templateParents[band].getFootprint().setSpans(templateSpans[band])
+                    templateParents[band].getFootprint().setSpans(butils.mergeSpanSets(templateSpans[band]))
                 if self.config.conserveFlux:
                     fluxParents[band].set(self.nChildKey, nchild)
-                    fluxParents[band].getFootprint().setSpans(fluxSpans[band])
+                    fluxParents[band].getFootprint().setSpans(butils.mergeSpanSets(fluxSpans[band]))
 
             self.postSingleDeblendHook(exposure, flux_catalogs, template_catalogs,
                                        pk, npre, foot, psfs, psf_fwhms, sigmas, result)
 
+            if checkpoint is not None:
+                checkpoint.addFamily("sources", [src])
+                for (name, cat), n in zip(outputCatalogs[1:], npreOutput[1:]):
+                    checkpoint.addFamily(name, [cat[i] for i in range(n, len(cat))])
+                checkpoint.parentDone()
+
+        if checkpoint is not None:
+            checkpoint.flush()
+        if self.pluginStatsRecorder is not None:
+            self.pluginStatsRecorder.updateMetadata(self.metadata, self.log)
+        if self.warmStart is not None:
+            self.warmStart.save()
+
         if flux_catalogs is not None:
             n1 = len(list(flux_catalogs.values())[0])
         else:
@@ -1132,37 +1701,49 @@ class MultibandDeblendTask(pipeBase.Task):
                               pk, npre, fp, psfs, psf_fwhms, sigmas, result):
         pass
 
+    def classifyParents(self, sources, mask):
+        """Compute the properties of all of the parents, and whether each one is deblended
+
+        Parameters
+        ----------
+        sources: `lsst.afw.table.source.source.SourceCatalog`
+            Catalog of the parents.
+        mask: `lsst.afw.image.mask.mask.MaskX`
+            Mask used for the mask limits: `deblend` passes the mask of the first band,
+            so the masked pixels of the other bands are not considered.
+
+        Returns
+        -------
+        classification: `lsst.meas.deblender.classify.ParentClassification`
+        """
+        return classifyParents(sources, mask,
+                               maxFootprintArea=self.config.maxFootprintArea,
+                               maxFootprintSize=self.config.maxFootprintSize,
+                               minFootprintAxisRatio=self.config.minFootprintAxisRatio,
+                               maskLimits=self.config.maskLimits,
+                               maxNumberOfPeaks=self.config.maxNumberOfPeaks,
+                               processSingles=self.config.processSingles)
+
     def isLargeFootprint(self, footprint):
         """Returns whether a Footprint is large
 
-        'Large' is defined by thresholds on the area, size and axis ratio.
-        These may be disabled independently by configuring them to be non-positive.
-
-        This is principally intended to get rid of satellite streaks, which the
-        deblender or other downstream processing can have trouble dealing with
-        (e.g., multiple large HeavyFootprints can chew up memory).
+        Deprecated: the parents are classified all at once by `classifyParents`;
+        see `lsst.meas.deblender.classify.isLargeFootprint`.
         """
-        if self.config.maxFootprintArea > 0 and footprint.getArea() > self.config.maxFootprintArea:
-            return True
-        if self.config.maxFootprintSize > 0:
-            bbox = footprint.getBBox()
-            if max(bbox.getWidth(), bbox.getHeight()) > self.config.maxFootprintSize:
-                return True
-        if self.config.minFootprintAxisRatio > 0:
-            axes = afwEll.Axes(footprint.getShape())
-            if axes.getB() < self.config.minFootprintAxisRatio*axes.getA():
-                return True
-        return False
+        warnings.warn("MultibandDeblendTask.isLargeFootprint is deprecated; use classifyParents",
+                      DeprecationWarning, stacklevel=2)
+        return isLargeFootprint(footprint, self.config.maxFootprintArea, self.config.maxFootprintSize,
+                                self.config.minFootprintAxisRatio)
 
     def isMasked(self, footprint, mask):
-        """Returns whether the footprint violates the mask limits"""
-        size = float(footprint.getArea())
-        for maskName, limit in self.config.maskLimits.items():
-            maskVal = mask.getPlaneBitMask(maskName)
-            unmaskedSpan = footprint.spans.intersectNot(mask, maskVal) # spanset of unmasked pixels
-            if (size - unmaskedSpan.getArea())/size > limit:
-                return True
-        return False
+        """Returns whether the footprint violates the mask limits
+
+        Deprecated: the parents are classified all at once by `classifyParents`;
+        see `lsst.meas.deblender.classify.isMasked`.
+        """
+        warnings.warn("MultibandDeblendTask.isMasked is deprecated; use classifyParents",
+                      DeprecationWarning, stacklevel=2)
+        return isMasked(footprint, mask, self.config.maskLimits)
 
     def skipParent(self, source, masks):
         """Indicate that the parent source is not being deblended
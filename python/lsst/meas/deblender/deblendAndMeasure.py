@@ -22,15 +22,28 @@
 #
 
 from __future__ import print_function
+from builtins import range
+from builtins import object
+from collections import defaultdict
+import math
+import os
+import numpy as np
+
 import lsst.pex.config as pexConfig
 import lsst.pex.exceptions as pexExceptions
 import lsst.pipe.base as pipeBase
 import lsst.daf.base as dafBase
+import lsst.afw.detection as afwDet
 import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.afw.table as afwTable
 from lsst.meas.algorithms import SourceMeasurementTask
 from lsst.meas.deblender import SourceDeblendTask
+from lsst.meas.deblender.tiling import ParentCutoutIterator
+from lsst.meas.deblender.noise import getCachedSigma1, getPlanesChecksum, NoiseMap
+from lsst.meas.deblender.checkpoint import DeblendCheckpoint, getCheckpointSignature
+from lsst.meas.deblender.classify import logClassification
 
 
 class DeblendAndMeasureConfig(pexConfig.Config):
@@ -43,6 +56,34 @@ class DeblendAndMeasureConfig(pexConfig.Config):
     sourceOutputFile = pexConfig.Field(
         dtype=str, default=None, doc="Write sources to given filename (default: use butler)", optional=True)
 
+    readParentCutouts = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("Do not load the full calexp to deblend: read only the (padded) bounding box of each parent "
+             "from disk.  The children are identical to the ones obtained on the full calexp.  The full "
+             "calexp is still read for the measurement, unless measureOnCutouts is set."))
+    readStripHeight = pexConfig.Field(
+        dtype=int, default=256,
+        doc="Height of the strips of the variance plane read to estimate sigma1 when readParentCutouts")
+    measureOnCutouts = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("When readParentCutouts, also measure each family on the bounding box of the family grown "
+             "by measureCutoutPadding instead of on the full calexp.  This is NOT equivalent to measuring "
+             "on the full calexp: the noise replacement is drawn over each cutout (with its own noise "
+             "statistics and random sequence), and apertures or neighbouring footprints that extend "
+             "beyond the cutout are truncated (see DeblendAndMeasureTask.measureByParent)."))
+    measureCutoutPadding = pexConfig.Field(
+        dtype=int, default=50,
+        doc=("Number of pixels added around the bounding box of each family when measureOnCutouts; "
+             "it should cover the largest measurement aperture"))
+
+    streamSources = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("Write the children to disk in blocks as the parents are deblended instead of keeping "
+             "them all in memory (see StreamingSourceWriter).  Requires sourceOutputFile and "
+             "doMeasurement=False; read the result back with readStreamedSources."))
+    streamBlockSize = pexConfig.Field(
+        dtype=int, default=100, doc="Number of parents whose children are written in a single block")
+
     deblend = pexConfig.ConfigurableField(
         target=SourceDeblendTask,
         doc="Split blended sources into their components",
@@ -52,6 +93,83 @@ class DeblendAndMeasureConfig(pexConfig.Config):
         doc="Final source measurement on low-threshold detections",
     )
 
+    def validate(self):
+        pexConfig.Config.validate(self)
+        if self.streamSources:
+            if not self.sourceOutputFile:
+                raise ValueError("streamSources requires sourceOutputFile")
+            if self.doMeasurement:
+                raise ValueError("streamSources cannot be used with doMeasurement, "
+                                 "which needs all of the children in memory")
+
+
+class StreamingSourceWriter(object):
+    """Write deblended children to disk in blocks as the deblender proceeds
+
+    The children of every `blockSize` parents are written to a side file
+    ``<root>-children<NNNN>.fits`` (including their HeavyFootprints unless `flags` says otherwise)
+    and dropped from memory.  When the deblender is done, `close` writes the parents to
+    `filename`, with the number of child blocks in its metadata.  readStreamedSources reads the
+    parents and the blocks back into the catalog that the non-streaming path would have written:
+    the parents, followed by the children in parent order.
+    """
+
+    def __init__(self, filename, table, blockSize=100, flags=0):
+        self.filename = filename
+        self.table = table
+        self.blockSize = blockSize
+        self.flags = flags
+        self.nBlocks = 0
+        self.nParents = 0
+        self.children = afwTable.SourceCatalog(table)
+
+    def addFamily(self, parent, children):
+        """Add the children of a single completed parent"""
+        self.children.extend(children)
+        self.nParents += 1
+        if self.nParents >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered children to the next block file"""
+        if len(self.children) > 0:
+            self.children.writeFits(getChildBlockFilename(self.filename, self.nBlocks), flags=self.flags)
+            self.nBlocks += 1
+        self.children = afwTable.SourceCatalog(self.table)
+        self.nParents = 0
+
+    def close(self, parents):
+        """Write the remaining children and the parent catalog"""
+        self.flush()
+        metadata = parents.getMetadata()
+        if metadata is None:
+            metadata = dafBase.PropertyList()
+        metadata.set("DEBLEND_NCHILDBLOCKS", self.nBlocks)
+        parents.setMetadata(metadata)
+        parents.writeFits(self.filename, flags=self.flags)
+
+
+def getChildBlockFilename(filename, block):
+    """Name of the file holding child block number `block` for the streamed catalog `filename`"""
+    root, ext = os.path.splitext(filename)
+    return "%s-children%04d%s" % (root, block, ext or ".fits")
+
+
+def readStreamedSources(filename, flags=0):
+    """Read a catalog written by StreamingSourceWriter
+
+    @param[in] filename  Name of the parent catalog
+    @param[in] flags     Flags passed to SourceCatalog.readFits
+
+    @return SourceCatalog containing the parents followed by all of the children
+    """
+    srcs = afwTable.SourceCatalog.readFits(filename, 0, flags)
+    nBlocks = srcs.getMetadata().getInt("DEBLEND_NCHILDBLOCKS")
+    for block in range(nBlocks):
+        children = afwTable.SourceCatalog.readFits(getChildBlockFilename(filename, block), 0, flags)
+        srcs.extend(children, deep=True)
+    return srcs
+
 
 class DeblendAndMeasureTask(pipeBase.CmdLineTask):
     ConfigClass = DeblendAndMeasureConfig
@@ -66,7 +184,10 @@ class DeblendAndMeasureTask(pipeBase.CmdLineTask):
     @pipeBase.timeMethod
     def run(self, dataRef):
         self.log.info("Processing %s" % (dataRef.dataId))
-        calexp = dataRef.get('calexp')
+        if self.config.readParentCutouts:
+            calexp = None
+        else:
+            calexp = dataRef.get('calexp')
         srcs = dataRef.get('src')
         print('Calexp:', calexp)
         print('srcs:', srcs)
@@ -97,20 +218,287 @@ class DeblendAndMeasureTask(pipeBase.CmdLineTask):
         srcs = outsources
         print(len(srcs), 'sources before deblending')
 
+        sourceWriteFlags = (0 if self.config.doWriteHeavyFootprintsInSources
+                            else afwTable.SOURCE_IO_NO_HEAVY_FOOTPRINTS)
+        writer = None
+        if self.config.streamSources:
+            writer = StreamingSourceWriter(self.config.sourceOutputFile, srcs.getTable(),
+                                           blockSize=self.config.streamBlockSize, flags=sourceWriteFlags)
+
         if self.config.doDeblend:
-            self.deblend.run(calexp, srcs)
+            if self.config.readParentCutouts or writer is not None:
+                srcs = self.deblendByParent(dataRef, calexp, srcs, writer=writer)
+            else:
+                self.deblend.run(calexp, srcs)
 
         if self.config.doMeasurement:
-            self.measurement.run(calexp, srcs)
+            if calexp is None and self.config.measureOnCutouts:
+                self.measureByParent(dataRef, srcs)
+            else:
+                if calexp is None:
+                    # The parents were deblended on cutouts, so the NOT_DEBLENDED mask that the
+                    # deblender sets on the full calexp is only set now
+                    calexp = dataRef.get('calexp')
+                    if self.config.doDeblend:
+                        self.setNotDeblendedMask(calexp, srcs)
+                self.measurement.run(calexp, srcs)
 
-        if srcs is not None and self.config.doWriteSources:
-            sourceWriteFlags = (0 if self.config.doWriteHeavyFootprintsInSources
-                                else afwTable.SOURCE_IO_NO_HEAVY_FOOTPRINTS)
+        if writer is not None:
+            print('Writing streamed "src" parents')
+            writer.close(srcs)
+        elif srcs is not None and self.config.doWriteSources:
             print('Writing "src" outputs')
             if self.config.sourceOutputFile:
                 srcs.writeFits(self.config.sourceOutputFile, flags=sourceWriteFlags)
             else:
                 dataRef.put(srcs, 'src', flags=sourceWriteFlags)
 
+    def readSigma1(self, dataRef, bbox):
+        """Compute the deblender's sigma1 without loading the full calexp
+
+        The variance and mask planes are read in strips of `readStripHeight` rows, and only the
+        unmasked variance values of every Nth pixel (deblend.noiseSubsample) are kept, so the result
+        is the value lsst.meas.deblender.noise.estimateSigma1 computes on the full calexp.
+        If cacheNoiseEstimate is set, a value cached in the calexp header by
+        lsst.meas.deblender.noise is used instead when it was computed from the same pixels.
+        """
+        config = self.deblend.config
+        step = max(config.noiseSubsample, 1)
+        values = []
+        andMask = None
+        checksum = (0, 0)
+        y = bbox.getMinY()
+        while y <= bbox.getMaxY():
+            height = min(self.config.readStripHeight, bbox.getMaxY() + 1 - y)
+            strip = afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), y),
+                                  afwGeom.Extent2I(bbox.getWidth(), height))
+            mi = dataRef.get('calexp_sub', bbox=strip, imageOrigin="PARENT", immediate=True).getMaskedImage()
+            if andMask is None:
+                andMask = mi.getMask().getPlaneBitMask(config.maskPlanes)
+            if config.cacheNoiseEstimate:
+                checksum = getPlanesChecksum(mi, checksum)
+            start = (bbox.getMinY() - y) % step
+            mask = mi.getMask().getArray()[start::step, ::step]
+            variance = mi.getVariance().getArray()[start::step, ::step]
+            values.append(variance[(mask & andMask) == 0])
+            del mi
+            y += height
+        if config.cacheNoiseEstimate:
+            sigma1 = getCachedSigma1(dataRef.get('calexp_md', immediate=True), andMask, step, checksum)
+            if sigma1 is not None:
+                return sigma1
+        values = np.concatenate(values).astype(np.float32)
+        if step > 1:
+            if np.all(np.isnan(values)):
+                return float("nan")
+            return math.sqrt(np.nanmedian(values))
+        var = afwImage.ImageF(values.reshape(1, -1))
+        stats = afwMath.makeStatistics(var, afwMath.MEDIAN)
+        return math.sqrt(stats.getValue(afwMath.MEDIAN))
+
+    def readPsf(self, dataRef, bbox):
+        """Read the PSF of the calexp, along with a single one of its pixels"""
+        corner = afwGeom.Box2I(bbox.getMin(), afwGeom.Extent2I(1, 1))
+        return dataRef.get('calexp_sub', bbox=corner, imageOrigin="PARENT", immediate=True).getPsf()
+
+    def readCutout(self, dataRef, bbox):
+        """Read the sub-image of the calexp in `bbox` (PARENT coordinates)"""
+        return dataRef.get('calexp_sub', bbox=bbox, imageOrigin="PARENT", immediate=True)
+
+    def deblendByParent(self, dataRef, calexp, srcs, writer=None):
+        """Deblend the parents one at a time
+
+        If `calexp` is None each parent is deblended on the padded bounding box given by
+        lsst.meas.deblender.tiling.getParentCutoutBBox, read from disk through a
+        ParentCutoutIterator, so the full calexp is never in memory.  The mask limits of the
+        deblender are then applied to the pixels of each parent once they are read.
+
+        The per-parent core of the deblender (SourceDeblendTask.deblendParent) is called directly,
+        so the noise level, checkpoint and plugin statistics are set up once for the whole catalog.
+        As in SourceDeblendTask.deblend, the noise level of each parent is read from a NoiseMap if
+        useNoiseMap is set (computed one row of bins at a time when reading cutouts).
+
+        If `writer` is None the children are appended after all of the parents, in parent order,
+        exactly as SourceDeblendTask.deblend does on the full image.  Otherwise each completed
+        family is handed to `writer` and the children are not kept in memory.
+
+        @param[in] dataRef  Data reference for the calexp
+        @param[in] calexp   Exposure to deblend, or None to read cutouts
+        @param[in] srcs     Catalog of parents
+        @param[in] writer   StreamingSourceWriter, or None
+
+        @return catalog containing the parents (followed by their children if `writer` is None)
+        """
+        deblendTask = self.deblend
+        config = deblendTask.config
+        sigma1 = None
+        noiseMap = None
+        if calexp is None:
+            imageBBox = dataRef.get('calexp_bbox')
+            if config.useNoiseMap:
+                noiseMap = NoiseMap.fromStrips(imageBBox,
+                                               lambda bbox: self.readCutout(dataRef, bbox).getMaskedImage(),
+                                               config.maskPlanes, config.noiseMapBinSize)
+            else:
+                sigma1 = self.readSigma1(dataRef, imageBBox)
+            psf = self.readPsf(dataRef, imageBBox)
+            mask = None
+
+            def readCutout(bbox):
+                return self.readCutout(dataRef, bbox)
+        else:
+            imageBBox = calexp.getBBox()
+            if config.useNoiseMap:
+                noiseMap = NoiseMap(calexp.getMaskedImage(), config.maskPlanes, config.noiseMapBinSize)
+            else:
+                sigma1 = deblendTask.getSigma1(calexp)
+            psf = calexp.getPsf()
+            mask = calexp.getMaskedImage().getMask()
+
+            def readCutout(bbox):
+                return calexp.Factory(calexp, bbox, afwImage.PARENT)
+
+        checkpoint = None
+        if config.checkpointFile:
+            checkpoint = DeblendCheckpoint(config.checkpointFile, config.checkpointInterval, self.log,
+                                           getCheckpointSignature(srcs, config))
+            completed = checkpoint.load("sources")
+        if deblendTask.pluginStatsRecorder is not None:
+            deblendTask.pluginStatsRecorder.reset()
+
+        n0 = len(srcs)
+        classification = deblendTask.classifyParents(srcs, mask)
+        logClassification(classification, self.log)
+        tooManyPeaks = dict(zip(classification.ids, classification.tooManyPeaks))
+        workList = afwTable.SourceCatalog(srcs.getTable())
+        for i, src in enumerate(srcs):
+            # Since we use the first peak for the parent object, we should propagate its flags
+            # to the parent source.
+            src.assign(src.getFootprint().getPeaks()[0], deblendTask.peakSchemaMapper)
+            if not deblendTask.flagSkippedParent(src, classification.skipReasons[i], mask):
+                workList.append(src)
+
+        children = []
+        nparents = 0
+        nchildren = 0
+        cutouts = ParentCutoutIterator(workList, imageBBox, lambda bbox: deblendTask._getPsfFwhm(psf, bbox),
+                                       readCutout, rampFluxAtEdge=(config.edgeHandling == 'ramp'))
+        for src, exposure in cutouts:
+            # Share the table (and its IdFactory) so that the children get the same ids
+            parentCat = afwTable.SourceCatalog(srcs.getTable())
+            parentCat.append(src)
+            if mask is None:
+                # The mask limits need the pixels of the parent, which are only read now
+                cutoutMask = exposure.getMaskedImage().getMask()
+                parentClassification = deblendTask.classifyParents(parentCat, cutoutMask)
+                if deblendTask.flagSkippedParent(src, parentClassification.skipReasons[0], None):
+                    continue
+            nparents += 1
+            if checkpoint is not None and src.getId() in completed:
+                self.log.trace('Parent %i: restoring from checkpoint', int(src.getId()))
+                checkpoint.restoreFamily(parentCat, completed[src.getId()], parent=src)
+            else:
+                if noiseMap is not None:
+                    sigma1 = noiseMap.getSigmaForBBox(src.getFootprint().getBBox())
+                    self.log.trace('Parent %i: local sigma1: %g', int(src.getId()), sigma1)
+                kids = deblendTask.deblendParent(exposure, parentCat, 0, psf, sigma1,
+                                                 bool(tooManyPeaks[src.getId()]))
+                if kids is None:
+                    continue
+                if checkpoint is not None:
+                    checkpoint.addFamily("sources", [src] + kids)
+                    checkpoint.parentDone()
+            nchildren += len(parentCat) - 1
+            if writer is not None:
+                writer.addFamily(src, parentCat[1:])
+            else:
+                children.extend(parentCat[1:])
+            del exposure
+
+        if checkpoint is not None:
+            checkpoint.flush()
+        if deblendTask.pluginStatsRecorder is not None:
+            deblendTask.pluginStatsRecorder.updateMetadata(deblendTask.metadata, self.log)
+        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children' %
+                      (n0, nparents, nchildren))
+
+        for child in children:
+            srcs.append(child)
+        return srcs
+
+    def measureByParent(self, dataRef, srcs):
+        """Measure the sources one family at a time, on cutouts read from disk
+
+        Each family (a parent and its children) is measured on the bounding box of the family
+        grown by measureCutoutPadding.  The neighbouring parents that overlap the cutout are
+        measured along with it, with their footprints clipped to the cutout, so that their
+        pixels are replaced by noise; only the measurements of the family are kept.
+
+        The results differ from measuring on the full calexp, so this is only used when
+        measureOnCutouts is set:
+        - the NoiseReplacer computes its noise level on each cutout, and draws the replacement
+          noise from a random sequence started again for each cutout;
+        - apertures, and footprints of the neighbours, extending beyond the cutout are truncated.
+
+        @param[in]     dataRef  Data reference for the calexp
+        @param[in,out] srcs     Catalog of parents followed by their children
+        """
+        imageBBox = dataRef.get('calexp_bbox')
+        parents = [src for src in srcs if src.getParent() == 0]
+        children = defaultdict(list)
+        for src in srcs:
+            if src.getParent() != 0:
+                children[src.getParent()].append(src)
+        corners = np.array([[bb.getMinX(), bb.getMinY(), bb.getMaxX(), bb.getMaxY()]
+                            for bb in (parent.getFootprint().getBBox() for parent in parents)], dtype=int)
+        table = srcs.getTable().clone()
+        for k, parent in enumerate(parents):
+            family = [parent] + children[parent.getId()]
+            bbox = afwGeom.Box2I(parent.getFootprint().getBBox())
+            for child in family[1:]:
+                bbox.include(child.getFootprint().getBBox())
+            bbox.grow(self.config.measureCutoutPadding)
+            bbox.clip(imageBBox)
+            exposure = self.readCutout(dataRef, bbox)
+
+            cat = afwTable.SourceCatalog(table)
+            for record in family:
+                cat.append(table.copyRecord(record))
+            overlaps = np.flatnonzero((corners[:, 0] <= bbox.getMaxX()) & (corners[:, 2] >= bbox.getMinX()) &
+                                      (corners[:, 1] <= bbox.getMaxY()) & (corners[:, 3] >= bbox.getMinY()))
+            for n in overlaps:
+                if n == k:
+                    continue
+                footprint = afwDet.Footprint(parents[n].getFootprint())
+                footprint.clipTo(bbox)
+                if footprint.getArea() == 0:
+                    continue
+                neighbour = table.copyRecord(parents[n])
+                neighbour.setFootprint(footprint)
+                cat.append(neighbour)
+
+            if self.config.doDeblend:
+                self.setNotDeblendedMask(exposure, cat)
+            self.measurement.run(exposure, cat)
+            for record, measured in zip(family, cat):
+                record.assign(measured)
+            del exposure
+
+    def setNotDeblendedMask(self, exposure, srcs):
+        """Set the mask bits that SourceDeblendTask.skipParent sets on skipped parents
+
+        When deblending on cutouts the calexp on disk is not modified, so we reproduce the
+        NOT_DEBLENDED mask on the exposure (or cutout) used for measurement.
+        """
+        maskName = self.deblend.config.notDeblendedMask
+        if not maskName:
+            return
+        mask = exposure.getMaskedImage().getMask()
+        mask.addMaskPlane(maskName)
+        bit = mask.getPlaneBitMask(maskName)
+        for src in srcs:
+            if src.get(self.deblend.tooBigKey) or src.get(self.deblend.maskedKey):
+                src.getFootprint().spans.clippedTo(mask.getBBox()).setMask(mask, bit)
+
 if __name__ == '__main__':
     DeblendAndMeasureTask.parseAndRun()
@@ -0,0 +1,293 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Noise level (``sigma1``) of an image, as used by the deblender
+
+``sigma1`` is the square root of the median of the unmasked pixels of the variance plane.
+Computing the median of a large coadd is expensive, so the value can be computed on a regular
+subsample of the pixels, and can optionally be cached in the metadata of the exposure (keys
+``DEBLEND_SIGMA1*``) so that other deblender runs, or later tasks, on the same exposure can reuse it.
+The cached value is stored with a checksum of the variance and mask planes, and is ignored if the
+pixels have changed since it was computed.
+
+`NoiseMap` gives the local noise level of a parent instead of a single value for the whole image.
+"""
+from builtins import object
+import math
+import warnings
+import zlib
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.math as afwMath
+
+__all__ = ["estimateSigma1", "getSigma1", "getPlanesChecksum", "getCachedSigma1", "setCachedSigma1",
+           "NoiseMap"]
+
+SIGMA1_KEY = "DEBLEND_SIGMA1"
+SIGMA1_MASK_KEY = "DEBLEND_SIGMA1_ANDMASK"
+SIGMA1_SUBSAMPLE_KEY = "DEBLEND_SIGMA1_SUBSAMPLE"
+SIGMA1_CHECKSUM_KEY = "DEBLEND_SIGMA1_CHECKSUM"
+
+# Number of rows of a plane passed to crc32 at once, to avoid copying a whole plane
+CHECKSUM_ROWS = 256
+
+
+def estimateSigma1(maskedImage, maskPlanes, subsample=1):
+    """Compute the noise level of an image
+
+    Parameters
+    ----------
+    maskedImage: `afw.image.MaskedImageF`
+        Image to estimate the noise of.
+    maskPlanes: list of `str`
+        Pixels with any of these mask planes set are ignored.
+    subsample: `int`, optional
+        Only use every ``subsample`` pixel in each direction.
+        With the default of 1 every pixel is used, and the median is computed by afwMath.
+        In both cases NaN variances are ignored.
+
+    Returns
+    -------
+    sigma1: `float`
+        Square root of the median unmasked variance.
+    """
+    andMask = maskedImage.getMask().getPlaneBitMask(maskPlanes)
+    if subsample <= 1:
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setAndMask(andMask)
+        stats = afwMath.makeStatistics(maskedImage.getVariance(), maskedImage.getMask(), afwMath.MEDIAN,
+                                       statsCtrl)
+        return math.sqrt(stats.getValue(afwMath.MEDIAN))
+    variance = maskedImage.getVariance().getArray()[::subsample, ::subsample]
+    mask = maskedImage.getMask().getArray()[::subsample, ::subsample]
+    good = variance[(mask & andMask) == 0]
+    # NaN variances are ignored, as by afwMath.makeStatistics
+    if np.all(np.isnan(good)):
+        return float("nan")
+    return math.sqrt(np.nanmedian(good))
+
+
+def getPlanesChecksum(maskedImage, checksum=(0, 0)):
+    """Checksum of the variance and mask planes of an image
+
+    Parameters
+    ----------
+    maskedImage: `afw.image.MaskedImageF`
+        Image to compute the checksum of.
+    checksum: `tuple`, optional
+        Checksum of the rows preceding ``maskedImage``, so that the checksum of a large image can be
+        computed one strip of full rows at a time.
+
+    Returns
+    -------
+    checksum: `tuple` of `int`
+        CRC32 of the variance plane and of the mask plane.
+    """
+    varianceCrc, maskCrc = checksum
+    variance = maskedImage.getVariance().getArray()
+    mask = maskedImage.getMask().getArray()
+    for y in range(0, variance.shape[0], CHECKSUM_ROWS):
+        varianceCrc = zlib.crc32(variance[y:y + CHECKSUM_ROWS].tobytes(), varianceCrc) & 0xffffffff
+        maskCrc = zlib.crc32(mask[y:y + CHECKSUM_ROWS].tobytes(), maskCrc) & 0xffffffff
+    return varianceCrc, maskCrc
+
+
+def _formatChecksum(checksum):
+    return "%08x%08x" % checksum
+
+
+def getCachedSigma1(metadata, andMask, subsample, checksum):
+    """Read the noise level cached in ``metadata``
+
+    Parameters
+    ----------
+    metadata: `lsst.daf.base.PropertySet`
+        Metadata of the exposure.
+    andMask: `int`
+        Bits of the masked pixels.
+    subsample: `int`
+        Subsampling of the pixels.
+    checksum: `tuple` of `int`
+        Current checksum of the variance and mask planes (see `getPlanesChecksum`).
+
+    Returns
+    -------
+    sigma1: `float` or `None`
+        The cached value, or `None` if there is none computed with the same mask and subsampling
+        on the same pixels.
+    """
+    if metadata is None:
+        return None
+    for key in (SIGMA1_KEY, SIGMA1_MASK_KEY, SIGMA1_SUBSAMPLE_KEY, SIGMA1_CHECKSUM_KEY):
+        if not metadata.exists(key):
+            return None
+    if (metadata.get(SIGMA1_MASK_KEY) != andMask or metadata.get(SIGMA1_SUBSAMPLE_KEY) != subsample or
+            metadata.get(SIGMA1_CHECKSUM_KEY) != _formatChecksum(checksum)):
+        return None
+    return metadata.get(SIGMA1_KEY)
+
+
+def setCachedSigma1(metadata, sigma1, andMask, subsample, checksum):
+    """Cache the noise level in ``metadata``, along with the settings and pixels it was computed from"""
+    metadata.set(SIGMA1_KEY, float(sigma1))
+    metadata.set(SIGMA1_MASK_KEY, int(andMask))
+    metadata.set(SIGMA1_SUBSAMPLE_KEY, int(subsample))
+    metadata.set(SIGMA1_CHECKSUM_KEY, _formatChecksum(checksum))
+
+
+def getSigma1(exposure, maskPlanes, subsample=1, useCache=False, log=None):
+    """Noise level of an exposure, computed once and cached in its metadata
+
+    Parameters
+    ----------
+    exposure: `afw.image.ExposureF`
+        Exposure to estimate the noise of.
+    maskPlanes: list of `str`
+        Pixels with any of these mask planes set are ignored.
+    subsample: `int`, optional
+        Only use every ``subsample`` pixel in each direction.
+    useCache: `bool`, optional
+        If True, reuse the value cached in the exposure metadata (if it was computed with the
+        same mask planes and subsampling, from the same variance and mask pixels) and cache the
+        new value otherwise.  The cache is written to the exposure metadata, and so to the header
+        of the exposure if it is written afterwards.
+    log: `lsst.log.Log`, optional
+        Logger used to report whether the cached value was used.
+
+    Returns
+    -------
+    sigma1: `float`
+    """
+    maskedImage = exposure.getMaskedImage()
+    andMask = maskedImage.getMask().getPlaneBitMask(maskPlanes)
+    if not useCache:
+        return estimateSigma1(maskedImage, maskPlanes, subsample)
+    metadata = exposure.getMetadata()
+    checksum = getPlanesChecksum(maskedImage)
+    sigma1 = getCachedSigma1(metadata, andMask, subsample, checksum)
+    if sigma1 is not None:
+        if log is not None:
+            log.trace('Using cached sigma1: %g', sigma1)
+        return sigma1
+    sigma1 = estimateSigma1(maskedImage, maskPlanes, subsample)
+    setCachedSigma1(metadata, sigma1, andMask, subsample, checksum)
+    return sigma1
+
+
+def _getBinnedSigmas(maskedImage, maskPlanes, binSize):
+    """Noise level of each ``binSize`` x ``binSize`` bin of an image, NaN in bins without unmasked pixels"""
+    andMask = maskedImage.getMask().getPlaneBitMask(maskPlanes)
+    variance = maskedImage.getVariance().getArray()
+    mask = maskedImage.getMask().getArray()
+    height, width = variance.shape
+    ny = (height + binSize - 1)//binSize
+    nx = (width + binSize - 1)//binSize
+    padded = np.empty((ny*binSize, nx*binSize), dtype=np.float32)
+    padded[:] = np.nan
+    padded[:height, :width] = variance
+    padded[:height, :width][(mask & andMask) != 0] = np.nan
+    bins = padded.reshape(ny, binSize, nx, binSize).transpose(0, 2, 1, 3).reshape(ny, nx, -1)
+    with warnings.catch_warnings():
+        # bins without unmasked pixels are filled by NoiseMap
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.sqrt(np.nanmedian(bins, axis=-1))
+
+
+class NoiseMap(object):
+    """Low resolution map of the noise level of an image
+
+    The image is divided in ``binSize`` x ``binSize`` bins, and the noise level of each bin is the
+    square root of the median of its unmasked variance pixels.  Bins without any unmasked pixel
+    get the median noise level of the other bins.  The local noise level of a parent is then
+    looked up in constant time, which on images with a strongly varying depth (e.g. coadds)
+    gives better thresholds than a single ``sigma1`` for the whole image.
+    """
+
+    def __init__(self, maskedImage, maskPlanes, binSize=256):
+        """Compute the noise map
+
+        Parameters
+        ----------
+        maskedImage: `afw.image.MaskedImageF`
+            Image to estimate the noise of.
+        maskPlanes: list of `str`
+            Pixels with any of these mask planes set are ignored.
+        binSize: `int`, optional
+            Size of the bins, in pixels.
+        """
+        self._setSigmas(maskedImage.getBBox(), binSize, _getBinnedSigmas(maskedImage, maskPlanes, binSize))
+
+    @classmethod
+    def fromStrips(cls, bbox, readStrip, maskPlanes, binSize=256):
+        """Compute the noise map of an image that is read one row of bins at a time
+
+        The result is the same as the map computed on the full image, but only a strip of
+        ``binSize`` rows of the image is in memory at once.
+
+        Parameters
+        ----------
+        bbox: `afw.geom.Box2I`
+            Bounding box of the full image.
+        readStrip: callable
+            Function returning the `afw.image.MaskedImageF` of the image in a bounding box
+            (in PARENT coordinates).
+        maskPlanes: list of `str`
+            Pixels with any of these mask planes set are ignored.
+        binSize: `int`, optional
+            Size of the bins, in pixels.
+
+        Returns
+        -------
+        noiseMap: `NoiseMap`
+        """
+        rows = []
+        for y in range(bbox.getMinY(), bbox.getMaxY() + 1, binSize):
+            strip = afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), y),
+                                  afwGeom.Extent2I(bbox.getWidth(), min(binSize, bbox.getMaxY() + 1 - y)))
+            rows.append(_getBinnedSigmas(readStrip(strip), maskPlanes, binSize))
+        noiseMap = cls.__new__(cls)
+        noiseMap._setSigmas(bbox, binSize, np.concatenate(rows))
+        return noiseMap
+
+    def _setSigmas(self, bbox, binSize, sigmas):
+        """Set the noise level of each bin, filling the bins without unmasked pixels"""
+        self.binSize = binSize
+        self.bbox = bbox
+        empty = ~np.isfinite(sigmas)
+        if np.all(empty):
+            sigmas[:] = np.nan
+        elif np.any(empty):
+            sigmas[empty] = np.median(sigmas[~empty])
+        self.sigmas = sigmas
+
+    def getSigma(self, x, y):
+        """Noise level at pixel ``(x, y)``, in PARENT coordinates"""
+        ix = int(x - self.bbox.getMinX())//self.binSize
+        iy = int(y - self.bbox.getMinY())//self.binSize
+        ix = min(max(ix, 0), self.sigmas.shape[1] - 1)
+        iy = min(max(iy, 0), self.sigmas.shape[0] - 1)
+        return float(self.sigmas[iy, ix])
+
+    def getSigmaForBBox(self, bbox):
+        """Noise level at the center of ``bbox`` (e.g. the bounding box of a parent footprint)"""
+        return self.getSigma((bbox.getMinX() + bbox.getMaxX())//2, (bbox.getMinY() + bbox.getMaxY())//2)
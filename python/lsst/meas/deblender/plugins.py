@@ -31,6 +31,7 @@ from lsst.afw.image import PARENT
 
 # Import C++ routines
 from .baselineUtils import BaselineUtilsF as butils
+from .tiling import getRampPadding
 
 
 def clipFootprintToNonzeroImpl(foot, image):
@@ -150,9 +151,149 @@ def _setPeakError(debResult, log, pk, cx, cy, filters, msg, flag):
         pkResult = debResult.deblendedParents[f].peaks[pk]
         getattr(pkResult, flag)()
 
+def _getMultibandDataCube(debResult, useWeights, badMask):
+    """Build the data and weight cubes of a parent for scarlet
+
+    The cubes are contiguous float32 arrays with shape (bands, height, width) over the parent
+    footprint's bounding box, filled directly from the pixels of each band (the masked images
+    are only sub-imaged when they are larger than the bounding box, and then as views).
+    The weights are zero for pixels outside the footprint or with any of the ``badMask``
+    planes set. The cubes are cached in ``debResult``.
+
+    Parameters
+    ----------
+    debResult: `lsst.meas.deblender.baseline.DeblenderResult`
+        Container for the deblender results.
+    useWeights: bool
+        Whether or not to use the inverse variance as the weights.
+    badMask: list of str
+        Names of the mask planes of bad pixels.
+
+    Returns
+    -------
+    data: `numpy.ndarray`
+        Image cube.
+    weights: `numpy.ndarray`
+        Weight cube.
+    """
+    key = (useWeights, tuple(badMask))
+    cached = getattr(debResult, "_dataCube", None)
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+
+    bbox = debResult.footprint.getBBox()
+    shape = (len(debResult.maskedImages), bbox.getHeight(), bbox.getWidth())
+    data = np.empty(shape, dtype=np.float32)
+    weights = np.empty(shape, dtype=np.float32)
+
+    # Pixels outside of the footprint
+    fpMask = afwImage.Mask(bbox)
+    debResult.footprint.spans.setMask(fpMask, 1)
+    outside = fpMask.getArray() == 0
+
+    for fidx, mimg in enumerate(debResult.maskedImages):
+        if mimg.getBBox() != bbox:
+            mimg = mimg.Factory(mimg, bbox, PARENT)
+        data[fidx] = mimg.image.array
+        if useWeights:
+            np.divide(1, mimg.variance.array, out=weights[fidx])
+        else:
+            weights[fidx] = 1
+        badPixels = mimg.mask.getPlaneBitMask(badMask)
+        bad = (mimg.mask.array & badPixels) != 0
+        bad |= outside
+        weights[fidx][bad] = 0
+
+    debResult._dataCube = (key, data, weights)
+    return data, weights
+
+
+def _relativeChange(new, old):
+    """Norm of the change from ``old`` to ``new``, relative to the norm of ``old``
+
+    Returns `numpy.inf` if the shape of the array changed (e.g. a resized source box).
+    """
+    new = np.asarray(new)
+    if new.shape != old.shape:
+        return np.inf
+    norm = np.sqrt(np.sum(old**2))
+    if norm == 0:
+        return 0. if not np.any(new) else np.inf
+    return np.sqrt(np.sum((new - old)**2))/norm
+
+
+def _freezeSource(src):
+    """Fix the SED and morphology of every component of a scarlet source"""
+    for attr in ("fix_sed", "fix_morph"):
+        fixed = np.array(getattr(src, attr), dtype=bool, copy=True)
+        fixed[...] = True
+        setattr(src, attr, fixed)
+
+
+def _fitPerSource(blend, steps, e_rel, sourceRelativeError, checkInterval):
+    """Fit a blend, freezing each source once it has converged
+
+    The blend is fit ``checkInterval`` iterations at a time. After each of these
+    fits, the sources whose SED and morphology changed by less than
+    ``sourceRelativeError`` are fixed, so that the following iterations only
+    update the sources that have not converged yet (in large blends usually a few
+    bright or extended sources, while most of the faint ones converge early).
+    The fit stops once scarlet reports that the whole blend has converged to
+    ``e_rel``, or stopped before the end of the ``checkInterval`` iterations.
+
+    Parameters
+    ----------
+    blend: `scarlet.blend.Blend`
+        Blend to fit.
+    steps: int
+        Maximum number of iterations.
+    e_rel: float
+        Relative error passed to `scarlet.blend.Blend.fit`.
+    sourceRelativeError: float
+        Relative change of the SED and morphology of a source below which
+        it is no longer updated.
+    checkInterval: int
+        Number of iterations between two checks of the convergence of each source.
+
+    Returns
+    -------
+    iterations: `numpy.ndarray`
+        Number of iterations in which each source was updated.
+    """
+    sources = blend.sources
+    iterations = np.zeros(len(sources), dtype=np.int32)
+    active = np.ones(len(sources), dtype=bool)
+    checkInterval = max(checkInterval, 1)
+    it = 0
+    converged = False
+    while it < steps and np.any(active) and not converged:
+        nIter = min(checkInterval, steps - it)
+        previous = [(np.array(src.sed, copy=True), np.array(src.morph, copy=True)) if active[m] else None
+                    for m, src in enumerate(sources)]
+        start = getattr(blend, "it", 0)
+        blend.fit(steps=nIter, e_rel=e_rel)
+        # `Blend.fit` stops early once the blend has converged to e_rel, so count the
+        # iterations it actually ran (`Blend.it` is the total number of iterations)
+        nRun = getattr(blend, "it", start + nIter) - start
+        converged = nRun < nIter or bool(np.all(getattr(blend, "converged", False)))
+        it += nRun
+        iterations[active] += nRun
+        for m, src in enumerate(sources):
+            if not active[m]:
+                continue
+            sed, morph = previous[m]
+            if (_relativeChange(src.sed, sed) < sourceRelativeError and
+                    _relativeChange(src.morph, morph) < sourceRelativeError):
+                _freezeSource(src)
+                active[m] = False
+    return iterations
+
+
 def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
                             sources=None, constraints=None, config=None, maxIter=100, bgScale=0.5,
-                            relativeError=1e-2, badMask=None):
+                            relativeError=1e-2, badMask=None, warmStart=None, warmStartMaxIter=None,
+                            warmStartRelativeError=None, psfCache=None, perSourceConvergence=False,
+                            sourceRelativeError=1e-3, convergenceCheckInterval=10):
     """Run the Multiband Deblender to build templates
 
     Parameters
@@ -165,8 +306,8 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
         Whether or not to use the variance map in each filter for the fit.
     usePsf: bool, default=False
         Whether or not to convolve the image with the PSF in each band.
-        This is not yet implemented in an optimized algorithm, so it is recommended
-        to leave this term off for now
+        The convolution itself is not yet optimized, but the PSF kernels can be
+        shared between parents with `psfCache`
     sources: list of `scarlet.source.Source` objects, default=None
         List of sources to use in the blend. By default the
         `scarlet.source.ExtendedSource` class is used, which initializes each
@@ -188,6 +329,29 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
         List of mask plane names to mark bad pixels.
         If `badPixelKeys` is `None`, the default keywords used are
         `["BAD", "CR", "NO_DATA", "SAT", "SUSPECT"]`.
+    warmStart: `lsst.meas.deblender.warmStart.ScarletWarmStart`, default=None
+        Store of converged models. If it contains a model of this parent (with the same
+        peaks and shapes) the sources are initialized from it, and the converged sources
+        are saved to it after the fit. Only used when `sources` is `None`.
+    warmStartMaxIter: int, default=None
+        Maximum iterations for a blend initialized from `warmStart`.
+        If `None`, `maxIter` is used.
+    warmStartRelativeError: float, default=None
+        Relative error to reach for convergence of a blend initialized from `warmStart`.
+        If `None`, `relativeError` is used.
+    psfCache: `lsst.meas.deblender.baseline.CachingPsfKernels`, default=None
+        Cache of the PSF kernels, shared between parents. If `None` the kernels are
+        computed for this parent only, at the average position of each PSF.
+    perSourceConvergence: bool, default=False
+        Whether or not to stop updating each source once it has converged
+        (see `_fitPerSource`), instead of updating all of the sources until the
+        whole blend has converged.
+    sourceRelativeError: float, default=1e-3
+        Relative change of the SED and morphology of a source below which it is
+        no longer updated, if `perSourceConvergence` is `True`.
+    convergenceCheckInterval: int, default=10
+        Number of iterations between two checks of the convergence of each source,
+        if `perSourceConvergence` is `True`.
 
     Returns
     -------
@@ -196,6 +360,7 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
         otherwise it is ``False`` (meaning all of the peaks were skipped).
     """
     import scarlet
+    from .warmStart import getBlendKey
 
     # Extract coordinates from each MultiColorPeak
     bbox = debResult.footprint.getBBox()
@@ -204,36 +369,17 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
     ymin = bbox.getMinY()
     peaks = [[pk.y-ymin, pk.x-xmin] for pk in debResult.peaks]
 
-    # Create the data array from the masked images
-    maskedImages = [mimg.Factory(mimg, debResult.footprint.getBBox(), PARENT)
-                    for mimg in debResult.maskedImages]
-    data = np.array([mimg.image.array for mimg in maskedImages])
-
-    # Use the inverse variance as the weights
-    if useWeights:
-        weights = 1/np.array([mimg.variance.array for mimg in maskedImages])
-    else:
-        weights = weights = np.ones_like(data)
-
-    # Use the mask plane to mask bad pixels and
-    # the footprint to mask out pixels outside the footprint
+    # Create the data cube, weights and bad pixel mask
     if badMask is None:
         badMask = ["BAD", "CR", "NO_DATA", "SAT", "SUSPECT"]
-    fpMask = afwImage.Mask(bbox)
-    debResult.footprint.spans.setMask(fpMask, 1)
-    fpMask = ~fpMask.getArray().astype(bool)
-    mask = np.zeros(weights.shape, dtype=bool)
-    for fidx, mimg in enumerate(maskedImages):
-        badPixels = mimg.mask.getPlaneBitMask(badMask)
-        mask[fidx] = (mimg.getMask().array & badPixels) | fpMask
-    weights[mask] = 0
+    data, weights = _getMultibandDataCube(debResult, useWeights, badMask)
 
     # Extract the PSF from each band for PSF convolution
     if usePsf:
-        psfs = []
-        for psf in debResult.psfs:
-            psfs.append(psf.computeKernelImage().array)
-        psf = np.array(psfs)
+        if psfCache is None:
+            from .baseline import CachingPsfKernels
+            psfCache = CachingPsfKernels()
+        psf = psfCache.getKernels(debResult.psfs, afwGeom.Box2D(bbox).getCenter())
     else:
         psf = None
 
@@ -258,18 +404,39 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
                                           config=config)
             for pk,peak in enumerate(peaks)
         ]
+    else:
+        warmStart = None
+
+    steps = maxIter
+    e_rel = relativeError
+    debResult.warmStarted = False
+    if warmStart is not None:
+        blendKey = getBlendKey(debResult.footprint)
+        if warmStart.apply(sources, warmStart.get(blendKey)):
+            debResult.warmStarted = True
+            if warmStartMaxIter is not None:
+                steps = warmStartMaxIter
+            if warmStartRelativeError is not None:
+                e_rel = warmStartRelativeError
+            log.trace("Initialized the sources from a saved model")
 
     # When a footprint includes only non-detections
     # (peaks in the noise too low to deblend as a source)
     # the deblender currently fails.
     try:
         blend = scarlet.blend.Blend(sources=sources, img=data, weights=weights, bg_rms=bg_rms, config=config)
-        blend.fit(steps=maxIter, e_rel=relativeError)
+        if perSourceConvergence:
+            iterations = _fitPerSource(blend, steps, e_rel, sourceRelativeError, convergenceCheckInterval)
+        else:
+            blend.fit(steps=steps, e_rel=e_rel)
+            iterations = None
     except np.linalg.LinAlgError as e:
         log.warn("Deblend failed catastrophically, most likely due to no signal in the footprint")
         debResult.failed = True
         return False
     debResult.blend = blend
+    if warmStart is not None:
+        warmStart.set(blendKey, blend.sources)
 
     modified = False
     # Create the Templates for each peak in each filter
@@ -277,6 +444,9 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
         _cx = src.Nx >> 1
         _cy = src.Ny >> 1
 
+        if iterations is not None:
+            for f in debResult.filters:
+                debResult.deblendedParents[f].peaks[pk].scarletIterations = int(iterations[pk])
         if debResult.peaks[pk].skip:
             continue
         modified = True
@@ -330,7 +500,8 @@ def buildMultibandTemplates(debResult, log, useWeights=False, usePsf=False,
             pkResult.peak.setIy(int(np.round(cy)))
     return modified
 
-def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.5, tinyFootprintSize=2):
+def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.5, tinyFootprintSize=2,
+            stencilQuantum=0.):
     """Fit a PSF + smooth background model (linear) to a small region around each peak
 
     This function will iterate over all filters in deblender result but does not compare
@@ -365,6 +536,10 @@ def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.
         If the bbox of the clipped PSF model for a peak is smaller than ``max(tinyFootprintSize,2)``
         then ``tinyFootprint`` for the peak is set to ``True`` and the peak is not fit.
         The default is 2.
+    stencilQuantum: `float`, optional
+        If positive, sub-pixel peak offsets are rounded to a multiple of ``stencilQuantum``
+        when looking up the cached radius and ramp-weight stencils.
+        The default is 0, which uses the exact offset of each peak.
 
     Returns
     -------
@@ -372,13 +547,14 @@ def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.
         If any templates have been assigned to PSF point sources then ``modified`` is ``True``,
         otherwise it is ``False``.
     """
-    from .baseline import CachingPsf
+    from .baseline import CachingPsf, CachingFitStencil
     modified = False
     # Loop over all of the filters to build the PSF
     for fidx in debResult.filters:
         dp = debResult.deblendedParents[fidx]
         peaks = dp.fp.getPeaks()
         cpsf = CachingPsf(dp.psf)
+        stencils = CachingFitStencil(stencilQuantum)
 
         # create mask image for pixels within the footprint
         fmask = afwImage.Mask(dp.bb)
@@ -393,13 +569,14 @@ def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.
         for pki, (pk, pkres, pkF) in enumerate(zip(peaks, dp.peaks, peakF)):
             log.trace('Filter %s, Peak %i', fidx, pki)
             ispsf = _fitPsf(dp.fp, fmask, pk, pkF, pkres, dp.bb, peaks, peakF, log, cpsf, dp.psffwhm,
-                            dp.img, dp.varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b, tinyFootprintSize)
+                            dp.img, dp.varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b, tinyFootprintSize,
+                            stencils)
             modified = modified or ispsf
     return modified
 
 def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
             img, varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b,
-            tinyFootprintSize=2,
+            tinyFootprintSize=2, stencils=None,
             ):
     """Fit a PSF + smooth background model (linear) to a small region around a peak.
 
@@ -431,6 +608,9 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         The image that contains the footprint.
     varimg: `afw.image.ImageF`
         The variance of the image that contains the footprint.
+    stencils: `meas.deblender.baseline.CachingFitStencil`, optional
+        Cache of the radius and ramp-weight stencils, shared by all of the peaks in a band.
+        If ``None`` a new cache is created for this peak.
 
     Results
     -------
@@ -438,6 +618,10 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         Whether or not the peak matches a PSF model.
     """
     import lsstDebug
+    from .baseline import CachingFitStencil
+
+    if stencils is None:
+        stencils = CachingFitStencil()
 
     # my __name__ is lsst.meas.deblender.baseline
     debugPlots = lsstDebug.Info(__name__).plots
@@ -463,11 +647,12 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         pkres.setOutOfBounds()
         return
 
-    # The bounding-box of the local region we are going to fit ("stamp")
-    xlo = int(np.floor(cx - R1))
-    ylo = int(np.floor(cy - R1))
-    xhi = int(np.ceil(cx + R1))
-    yhi = int(np.ceil(cy + R1))
+    # The bounding-box of the local region we are going to fit ("stamp"),
+    # along with the radius and ramp-weight stencils for that region.
+    sxlo, sylo, sRR, srw, sdisk = stencils.getStencil(R0, R1, cx, cy)
+    xlo, ylo = sxlo, sylo
+    xhi = sxlo + sRR.shape[1] - 1
+    yhi = sylo + sRR.shape[0] - 1
     stampbb = afwGeom.Box2I(afwGeom.Point2I(xlo, ylo), afwGeom.Point2I(xhi, yhi))
     stampbb.clip(fbb)
     xlo, xhi = stampbb.getMinX(), stampbb.getMaxX()
@@ -532,11 +717,14 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     px0, px1 = pbb.getMinX(), pbb.getMaxX()
     py0, py1 = pbb.getMinY(), pbb.getMaxY()
 
+    # Slice the stencils down to the clipped stamp
+    sslice = (slice(ylo-sylo, yhi-sylo+1), slice(xlo-sxlo, xhi-sxlo+1))
+    rw = srw[sslice]
+
     # Compute the "valid" pixels within our region-of-interest
     valid = (fmask_sub > 0)
     xx, yy = np.arange(xlo, xhi+1), np.arange(ylo, yhi+1)
-    RR = ((xx - cx)**2)[np.newaxis, :] + ((yy - cy)**2)[:, np.newaxis]
-    valid *= (RR <= R1**2)
+    valid *= sdisk[sslice]
     valid *= (var_sub > 0)
     NP = valid.sum()
 
@@ -545,9 +733,9 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         pkres.setNoValidPixels()
         return
 
-    # pixel coords of valid pixels
-    XX, YY = np.meshgrid(xx, yy)
-    ipixes = np.vstack((XX[valid] - xlo, YY[valid] - ylo)).T
+    # pixel coords of valid pixels (stamp-relative)
+    iy, ix = np.nonzero(valid)
+    ipixes = np.vstack((ix, iy)).T
 
     inpsfx = (xx >= px0)*(xx <= px1)
     inpsfy = (yy >= py0)*(yy <= py1)
@@ -621,19 +809,12 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
 
     b = img_sub[valid]
 
-    # Weights -- from ramp and image variance map.
-    # Ramp weights -- from 1 at R0 down to 0 at R1.
-    rw = np.ones_like(RR)
-    ii = (RR > R0**2)
-    rr = np.sqrt(RR[ii])
-    rw[ii] = np.maximum(0, 1. - ((rr - R0)/(R1 - R0)))
+    # Weights -- from ramp (precomputed in the stencil) and image variance map.
     w = np.sqrt(rw[valid]/var_sub[valid])
     # save the effective number of pixels
     sumr = np.sum(rw[valid])
     log.debug('sumr = %g', sumr)
 
-    del ii
-
     Aw = A*w[:, np.newaxis]
     bw = b*w
 
@@ -952,6 +1133,8 @@ def rampFluxAtEdge(debResult, log, patchEdges=False):
         dp = debResult.deblendedParents[fidx]
         log.trace('Checking for significant flux at edge: sigma1=%g', dp.avgNoise)
 
+        # Shared by all of the ramped templates of this parent
+        rampedParent = None
         for peaki, pkres in enumerate(dp.peaks):
             if pkres.skip or pkres.deblendedAsPsf:
                 continue
@@ -959,10 +1142,14 @@ def rampFluxAtEdge(debResult, log, patchEdges=False):
             if butils.hasSignificantFluxAtEdge(timg, tfoot, 3*dp.avgNoise):
                 log.trace("Template %i has significant flux at edge: ramping", pkres.pki)
                 try:
+                    if rampedParent is None:
+                        rampedParent = _RampedParent(dp.psffwhm, dp.fp, dp.maskedImage, dp.x0, dp.x1,
+                                                     dp.y0, dp.y1, dp.psf)
                     (timg2, tfoot2, patched) = _handle_flux_at_edge(log, dp.psffwhm, timg, tfoot, dp.fp,
                                                                     dp.maskedImage, dp.x0, dp.x1,
                                                                     dp.y0, dp.y1, dp.psf, pkres.peak,
-                                                                    dp.avgNoise, patchEdges)
+                                                                    dp.avgNoise, patchEdges,
+                                                                    rampedParent=rampedParent)
                 except lsst.pex.exceptions.Exception as exc:
                     if (isinstance(exc, lsst.pex.exceptions.InvalidParameterError)
                             and "CoaddPsf" in str(exc)):
@@ -976,8 +1163,124 @@ def rampFluxAtEdge(debResult, log, patchEdges=False):
                 modified = True
     return modified
 
+def _getSpanPixels(spans):
+    """Coordinates of all of the pixels of a `SpanSet`
+
+    Returns
+    -------
+    ys, xs: `numpy.ndarray`
+        y and x coordinates of the pixels, in PARENT coordinates.
+    """
+    spans = list(spans)
+    if len(spans) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    ys = np.concatenate([np.full(span.getX1() - span.getX0() + 1, span.getY(), dtype=int)
+                         for span in spans])
+    xs = np.concatenate([np.arange(span.getX0(), span.getX1() + 1) for span in spans])
+    return ys, xs
+
+def _rampEdgePixels(template, edgeSpans, psfArray, px0, py0, ramped):
+    """Spread the edge pixels of a template with the PSF
+
+    For each edge pixel, ``ramped = max(ramped, template[edge pixel] * PSF)``, with the PSF
+    centered on the edge pixel: a grayscale dilation of the edge pixels with the (normalized)
+    PSF. It is computed with one vectorized operation over all of the edge pixels for each
+    PSF pixel, rather than one operation per edge pixel.
+
+    Parameters
+    ----------
+    template: `afw.image.ImageF`
+        Template containing the edge pixels.
+    edgeSpans: `afw.geom.SpanSet`
+        Edge pixels.
+    psfArray: `numpy.ndarray`
+        PSF image, normalized to a maximum of 1.
+    px0, py0: `int`
+        Offset of the first pixel of ``psfArray`` from its center.
+    ramped: `afw.image.ImageF`
+        Image updated in place; it must contain the edge pixels grown by the PSF.
+    """
+    ys, xs = _getSpanPixels(edgeSpans)
+    if len(ys) == 0:
+        return
+    values = template.getArray()[ys - template.getY0(), xs - template.getX0()]
+    ys = ys + py0 - ramped.getY0()
+    xs = xs + px0 - ramped.getX0()
+    Tout = ramped.getArray()
+    ph, pw = psfArray.shape
+    for dy in range(ph):
+        for dx in range(pw):
+            # Each edge pixel is shifted to a different pixel, so there are no repeated indices
+            idx = (ys + dy, xs + dx)
+            Tout[idx] = np.maximum(Tout[idx], values*psfArray[dy, dx])
+
+class _RampedParent(object):
+    """Inputs of `_handle_flux_at_edge` that only depend on the parent
+
+    The parent footprint dilated by the ramp size ``S``, the image under it and the PSF image
+    at the center of the parent are the same for every ramped template of a parent (in a
+    single band), so they are computed once and shared.
+
+    Attributes
+    ----------
+    S: `int`
+        Number of pixels the templates are grown by.
+    spans: `afw.geom.SpanSet`
+        Parent footprint dilated by ``S``.
+    psfArray: `numpy.ndarray`
+        PSF image, clipped to ``S`` and normalized to a maximum of 1.
+    px0, py0: `int`
+        Offset of the first pixel of ``psfArray`` from its center.
+    """
+
+    def __init__(self, psffwhm, fp, maskedImage, x0, x1, y0, y1, psf):
+        # The size we'll grow by
+        S = getRampPadding(psffwhm)
+        self.S = S
+
+        self.spans = fp.spans.dilated(S)
+        # Image under the dilated footprint, zero elsewhere
+        self.padded = maskedImage.Factory(self.spans.getBBox())
+        self.spans.clippedTo(maskedImage.getBBox()).copyMaskedImage(maskedImage, self.padded)
+
+        # instantiate PSF image
+        xc = int((x0 + x1)/2)
+        yc = int((y0 + y1)/2)
+        psfim = psf.computeImage(afwGeom.Point2D(xc, yc))
+        pbb = psfim.getBBox()
+        # shift PSF image to be centered on zero
+        lx, ly = pbb.getMinX(), pbb.getMinY()
+        psfim.setXY0(lx - xc, ly - yc)
+        pbb = psfim.getBBox()
+        # clip PSF to S, if necessary
+        Sbox = afwGeom.Box2I(afwGeom.Point2I(-S, -S), afwGeom.Extent2I(2*S+1, 2*S+1))
+        if not Sbox.contains(pbb):
+            # clip PSF image
+            psfim = psfim.Factory(psfim, Sbox, afwImage.PARENT, True)
+            pbb = psfim.getBBox()
+        self.px0 = pbb.getMinX()
+        self.py0 = pbb.getMinY()
+        self.psfArray = psfim.getArray()
+        self.psfArray /= self.psfArray.max()
+
+    def getPaddedImage(self, bbox):
+        """New masked image over ``bbox`` with the pixels of the dilated parent footprint
+
+        Pixels outside of the dilated footprint (or of the image) are zero.
+        """
+        padim = self.padded.Factory(bbox)
+        overlap = afwGeom.Box2I(bbox)
+        overlap.clip(self.padded.getBBox())
+        if not overlap.isEmpty():
+            dest = _getSlices(overlap, bbox)
+            src = _getSlices(overlap, self.padded.getBBox())
+            padim.getImage().getArray()[dest] = self.padded.getImage().getArray()[src]
+            padim.getMask().getArray()[dest] = self.padded.getMask().getArray()[src]
+            padim.getVariance().getArray()[dest] = self.padded.getVariance().getArray()[src]
+        return padim
+
 def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
-                         x0, x1, y0, y1, psf, pk, sigma1, patchEdges
+                         x0, x1, y0, y1, psf, pk, sigma1, patchEdges, rampedParent=None
     ):
     """Extend a template by the PSF to fill in the footprint.
 
@@ -1013,6 +1316,9 @@ def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
         ``EDGE`` bit set, then for spans whose symmetric mirror are outside the
         image, the symmetric footprint is grown to include them and their
         pixel values are stored.
+    rampedParent: `_RampedParent`, optional
+        Dilated parent footprint, padded image and PSF image shared by all of the
+        ramped templates of the parent. If `None` they are computed for this template.
 
     Results
     -------
@@ -1031,61 +1337,25 @@ def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
     # Ie, extend the template by the PSF and "fill in" the footprint.
     # Then find the symmetric template of that image.
 
-    # The size we'll grow by
-    S = psffwhm*1.5
-    # make it an odd integer
-    S = int((S + 0.5)/2)*2 + 1
+    if rampedParent is None:
+        rampedParent = _RampedParent(psffwhm, fp, maskedImage, x0, x1, y0, y1, psf)
+    S = rampedParent.S
 
     tbb = tfoot.getBBox()
     tbb.grow(S)
 
     # (footprint+margin)-clipped image;
     # we need the pixels OUTSIDE the footprint to be 0.
-    fpcopy = afwDet.Footprint(fp)
-    fpcopy.dilate(S)
-    fpcopy.setSpans(fpcopy.spans.clippedTo(tbb))
-    fpcopy.removeOrphanPeaks()
-    padim = maskedImage.Factory(tbb)
-    fpcopy.spans.clippedTo(maskedImage.getBBox()).copyMaskedImage(maskedImage, padim)
+    fpcopy = afwDet.Footprint(rampedParent.spans.clippedTo(tbb))
+    padim = rampedParent.getPaddedImage(tbb)
 
     # find pixels on the edge of the template
     edgepix = butils.getSignificantEdgePixels(t1, tfoot, -1e6)
 
-    # instantiate PSF image
-    xc = int((x0 + x1)/2)
-    yc = int((y0 + y1)/2)
-    psfim = psf.computeImage(afwGeom.Point2D(xc, yc))
-    pbb = psfim.getBBox()
-    # shift PSF image to be centered on zero
-    lx, ly = pbb.getMinX(), pbb.getMinY()
-    psfim.setXY0(lx - xc, ly - yc)
-    pbb = psfim.getBBox()
-    # clip PSF to S, if necessary
-    Sbox = afwGeom.Box2I(afwGeom.Point2I(-S, -S), afwGeom.Extent2I(2*S+1, 2*S+1))
-    if not Sbox.contains(pbb):
-        # clip PSF image
-        psfim = psfim.Factory(psfim, Sbox, afwImage.PARENT, True)
-        pbb = psfim.getBBox()
-    px0 = pbb.getMinX()
-    px1 = pbb.getMaxX()
-    py0 = pbb.getMinY()
-    py1 = pbb.getMaxY()
-
     # Compute the ramped-down edge pixels
     ramped = t1.Factory(tbb)
-    Tout = ramped.getArray()
-    Tin = t1.getArray()
-    tx0, ty0 = t1.getX0(), t1.getY0()
-    ox0, oy0 = ramped.getX0(), ramped.getY0()
-    P = psfim.getArray()
-    P /= P.max()
-    # For each edge pixel, Tout = max(Tout, edgepix * PSF)
-    for span in edgepix.getSpans():
-        y = span.getY()
-        for x in range(span.getX0(), span.getX1()+1):
-            slc = (slice(y+py0 - oy0, y+py1+1 - oy0),
-                   slice(x+px0 - ox0, x+px1+1 - ox0))
-            Tout[slc] = np.maximum(Tout[slc], Tin[y-ty0, x-tx0]*P)
+    _rampEdgePixels(t1, edgepix.getSpans(), rampedParent.psfArray, rampedParent.px0, rampedParent.py0,
+                    ramped)
 
     # Fill in the "padim" (which has the right variance and
     # mask planes) with the ramped pixels, outside the footprint
@@ -1244,19 +1514,122 @@ def weightTemplates(debResult, log):
         _weightTemplates(debResult.deblendedParents[fidx])
     return False
 
-def _weightTemplates(dp):
-    """Weight the templates to best match the parent Footprint in a single filter
+def _getSlices(bbox, origin):
+    """Slices of the pixels of ``bbox`` in an array covering the box ``origin``"""
+    x0, y0 = origin.getMinX(), origin.getMinY()
+    return (slice(bbox.getMinY() - y0, bbox.getMaxY() + 1 - y0),
+            slice(bbox.getMinX() - x0, bbox.getMaxX() + 1 - x0))
 
-    This includes weighting both regular templates and point source templates
+def _getFootprintTemplates(dp, restrictToParent=True):
+    """Pixels of the templates of the children of a parent
 
-    Parameter
-    ---------
+    Each template is only stored over its own bounding box, so the memory used scales with the
+    sum of the template areas rather than with the parent bounding box times the number of children.
+
+    Parameters
+    ----------
     dp: `DeblendedParent`
-        The deblended parent to re-weight
+        The deblended parent.
+    restrictToParent: `bool`, optional
+        If ``True`` the templates are restricted to the parent footprint (as used to fit the
+        templates to the image), otherwise each template is restricted to its own template
+        footprint (as its ``HeavyFootprint`` would be).
 
     Returns
     -------
-    None
+    templates: list of (`afw.geom.Box2I`, `numpy.ndarray`)
+        For each child that is not skipped, the bounding box of its template (clipped to the
+        parent's if ``restrictToParent``) and the float64 template pixels in that box, set to
+        zero outside of the footprint. The pixels are `None` for an empty template.
+    """
+    if restrictToParent:
+        fpMask = afwImage.Mask(dp.bb)
+        dp.fp.spans.setMask(fpMask, 1)
+        inside = fpMask.getArray() != 0
+    templates = []
+    for pkres in dp.peaks:
+        if pkres.skip:
+            continue
+        bbox = afwGeom.Box2I(pkres.templateImage.getBBox())
+        if restrictToParent:
+            bbox.clip(dp.bb)
+        if bbox.isEmpty():
+            templates.append((bbox, None))
+            continue
+        timg = pkres.templateImage.Factory(pkres.templateImage, bbox, PARENT)
+        values = timg.getArray().astype(np.float64)
+        if restrictToParent:
+            values *= inside[_getSlices(bbox, dp.bb)]
+        else:
+            tMask = afwImage.Mask(bbox)
+            pkres.templateFootprint.spans.clippedTo(bbox).setMask(tMask, 1)
+            values *= tMask.getArray() != 0
+        templates.append((bbox, values))
+    return templates
+
+def _templateDot(template1, template2):
+    """Dot product of two templates returned by `_getFootprintTemplates`"""
+    bbox = afwGeom.Box2I(template1[0])
+    bbox.clip(template2[0])
+    if bbox.isEmpty():
+        return 0.
+    return np.vdot(template1[1][_getSlices(bbox, template1[0])],
+                   template2[1][_getSlices(bbox, template2[0])])
+
+def _getTemplateGram(templates):
+    """Matrix of the dot products between all pairs of templates
+
+    Only the pairs of templates whose bounding boxes overlap are multiplied (the others are
+    zero). They are found by sweeping over the templates sorted by their minimum x, keeping
+    the templates whose x range still overlaps the current one.
+
+    Parameters
+    ----------
+    templates: list of (`afw.geom.Box2I`, `numpy.ndarray`)
+        Templates returned by `_getFootprintTemplates`.
+
+    Returns
+    -------
+    gram: `numpy.ndarray`
+        Symmetric ``(len(templates), len(templates))`` matrix.
+    """
+    nchild = len(templates)
+    gram = np.zeros((nchild, nchild))
+    order = sorted((i for i in range(nchild) if templates[i][1] is not None),
+                   key=lambda i: templates[i][0].getMinX())
+    active = []
+    for i in order:
+        bbox, values = templates[i]
+        gram[i, i] = np.vdot(values, values)
+        active = [j for j in active if templates[j][0].getMaxX() >= bbox.getMinX()]
+        for j in active:
+            other = templates[j][0]
+            if other.getMaxY() < bbox.getMinY() or other.getMinY() > bbox.getMaxY():
+                continue
+            gram[i, j] = gram[j, i] = _templateDot(templates[i], templates[j])
+        active.append(i)
+    return gram
+
+# Largest condition number of the matrix of dot products between templates for which
+# `_weightTemplates` solves the normal equations
+MAX_TEMPLATE_GRAM_CONDITION = 1e8
+
+
+def _fitTemplatePixels(dp):
+    """Least-squares weights of the templates, fit directly to the pixels of the parent footprint
+
+    This copies the parent bounding box once per child, so it is only used by `_weightTemplates`
+    when the normal equations are ill-conditioned.
+
+    Parameters
+    ----------
+    dp: `DeblendedParent`
+        The deblended parent.
+
+    Returns
+    -------
+    weights: `numpy.ndarray`
+        Weight of each template that is not skipped.
     """
     nchild = np.sum([pkres.skip is False for pkres in dp.peaks])
     A = np.zeros((dp.W*dp.H, nchild))
@@ -1273,9 +1646,51 @@ def _weightTemplates(dp):
         A[:, index] = childImage.getArray().ravel()
         index += 1
 
-    X1, r1, rank1, s1 = np.linalg.lstsq(A, b)
-    del A
-    del b
+    return np.linalg.lstsq(A, b, rcond=-1)[0]
+
+
+def _weightTemplates(dp):
+    """Weight the templates to best match the parent Footprint in a single filter
+
+    This includes weighting both regular templates and point source templates.
+
+    The least-squares fit of the templates to the image is solved with the normal equations:
+    the ``nchild`` x ``nchild`` matrix of dot products between templates (only computed for
+    pairs of templates whose bounding boxes overlap) and the dot products of the templates with
+    the image (see `_getTemplateGram`), so the pixels of the parent bounding box are never
+    copied once per child.
+
+    Solving the normal equations squares the condition number of the fit, so when the templates
+    are close to degenerate (the condition number of the matrix of dot products is larger than
+    ``MAX_TEMPLATE_GRAM_CONDITION``) the templates are instead fit directly to the pixels, with
+    `numpy.linalg.lstsq`, which gives the same weights as before the normal equations were used.
+    Empty templates get a zero weight, as with `numpy.linalg.lstsq`.
+
+    Parameter
+    ---------
+    dp: `DeblendedParent`
+        The deblended parent to re-weight
+
+    Returns
+    -------
+    None
+    """
+    templates = _getFootprintTemplates(dp)
+    image = dp.img.getArray()
+    ATA = _getTemplateGram(templates)
+    ATb = np.zeros(len(templates))
+    for i, (bbox, values) in enumerate(templates):
+        if values is not None:
+            ATb[i] = np.vdot(values, image[_getSlices(bbox, dp.imbb)])
+
+    X1 = np.zeros(len(templates))
+    nonEmpty = np.flatnonzero(np.diag(ATA) > 0)
+    if len(nonEmpty) > 0:
+        gram = ATA[np.ix_(nonEmpty, nonEmpty)]
+        if np.linalg.cond(gram) < MAX_TEMPLATE_GRAM_CONDITION:
+            X1[nonEmpty] = np.linalg.solve(gram, ATb[nonEmpty])
+        else:
+            X1 = _fitTemplatePixels(dp)
 
     index = 0
     for pkres in dp.peaks:
@@ -1285,7 +1700,73 @@ def _weightTemplates(dp):
         pkres.setTemplateWeight(X1[index])
         index += 1
 
-def reconstructTemplates(debResult, log, maxTempDotProd=0.5):
+def _removeDegenerateTemplates(dp, log, maxTempDotProd):
+    """Remove all of the degenerate templates of a parent in a single band
+
+    The normalized dot products of all pairs of templates are computed once (see
+    `_getTemplateGram`). The pairs whose dot product is larger than ``maxTempDotProd`` are
+    then processed from the most to the least degenerate, with the same rule as
+    `reconstructTemplates` to decide which template of a pair is kept, skipping the pairs
+    that contain an already removed template.
+    Removing a template does not change the other templates, so the dot products never need
+    to be computed again.
+
+    Parameters
+    ----------
+    dp: `DeblendedParent`
+        The deblended parent.
+    log: `log.Log`
+        LSST logger for logging purposes.
+    maxTempDotProd: `float`
+        All dot products between templates greater than ``maxTempDotProd`` will result in one
+        of the templates removed.
+
+    Returns
+    -------
+    removed: `int`
+        Number of templates removed.
+    """
+    indexes = [pkres.pki for pkres in dp.peaks if pkres.skip is False]
+    maxTemplate = [np.max(pkres.templateImage.getArray()) for pkres in dp.peaks if pkres.skip is False]
+    gram = _getTemplateGram(_getFootprintTemplates(dp, restrictToParent=False))
+    nchild = len(indexes)
+    norms = np.diag(gram)
+
+    # Degenerate pairs, with their normalized dot product
+    pairs = []
+    for i in range(nchild):
+        if norms[i] <= 0:
+            continue
+        for j in range(i):
+            if norms[j] <= 0 or gram[i, j] == 0:
+                continue
+            dotProd = gram[i, j]/np.sqrt(norms[i]*norms[j])
+            if dotProd > maxTempDotProd:
+                pairs.append((dotProd, i, j))
+    pairs.sort(key=lambda pair: -pair[0])
+
+    removed = 0
+    for dotProd, i, j in pairs:
+        keep = dp.peaks[indexes[i]]
+        reject = dp.peaks[indexes[j]]
+        if keep.skip or reject.skip:
+            continue
+        # If one of the objects is identified as a PSF keep the other one, otherwise keep the one
+        # with the maximum template value
+        if keep.deblendedAsPsf and reject.deblendedAsPsf is False:
+            keep, reject = reject, keep
+        elif keep.deblendedAsPsf is False and reject.deblendedAsPsf:
+            pass
+        elif maxTemplate[j] > maxTemplate[i]:
+            keep, reject = reject, keep
+        log.trace('Removing object with index %d : %f.  Degenerate with %d' % (reject.pki, dotProd,
+                                                                               keep.pki))
+        reject.skip = True
+        reject.degenerate = True
+        removed += 1
+    return removed
+
+def reconstructTemplates(debResult, log, maxTempDotProd=0.5, greedy=False, reweight=False):
     """Remove "degenerate templates"
 
     If galaxies have substructure, such as face-on spirals, the process of identifying peaks can
@@ -1305,36 +1786,41 @@ def reconstructTemplates(debResult, log, maxTempDotProd=0.5):
     maxTempDotProd: `float`, optional
         All dot products between templates greater than ``maxTempDotProd`` will result in one
         of the templates removed.
+    greedy: `bool`, optional
+        If ``True``, all of the degenerate templates are removed in a single pass (see
+        `_removeDegenerateTemplates`) and the deblender is never sent back to an earlier
+        step. Otherwise a single template is removed and ``modified`` is ``True``, so the
+        deblender runs this step (and the ones from its ``onReset``) again until no
+        degenerate template is left.
+    reweight: `bool`, optional
+        If ``True`` (and ``greedy``), the remaining templates of each band in which a
+        template was removed are weighted again (see `weightTemplates`), as they would be
+        when going back to the ``weightTemplates`` step.
 
     Returns
     -------
     modified: `bool`
-        If any degenerate templates are found, ``modified`` is ``True``.
+        If any degenerate templates are found (and not ``greedy``), ``modified`` is ``True``.
     """
     log.trace('Looking for degnerate templates')
 
+    if greedy:
+        for fidx in debResult.filters:
+            dp = debResult.deblendedParents[fidx]
+            if _removeDegenerateTemplates(dp, log, maxTempDotProd) and reweight:
+                _weightTemplates(dp)
+        return False
+
     foundReject = False
     for fidx in debResult.filters:
         dp = debResult.deblendedParents[fidx]
         nchild = np.sum([pkres.skip is False for pkres in dp.peaks])
         indexes = [pkres.pki for pkres in dp.peaks if pkres.skip is False]
 
-        # We build a matrix that stores the dot product between templates.
-        # We convert the template images to HeavyFootprints because they already have a method
-        # to compute the dot product.
-        A = np.zeros((nchild, nchild))
-        maxTemplate = []
-        heavies = []
-        for pkres in dp.peaks:
-            if pkres.skip:
-                continue
-            heavies.append(afwDet.makeHeavyFootprint(pkres.templateFootprint,
-                                                     afwImage.MaskedImageF(pkres.templateImage)))
-            maxTemplate.append(np.max(pkres.templateImage.getArray()))
-
-        for i in range(nchild):
-            for j in range(i + 1):
-                A[i, j] = heavies[i].dot(heavies[j])
+        # We build a matrix that stores the dot product between templates,
+        # restricted to the template footprints.
+        A = _getTemplateGram(_getFootprintTemplates(dp, restrictToParent=False))
+        maxTemplate = [np.max(pkres.templateImage.getArray()) for pkres in dp.peaks if pkres.skip is False]
 
         # Normalize the dot products to get the cosine of the angle between templates
         for i in range(nchild):
@@ -1499,10 +1985,7 @@ def apportionFlux(debResult, log, assignStrayFlux=True, strayFluxAssignment='r-t
 
         # Shrink parent to union of children
         if strayFluxAssignment == 'trim':
-            finalSpanSet = afwGeom.SpanSet()
-            for foot in tfoots:
-                finalSpanSet = finalSpanSet.union(foot.spans)
-            dp.fp.setSpans(finalSpanSet)
+            dp.fp.setSpans(butils.mergeSpanSets([foot.spans for foot in tfoots]))
 
         # Store the template sum in the deblender result
         if getTemplateSum:
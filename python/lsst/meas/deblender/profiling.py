@@ -0,0 +1,225 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Deblender tasks that profile the slowest parents
+
+`ProfilingSourceDeblendTask` and `ProfilingMultibandDeblendTask` use the ``preSingleDeblendHook``
+and ``postSingleDeblendHook`` of the deblender tasks to run `cProfile` on every parent, and keep
+the profiles of the ``profileMaxParents`` slowest parents that took more than ``profileThreshold``.
+At the end of ``deblend`` they are written to ``profileDir``, one directory per parent::
+
+    parent-<id>/profile.prof      cProfile statistics (see `pstats`)
+    parent-<id>/summary.json      runtime, bounding box, peaks, noise and PSF width
+    parent-<id>/...               blend bundle of the parent (see `lsst.meas.deblender.bundle`)
+    index.json                    summary of all of the saved parents, slowest first
+
+so that each parent can be replayed offline with ``python -m lsst.meas.deblender.bundle``.
+"""
+from builtins import object
+import cProfile
+import heapq
+import json
+import os
+import time
+
+import lsst.pex.config as pexConfig
+import lsst.afw.detection as afwDet
+
+from .deblend import SourceDeblendConfig, SourceDeblendTask, MultibandDeblendConfig, MultibandDeblendTask
+from .bundle import makeBlendBundle
+
+__all__ = ["ProfileDeblendConfig", "ProfilingSourceDeblendConfig", "ProfilingSourceDeblendTask",
+           "ProfilingMultibandDeblendConfig", "ProfilingMultibandDeblendTask"]
+
+
+class ProfileDeblendConfig(pexConfig.Config):
+    profileThreshold = pexConfig.Field(dtype=float, default=1000.,
+                                       doc="Minimum runtime, in ms, of the parents whose profile is saved")
+    profileMaxParents = pexConfig.Field(dtype=int, default=10,
+                                        doc="Maximum number of parents (the slowest ones) to save")
+    profileDir = pexConfig.Field(dtype=str, default="deblendProfiles",
+                                 doc="Directory in which the profiles are written")
+    profileSaveImages = pexConfig.Field(dtype=bool, default=True,
+                                        doc=("Save the blend bundle (padded cutout of each band, PSF images "
+                                             "and config) along with the profile; otherwise only the parent "
+                                             "footprint is saved"))
+
+
+class _ParentProfile(object):
+    """Profile and inputs of a single parent"""
+
+    def __init__(self, parentId, runtime, profile, footprint, bundle):
+        self.parentId = parentId
+        self.runtime = runtime
+        self.profile = profile
+        self.footprint = footprint
+        self.bundle = bundle
+
+    def __lt__(self, other):
+        return self.runtime < other.runtime
+
+    def getSummary(self):
+        bbox = self.footprint.getBBox()
+        summary = dict(
+            id=int(self.parentId),
+            runtime=self.runtime,
+            bbox=[bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()],
+            area=self.footprint.getArea(),
+            peaks=[[pk.getFx(), pk.getFy(), pk.getPeakValue()] for pk in self.footprint.getPeaks()],
+        )
+        if self.bundle is not None:
+            summary["sigmas"] = self.bundle.sigmas
+            summary["psfFwhms"] = self.bundle.psfFwhms
+        return summary
+
+    def write(self, dirName):
+        if not os.path.exists(dirName):
+            os.makedirs(dirName)
+        self.profile.dump_stats(os.path.join(dirName, "profile.prof"))
+        if self.bundle is not None:
+            self.bundle.write(dirName)
+        else:
+            self.footprint.writeFits(os.path.join(dirName, "footprint.fits"))
+        with open(os.path.join(dirName, "summary.json"), "w") as f:
+            json.dump(self.getSummary(), f, indent=2)
+
+
+class _ParentProfiler(object):
+    """Profile parents between ``start`` and ``stop`` and keep the slowest ones"""
+
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self.profiles = []
+        self.profile = None
+
+    def start(self, footprint):
+        if self.profile is not None:
+            # The previous parent failed before reaching postSingleDeblendHook
+            self.profile.disable()
+        # The parent footprint is updated with the children spans after deblending
+        self.footprint = afwDet.Footprint(footprint)
+        self.profile = cProfile.Profile()
+        self.t0 = time.time()
+        self.profile.enable()
+
+    def stop(self, parentId, maskedImages, psfs, sigmas, psfFwhms):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        runtime = (time.time() - self.t0)*1000
+        profile, self.profile = self.profile, None
+        if runtime < self.config.profileThreshold:
+            return
+        if (len(self.profiles) >= self.config.profileMaxParents and
+                runtime <= self.profiles[0].runtime):
+            return
+        bundle = None
+        if self.config.profileSaveImages:
+            bundle = makeBlendBundle(parentId, self.footprint, maskedImages, psfs, sigmas, psfFwhms,
+                                     self.config)
+        entry = _ParentProfile(parentId, runtime, profile, self.footprint, bundle)
+        if len(self.profiles) >= self.config.profileMaxParents:
+            heapq.heapreplace(self.profiles, entry)
+        else:
+            heapq.heappush(self.profiles, entry)
+
+    def write(self):
+        """Write the saved profiles, and clear them"""
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile = None
+        if not self.profiles:
+            return
+        profiles = sorted(self.profiles, reverse=True)
+        self.profiles = []
+        summaries = []
+        for entry in profiles:
+            dirName = os.path.join(self.config.profileDir, "parent-%d" % entry.parentId)
+            entry.write(dirName)
+            summary = entry.getSummary()
+            summary["dir"] = dirName
+            summaries.append(summary)
+        with open(os.path.join(self.config.profileDir, "index.json"), "w") as f:
+            json.dump(summaries, f, indent=2)
+        self.log.info("Saved the profiles of %d parents (slowest: %d, %.0f ms) to %s" %
+                      (len(profiles), profiles[0].parentId, profiles[0].runtime, self.config.profileDir))
+
+
+class ProfilingSourceDeblendConfig(SourceDeblendConfig, ProfileDeblendConfig):
+    pass
+
+
+class ProfilingSourceDeblendTask(SourceDeblendTask):
+    """SourceDeblendTask that saves the profiles of the slowest parents
+
+    See `lsst.meas.deblender.profiling`.
+    """
+    ConfigClass = ProfilingSourceDeblendConfig
+
+    def __init__(self, schema, peakSchema=None, **kwargs):
+        SourceDeblendTask.__init__(self, schema, peakSchema=peakSchema, **kwargs)
+        self.profiler = _ParentProfiler(self.config, self.log)
+
+    def deblend(self, exposure, srcs, psf, sigma1=None):
+        try:
+            SourceDeblendTask.deblend(self, exposure, srcs, psf, sigma1)
+        finally:
+            self.profiler.write()
+
+    def preSingleDeblendHook(self, exposure, srcs, i, fp, psf, psf_fwhm, sigma1):
+        self.profiler.start(fp)
+
+    def postSingleDeblendHook(self, exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma1, res):
+        self.profiler.stop(srcs[i].getId(), {"single": exposure.getMaskedImage()}, {"single": psf},
+                           {"single": sigma1}, {"single": psf_fwhm})
+
+
+class ProfilingMultibandDeblendConfig(MultibandDeblendConfig, ProfileDeblendConfig):
+    pass
+
+
+class ProfilingMultibandDeblendTask(MultibandDeblendTask):
+    """MultibandDeblendTask that saves the profiles of the slowest parents
+
+    See `lsst.meas.deblender.profiling`.
+    """
+    ConfigClass = ProfilingMultibandDeblendConfig
+
+    def __init__(self, schema, peakSchema=None, **kwargs):
+        MultibandDeblendTask.__init__(self, schema, peakSchema=peakSchema, **kwargs)
+        self.profiler = _ParentProfiler(self.config, self.log)
+
+    def deblend(self, exposures, sources, psfs, bands=None):
+        try:
+            return MultibandDeblendTask.deblend(self, exposures, sources, psfs, bands)
+        finally:
+            self.profiler.write()
+
+    def preSingleDeblendHook(self, exposures, sources, pk, fp, psfs, psf_fwhms, sigmas):
+        self._exposures = exposures
+        self._parentId = sources[pk].getId()
+        self.profiler.start(fp)
+
+    def postSingleDeblendHook(self, exposure, flux_catalogs, template_catalogs,
+                              pk, npre, fp, psfs, psf_fwhms, sigmas, result):
+        maskedImages = {band: exp.getMaskedImage() for band, exp in self._exposures.items()}
+        self.profiler.stop(self._parentId, maskedImages, psfs, sigmas, psf_fwhms)
@@ -0,0 +1,183 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Extract the minimal sub-image needed to deblend a single parent
+
+The deblender only reads pixels inside the parent footprint's bounding box, with one exception:
+when ramping flux at the edges of templates (``rampFluxAtEdge``), the parent footprint is dilated by
+the PSF ramp size ``S`` (see `lsst.meas.deblender.plugins._handle_flux_at_edge`) and the resulting
+template is clipped to the image bounding box.  Symmetric templates (including the "patched" spans
+whose mirrors fall outside the parent) never leave the parent bounding box.
+
+So a cutout of the parent bounding box grown by ``S`` and clipped to the full image produces results
+identical to deblending on the full image, provided the noise level (``sigma1``/``avgNoise``)
+is computed from the full image and passed in explicitly.
+"""
+from builtins import object, range
+
+import lsst.afw.image as afwImage
+
+__all__ = ["getRampPadding", "getParentCutoutBBox", "makeParentCutout", "ParentCutoutIterator"]
+
+
+def getRampPadding(psffwhm):
+    """Number of pixels the deblender may read beyond the parent bounding box
+
+    This is the size ``S`` that ``_handle_flux_at_edge`` dilates the parent footprint by.
+
+    Parameters
+    ----------
+    psffwhm: `float`
+        FWHM of the PSF in pixels.
+
+    Returns
+    -------
+    padding: `int`
+        Padding in pixels.
+    """
+    S = psffwhm*1.5
+    # make it an odd integer
+    return int((S + 0.5)/2)*2 + 1
+
+
+def getParentCutoutBBox(footprint, imageBBox, psffwhm, rampFluxAtEdge=True):
+    """Bounding box of the sub-image needed to deblend ``footprint``
+
+    Parameters
+    ----------
+    footprint: `afw.detection.Footprint`
+        Parent footprint to deblend.
+    imageBBox: `afw.geom.Box2I`
+        Bounding box of the full image containing ``footprint``.
+    psffwhm: `float` or list of `float`s
+        FWHM of the PSF. If a list is given (one entry per band) the largest is used.
+    rampFluxAtEdge: `bool`, optional
+        Whether or not the templates will be ramped at their edges.
+        If ``False`` no padding is required.
+
+    Returns
+    -------
+    bbox: `afw.geom.Box2I`
+        Bounding box of the cutout, in PARENT coordinates.
+    """
+    bbox = footprint.getBBox()
+    if rampFluxAtEdge:
+        try:
+            psffwhm = max(psffwhm)
+        except TypeError:
+            pass
+        bbox.grow(getRampPadding(psffwhm))
+        bbox.clip(imageBBox)
+    return bbox
+
+
+def makeParentCutout(maskedImage, footprint, psffwhm, rampFluxAtEdge=True, deep=False):
+    """Extract the padded sub-image needed to deblend a single parent
+
+    Parameters
+    ----------
+    maskedImage: `afw.image.MaskedImageF`
+        Full masked image containing ``footprint``.
+    footprint: `afw.detection.Footprint`
+        Parent footprint to deblend.
+    psffwhm: `float`
+        FWHM of the PSF in pixels.
+    rampFluxAtEdge: `bool`, optional
+        Whether or not the templates will be ramped at their edges.
+    deep: `bool`, optional
+        If ``True`` the pixels are copied, so that the cutout can be shipped to another process
+        without the full image. Otherwise the cutout is a view into ``maskedImage``.
+
+    Returns
+    -------
+    cutout: `afw.image.MaskedImageF`
+        Sub-image of ``maskedImage``.
+    """
+    bbox = getParentCutoutBBox(footprint, maskedImage.getBBox(), psffwhm, rampFluxAtEdge)
+    return maskedImage.Factory(maskedImage, bbox, afwImage.PARENT, deep)
+
+
+class ParentCutoutIterator(object):
+    """Iterate over the parents of a catalog along with their padded cutouts
+
+    Only parents that the deblender would process (more than one peak) are returned.
+    The cutouts are obtained from a function of their bounding box, so that they can be either
+    sub-images of an image in memory (see `fromMaskedImage`) or read from disk one at a time.
+    The parents are those in the catalog when the iteration starts, so children may be added to
+    the catalog while iterating.
+    """
+
+    def __init__(self, sources, imageBBox, psffwhm, readCutout, rampFluxAtEdge=True):
+        """Create the iterator
+
+        Parameters
+        ----------
+        sources: `afw.table.SourceCatalog`
+            Catalog of parents to deblend.
+        imageBBox: `afw.geom.Box2I`
+            Bounding box of the full image containing the ``sources``.
+        psffwhm: `float` or callable
+            FWHM of the PSF in pixels, or a function returning the FWHM at the bounding box of a
+            parent footprint.
+        readCutout: callable
+            Function returning the cutout (e.g. an `afw.image.ExposureF`) for a bounding box
+            in PARENT coordinates.
+        rampFluxAtEdge: `bool`, optional
+            Whether or not the templates will be ramped at their edges.
+        """
+        self.sources = sources
+        self.imageBBox = imageBBox
+        self.psffwhm = psffwhm
+        self.readCutout = readCutout
+        self.rampFluxAtEdge = rampFluxAtEdge
+
+    @classmethod
+    def fromMaskedImage(cls, maskedImage, sources, psffwhm, rampFluxAtEdge=True, deep=False):
+        """Iterate over the cutouts of an image in memory
+
+        Parameters
+        ----------
+        maskedImage: `afw.image.MaskedImageF`
+            Full masked image containing the ``sources``.
+        sources: `afw.table.SourceCatalog`
+            Catalog of parents to deblend.
+        psffwhm: `float` or callable
+            FWHM of the PSF in pixels (see `__init__`).
+        rampFluxAtEdge: `bool`, optional
+            Whether or not the templates will be ramped at their edges.
+        deep: `bool`, optional
+            If ``True`` copy the cutout pixels.
+        """
+        def readCutout(bbox):
+            return maskedImage.Factory(maskedImage, bbox, afwImage.PARENT, deep)
+        return cls(sources, maskedImage.getBBox(), psffwhm, readCutout, rampFluxAtEdge)
+
+    def __iter__(self):
+        for i in range(len(self.sources)):
+            src = self.sources[i]
+            if src.getParent() != 0:
+                continue
+            fp = src.getFootprint()
+            if len(fp.getPeaks()) < 2:
+                continue
+            psffwhm = self.psffwhm(fp.getBBox()) if callable(self.psffwhm) else self.psffwhm
+            bbox = getParentCutoutBBox(fp, self.imageBBox, psffwhm, self.rampFluxAtEdge)
+            yield src, self.readCutout(bbox)
@@ -0,0 +1,139 @@
+#
+# LSST Data Management System
+# See COPYRIGHT file.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Converged scarlet models, saved so that a later run can start from them
+
+The SED and morphology of each source of a blend are stored under a key made from the parent
+footprint's bounding box and peak positions, so that a rerun on the same detections finds them
+again, while a parent whose detection changed is fit from scratch.
+"""
+from builtins import object
+import os
+import zlib
+
+import numpy as np
+
+__all__ = ["ScarletWarmStart", "getBlendKey"]
+
+
+def getBlendKey(footprint):
+    """Key identifying a parent footprint and its peaks
+
+    Parameters
+    ----------
+    footprint: `afw.detection.Footprint`
+        Parent footprint.
+
+    Returns
+    -------
+    key: `str`
+    """
+    bbox = footprint.getBBox()
+    peaks = np.array([[pk.getIx(), pk.getIy()] for pk in footprint.getPeaks()], dtype=np.int32)
+    return "%d_%d_%d_%d_%d_%08x" % (bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY(),
+                                    len(peaks), zlib.crc32(peaks.tobytes()) & 0xffffffff)
+
+
+class ScarletWarmStart(object):
+    """Store of the converged SED and morphology of the sources of each blend
+
+    The models are kept in memory and read from, or written to, a numpy ``.npz`` file.
+    """
+
+    def __init__(self, filename=None):
+        """Create the store, reading ``filename`` if it exists
+
+        Parameters
+        ----------
+        filename: `str`, optional
+            Name of the ``.npz`` file used by `save`.
+            If `None` the models are only kept in memory.
+        """
+        self.filename = filename
+        self.models = {}
+        if filename is not None and os.path.exists(filename):
+            self._read(filename)
+
+    def _read(self, filename):
+        with np.load(filename) as data:
+            for name in data.files:
+                key, pk, kind = name.rsplit("__", 2)
+                sources = self.models.setdefault(key, {})
+                sources.setdefault(int(pk), {})[kind] = data[name]
+        # Convert to lists of (sed, morph), ordered by peak index
+        self.models = {key: [(sources[pk]["sed"], sources[pk]["morph"]) for pk in sorted(sources)]
+                       for key, sources in self.models.items()}
+
+    def __len__(self):
+        return len(self.models)
+
+    def get(self, key):
+        """List of ``(sed, morph)`` arrays, one per source, or `None` if there is no model for ``key``"""
+        return self.models.get(key)
+
+    def set(self, key, sources):
+        """Save the SED and morphology of the sources of a blend
+
+        Parameters
+        ----------
+        key: `str`
+            Key of the blend (see `getBlendKey`).
+        sources: list of `scarlet.source.Source`
+            Converged sources.
+        """
+        self.models[key] = [(np.array(src.sed, copy=True), np.array(src.morph, copy=True))
+                            for src in sources]
+
+    def save(self):
+        """Write all of the models to ``filename``"""
+        if self.filename is None:
+            return
+        arrays = {}
+        for key, sources in self.models.items():
+            for pk, (sed, morph) in enumerate(sources):
+                arrays["%s__%d__sed" % (key, pk)] = sed
+                arrays["%s__%d__morph" % (key, pk)] = morph
+        tmpName = self.filename + ".tmp.npz"
+        np.savez_compressed(tmpName, **arrays)
+        os.rename(tmpName, self.filename)
+
+    @staticmethod
+    def apply(sources, models):
+        """Initialize ``sources`` from saved models
+
+        Sources are only initialized if the number of sources and the shape of every SED and
+        morphology match the saved ones (the box size of a source depends on the data, and the
+        number of bands may have changed).
+
+        Returns
+        -------
+        applied: `bool`
+            True if the sources were initialized.
+        """
+        if models is None or len(models) != len(sources):
+            return False
+        for src, (sed, morph) in zip(sources, models):
+            if src.sed.shape != sed.shape or src.morph.shape != morph.shape:
+                return False
+        for src, (sed, morph) in zip(sources, models):
+            src.sed[:] = sed
+            src.morph[:] = morph
+        return True
@@ -1,3 +1,4 @@
+#include <algorithm>
 #include <list>
 #include <cmath>
 #include <cstdint>
@@ -1450,6 +1451,97 @@ getSignificantEdgePixels(ImagePtrT img,
     return significant;
 }
 
+/**
+ Returns the union of a list of SpanSets.
+
+ All of the spans are collected, sorted once by (y, x0), and overlapping or
+ contiguous spans on the same row are merged, so the cost is O(N log N) in
+ the total number of spans (successive pairwise unions are quadratic in the
+ number of SpanSets).
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+std::shared_ptr<geom::SpanSet>
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+mergeSpanSets(std::vector<std::shared_ptr<geom::SpanSet> > const& spanSets) {
+    std::size_t nSpans = 0;
+    for (auto const& spanSet : spanSets) {
+        if (spanSet) {
+            nSpans += spanSet->size();
+        }
+    }
+    std::vector<geom::Span> spans;
+    spans.reserve(nSpans);
+    for (auto const& spanSet : spanSets) {
+        if (spanSet) {
+            spans.insert(spans.end(), spanSet->begin(), spanSet->end());
+        }
+    }
+    std::sort(spans.begin(), spans.end(), [](geom::Span const& a, geom::Span const& b) {
+        return (a.getY() < b.getY()) || (a.getY() == b.getY() && a.getX0() < b.getX0());
+    });
+
+    std::vector<geom::Span> merged;
+    merged.reserve(spans.size());
+    for (auto const& span : spans) {
+        if (!merged.empty() && merged.back().getY() == span.getY() &&
+            span.getX0() <= merged.back().getX1() + 1) {
+            if (span.getX1() > merged.back().getX1()) {
+                merged.back() = geom::Span(span.getY(), merged.back().getX0(), span.getX1());
+            }
+        } else {
+            merged.push_back(span);
+        }
+    }
+    return std::make_shared<geom::SpanSet>(std::move(merged), false);
+}
+/**
+ Returns, for each bitmask, the fraction of the pixels of a SpanSet with any of
+ its bits set in the mask.
+
+ Pixels outside of the mask are counted as unmasked.  All of the fractions are
+ computed in a single pass over the spans, rather than building the SpanSet of
+ the unmasked pixels for every bitmask.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+std::vector<double>
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+getMaskedFractions(geom::SpanSet const& spans,
+                   MaskT const& mask,
+                   std::vector<MaskPixelT> const& bitmasks) {
+    std::vector<std::size_t> counts(bitmasks.size(), 0);
+    geom::Box2I const bbox = mask.getBBox(image::PARENT);
+    for (geom::SpanSet::const_iterator sp = spans.begin(); sp != spans.end(); ++sp) {
+        int const y = sp->getY();
+        if (y < bbox.getMinY() || y > bbox.getMaxY()) {
+            continue;
+        }
+        int const x0 = std::max(sp->getX0(), bbox.getMinX());
+        int const x1 = std::min(sp->getX1(), bbox.getMaxX());
+        if (x0 > x1) {
+            continue;
+        }
+        typename MaskT::x_iterator iter = mask.x_at(x0 - mask.getX0(), y - mask.getY0());
+        for (int x = x0; x <= x1; ++x, ++iter) {
+            MaskPixelT const value = *iter;
+            if (value == 0) {
+                continue;
+            }
+            for (std::size_t i = 0; i < bitmasks.size(); ++i) {
+                if (value & bitmasks[i]) {
+                    ++counts[i];
+                }
+            }
+        }
+    }
+    std::vector<double> fractions(bitmasks.size(), 0.0);
+    double const area = spans.getArea();
+    if (area > 0) {
+        for (std::size_t i = 0; i < bitmasks.size(); ++i) {
+            fractions[i] = counts[i]/area;
+        }
+    }
+    return fractions;
+}
 
 // Instantiate
 template class deblend::BaselineUtils<float>;
@@ -0,0 +1,74 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import json
+import unittest
+
+import lsst.utils.tests
+from lsst.meas.deblender.benchmark import makeSyntheticField, runBenchmarks, writeBenchmarks
+
+
+class BenchmarkTestCase(lsst.utils.tests.TestCase):
+
+    def testBenchmark(self):
+        """Run the single band benchmarks on a small field and check the output file"""
+        field = makeSyntheticField(width=128, height=128, nParents=3, peaksPerParent=2,
+                                   blendSize=3., edgeFraction=0.3, seed=2)
+        self.assertGreater(len(field.getBlends()), 0)
+        spans = [src.getFootprint().getSpans() for src in field.sources]
+        nPeaks = [len(src.getFootprint().getPeaks()) for src in field.sources]
+        names = ["baseline.deblend", "baseline.newDeblend", "SourceDeblendTask"]
+        results = runBenchmarks(field, names)
+        self.assertEqual([r["name"] for r in results], names)
+        for result in results:
+            self.assertEqual(result["nParents"], len(field.getBlends()))
+            self.assertGreater(result["peaksPerSecond"], 0)
+            self.assertEqual(result["bands"], ["b0"])
+            self.assertGreater(result["peakRss"], 0)
+            self.assertGreaterEqual(result["rssIncrease"], 0)
+        self.assertIn("fitPsfs", results[1]["plugins"])
+        # the benchmarks deblend copies of the parents
+        self.assertEqual([src.getFootprint().getSpans() for src in field.sources], spans)
+        self.assertEqual([len(src.getFootprint().getPeaks()) for src in field.sources], nPeaks)
+
+        results = runBenchmarks(field, names[:1], measureMemory=False)
+        self.assertNotIn("peakRss", results[0])
+
+        with lsst.utils.tests.getTempFilePath(".json") as filename:
+            writeBenchmarks(filename, field, results)
+            with open(filename) as f:
+                output = json.load(f)
+        self.assertEqual(output["field"]["nParents"], 3)
+        self.assertEqual(len(output["results"]), 3)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,96 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.meas.algorithms as algorithms
+from lsst.meas.deblender import SourceDeblendConfig
+from lsst.meas.deblender.baseline import deblend
+from lsst.meas.deblender.bundle import BlendBundle, makeBlendBundle
+
+
+class BlendBundleTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.dirName = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirName, ignore_errors=True)
+
+    def testReplay(self):
+        """Write and read a bundle, and check that replaying it gives the same children"""
+        mi = afwImage.MaskedImageF(afwGeom.Extent2I(100, 100))
+        mi.getVariance().set(1.0)
+        mi.getImage().set(0)
+        x, y = 50, 50
+        mi.getImage().set(x, y, 100.)
+        mi.getImage().set(x - 2, y - 2, 100.)
+        psf = algorithms.DoubleGaussianPsf(21, 21, 3.)
+        psfFwhm = psf.computeShape().getDeterminantRadius()*2.35
+        foot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(3, offset=(x, y)))
+        foot.addPeak(x, y, 100.)
+        foot.addPeak(x - 2, y - 2, 100.)
+
+        config = SourceDeblendConfig()
+        bundle = makeBlendBundle(7, foot, {"r": mi}, {"r": psf}, {"r": 1.}, {"r": psfFwhm}, config)
+        bundle.write(self.dirName)
+        bundle = BlendBundle.read(self.dirName)
+        self.assertEqual(bundle.parentId, 7)
+        self.assertEqual(bundle.bands, ["r"])
+        self.assertEqual(len(bundle.footprint.getPeaks()), 2)
+        self.assertEqual(len(bundle.psfGrids["r"]), 9)
+
+        result, runtime = bundle.replay()
+        self.assertFalse(result.failed)
+        self.assertIn("fitPsfs", result.pluginStats)
+        expected = deblend(afwDetection.Footprint(foot), mi, psf, psfFwhm, sigma1=1.,
+                           rampFluxAtEdge=True)
+        peaks = result.deblendedParents["r"].peaks
+        expectedPeaks = expected.deblendedParents[0].peaks
+        self.assertEqual(len(peaks), len(expectedPeaks))
+        for peak, expectedPeak in zip(peaks, expectedPeaks):
+            self.assertEqual(peak.deblendedAsPsf, expectedPeak.deblendedAsPsf)
+            self.assertEqual(peak.getFluxPortion().getBBox(), expectedPeak.getFluxPortion().getBBox())
+            self.assertFloatsAlmostEqual(peak.templateImage.getArray(),
+                                         expectedPeak.templateImage.getArray(), rtol=1e-6, atol=1e-6)
+            self.assertFloatsAlmostEqual(peak.fluxPortion.getImage().getArray(),
+                                         expectedPeak.fluxPortion.getImage().getArray(),
+                                         rtol=1e-6, atol=1e-6)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
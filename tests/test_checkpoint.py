@@ -0,0 +1,137 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.meas.algorithms as algorithms
+from lsst.meas.deblender import SourceDeblendConfig, SourceDeblendTask
+from lsst.meas.deblender.checkpoint import DeblendCheckpoint
+
+
+class CheckpointTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        flux = 100.0
+        mi = afwImage.MaskedImageF(afwGeom.Extent2I(128, 128))
+        mi.getVariance().set(1.0)
+        mi.getImage().set(0)
+        self.centers = [(30, 30), (90, 40), (60, 100)]
+        for x, y in self.centers:
+            mi.getImage().set(x, y, flux)
+            mi.getImage().set(x - 2, y - 2, flux)
+        self.exposure = afwImage.makeExposure(mi)
+        self.exposure.setPsf(algorithms.DoubleGaussianPsf(21, 21, 3.))
+        self.schema = afwTable.SourceTable.makeMinimalSchema()
+
+    def makeCatalog(self, task):
+        catalog = afwTable.SourceCatalog(self.schema)
+        for x, y in self.centers:
+            src = catalog.addNew()
+            foot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(3, offset=(x, y)))
+            foot.addPeak(x, y, 100.)
+            foot.addPeak(x - 2, y - 2, 100.)
+            src.setFootprint(foot)
+        return catalog
+
+    def testResume(self):
+        """Deblend once while checkpointing, then rerun from the checkpoint
+
+        The rerun must not deblend any parent, and must produce the same catalog.
+        """
+        with lsst.utils.tests.getTempFilePath(".txt") as filename:
+            config = SourceDeblendConfig()
+            config.checkpointFile = filename
+            config.checkpointInterval = 2
+            task = SourceDeblendTask(self.schema, config=config)
+            expected = self.makeCatalog(task)
+            task.run(self.exposure, expected)
+            self.assertGreater(len(expected), len(self.centers))
+            self.assertTrue(os.path.exists(filename))
+
+            resumed = SourceDeblendTask(self.schema, config=config)
+            ndeblended = []
+            resumed.postSingleDeblendHook = lambda *args: ndeblended.append(1)
+            catalog = self.makeCatalog(resumed)
+            resumed.run(self.exposure, catalog)
+
+            self.assertEqual(len(ndeblended), 0)
+            self.assertEqual(len(catalog), len(expected))
+            for src, exp in zip(catalog, expected):
+                self.assertEqual(src.getId(), exp.getId())
+                self.assertEqual(src.getParent(), exp.getParent())
+                self.assertEqual(src.get("deblend_nChild"), exp.get("deblend_nChild"))
+                self.assertEqual(src.getFootprint().getBBox(), exp.getFootprint().getBBox())
+
+            # A checkpoint written with another configuration is refused
+            config.maxNumberOfPeaks = 1
+            other = SourceDeblendTask(self.schema, config=config)
+            with self.assertRaises(RuntimeError):
+                other.run(self.exposure, self.makeCatalog(other))
+
+            self.removeBlocks(filename)
+
+    def testLoadOrder(self):
+        """Children are attached to their parent whatever their order, and orphans are dropped"""
+        with lsst.utils.tests.getTempFilePath(".txt") as filename:
+            catalog = afwTable.SourceCatalog(self.schema)
+            parent = catalog.addNew()
+            child = catalog.addNew()
+            child.setParent(parent.getId())
+            orphan = catalog.addNew()
+            orphan.setParent(parent.getId() + 1000)
+            checkpoint = DeblendCheckpoint(filename, signature="input")
+            checkpoint.addFamily("sources", [child, orphan, parent])
+            checkpoint.parentDone()
+            checkpoint.flush()
+
+            families = DeblendCheckpoint(filename, signature="input").load("sources")
+            self.assertEqual(list(families.keys()), [parent.getId()])
+            self.assertEqual([record.getId() for record in families[parent.getId()]],
+                             [parent.getId(), child.getId()])
+            with self.assertRaises(RuntimeError):
+                DeblendCheckpoint(filename, signature="other input")
+
+            self.removeBlocks(filename)
+
+    def removeBlocks(self, filename):
+        for name in os.listdir(os.path.dirname(filename) or "."):
+            if name.startswith(os.path.splitext(os.path.basename(filename))[0] + "-"):
+                os.remove(os.path.join(os.path.dirname(filename), name))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
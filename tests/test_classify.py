@@ -0,0 +1,136 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.deblender import SourceDeblendConfig, SourceDeblendTask
+from lsst.meas.deblender.classify import (classifyParents, isLargeFootprint, isMasked,
+                                         SKIP_SINGLE_PEAK, SKIP_TOO_BIG, SKIP_MASKED)
+
+
+class ClassifyTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.mask = afwImage.Mask(afwGeom.Extent2I(200, 100))
+        # the pixels of the last parent are saturated
+        self.mask.getArray()[:, 150:] = self.mask.getPlaneBitMask("SAT")
+        self.schema = afwTable.SourceTable.makeMinimalSchema()
+        self.catalog = afwTable.SourceCatalog(self.schema)
+        # single peak, deblended, large, elongated, masked
+        shapes = [(afwGeom.SpanSet.fromShape(3, offset=(20, 20)), 1),
+                  (afwGeom.SpanSet.fromShape(3, offset=(50, 20)), 2),
+                  (afwGeom.SpanSet.fromShape(20, offset=(40, 60)), 2),
+                  (afwGeom.SpanSet([afwGeom.Span(y, 80, 130) for y in range(50, 53)]), 3),
+                  (afwGeom.SpanSet.fromShape(3, offset=(170, 20)), 2)]
+        for spans, nPeaks in shapes:
+            foot = afwDetection.Footprint(spans)
+            center = spans.getBBox().getCenter()
+            for i in range(nPeaks):
+                foot.addPeak(center.getX() + i, center.getY(), 100.)
+            self.catalog.addNew().setFootprint(foot)
+
+    def testClassify(self):
+        classification = classifyParents(self.catalog, self.mask, maxFootprintArea=1000,
+                                         minFootprintAxisRatio=0.2, maskLimits={"SAT": 0.5},
+                                         maxNumberOfPeaks=2)
+        self.assertEqual(len(classification), len(self.catalog))
+        self.assertEqual(list(classification.skipReasons),
+                         [SKIP_SINGLE_PEAK, "", SKIP_TOO_BIG, SKIP_TOO_BIG, SKIP_MASKED])
+        self.assertEqual(list(classification.getWorkList()), [1])
+        self.assertEqual(classification.getSkipCounts(),
+                         {SKIP_SINGLE_PEAK: 1, SKIP_TOO_BIG: 2, SKIP_MASKED: 1})
+        self.assertEqual(list(classification.nPeaks), [1, 2, 2, 3, 2])
+        self.assertEqual(list(classification.tooManyPeaks), [False, False, False, True, False])
+        for i, src in enumerate(self.catalog):
+            self.assertEqual(classification.ids[i], src.getId())
+            self.assertEqual(classification.area[i], src.getFootprint().getArea())
+            self.assertEqual(classification.width[i], src.getFootprint().getBBox().getWidth())
+        # the moments and masked fractions are only computed when needed
+        self.assertTrue(np.isnan(classification.axisRatio[0]))
+        self.assertTrue(np.isnan(classification.axisRatio[2]))
+        self.assertLess(classification.axisRatio[3], 0.2)
+        self.assertEqual(classification.maskedFractions["SAT"][1], 0.)
+        self.assertEqual(classification.maskedFractions["SAT"][4], 1.)
+        self.assertTrue(np.isnan(classification.maskedFractions["SAT"][3]))
+
+        # without thresholds only the single peak parent is skipped, unless singles are processed
+        classification = classifyParents(self.catalog, self.mask)
+        self.assertEqual(list(classification.getWorkList()), [1, 2, 3, 4])
+        classification = classifyParents(self.catalog, self.mask, processSingles=True)
+        self.assertEqual(list(classification.getWorkList()), [0, 1, 2, 3, 4])
+
+    def testTask(self):
+        """The task classifies the parents with the limits of its config"""
+        config = SourceDeblendConfig()
+        config.maxFootprintArea = 1000
+        config.minFootprintAxisRatio = 0.2
+        config.maskLimits = {"SAT": 0.5}
+        task = SourceDeblendTask(self.schema, config=config)
+        classification = task.classifyParents(self.catalog, self.mask)
+        self.assertEqual(list(classification.skipReasons),
+                         [SKIP_SINGLE_PEAK, "", SKIP_TOO_BIG, SKIP_TOO_BIG, SKIP_MASKED])
+
+        # without a mask the mask limits are not applied
+        classification = task.classifyParents(self.catalog, None)
+        self.assertEqual(list(classification.getWorkList()), [1, 4])
+
+        # the deprecated per-footprint methods apply the same rules
+        for i, src in enumerate(self.catalog):
+            foot = src.getFootprint()
+            with self.assertWarns(DeprecationWarning):
+                self.assertEqual(task.isLargeFootprint(foot), i in (2, 3))
+            with self.assertWarns(DeprecationWarning):
+                self.assertEqual(task.isMasked(foot, self.mask), i == 4)
+
+    def testFootprint(self):
+        """A single footprint is classified with the rules of classifyParents"""
+        feet = [src.getFootprint() for src in self.catalog]
+        self.assertEqual([isLargeFootprint(foot, maxFootprintArea=1000) for foot in feet],
+                         [False, False, True, False, False])
+        self.assertEqual([isLargeFootprint(foot, minFootprintAxisRatio=0.2) for foot in feet],
+                         [False, False, False, True, False])
+        self.assertEqual([isLargeFootprint(foot, maxFootprintSize=30) for foot in feet],
+                         [False, False, True, True, False])
+        self.assertFalse(isLargeFootprint(feet[2]))
+        self.assertEqual([isMasked(foot, self.mask, {"SAT": 0.5}) for foot in feet],
+                         [False, False, False, False, True])
+        self.assertFalse(isMasked(feet[4], self.mask, {}))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
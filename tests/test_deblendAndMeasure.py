@@ -0,0 +1,138 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+from lsst.meas.deblender.benchmark import makeSyntheticField
+from lsst.meas.deblender.deblendAndMeasure import DeblendAndMeasureTask
+
+
+class _DataRef(object):
+    """Serve the calexp datasets read by DeblendAndMeasureTask from an exposure in memory"""
+
+    def __init__(self, exposure):
+        self.exposure = exposure
+        self.dataId = {}
+
+    def get(self, datasetType, bbox=None, imageOrigin="PARENT", immediate=True):
+        if datasetType == "calexp_bbox":
+            return self.exposure.getBBox()
+        if datasetType == "calexp_md":
+            return self.exposure.getMetadata()
+        if datasetType == "calexp_sub":
+            return self.exposure.Factory(self.exposure, bbox, afwImage.PARENT, True)
+        if datasetType == "calexp":
+            return self.exposure.Factory(self.exposure, True)
+        raise KeyError(datasetType)
+
+
+class DeblendAndMeasureTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        field = makeSyntheticField(width=200, height=150, nParents=6, peaksPerParent=3, blendSize=4.,
+                                   edgeFraction=0.3, seed=3)
+        self.exposure = list(field.exposures.values())[0]
+        mi = self.exposure.getMaskedImage()
+        rng = np.random.RandomState(4)
+        mi.getVariance().getArray()[:] = rng.uniform(0.5, 1.5, size=mi.getVariance().getArray().shape)
+        mi.getVariance().getArray()[10, 10] = np.nan
+        mi.getMask().getArray()[:, 180:] = mi.getMask().getPlaneBitMask("SAT")
+        self.parents = field.sources
+        self.dataRef = _DataRef(self.exposure)
+
+    def makeTask(self, noiseSubsample=1, useNoiseMap=False):
+        config = DeblendAndMeasureTask.ConfigClass()
+        config.readStripHeight = 16
+        config.deblend.noiseSubsample = noiseSubsample
+        config.deblend.useNoiseMap = useNoiseMap
+        config.deblend.noiseMapBinSize = 64
+        # the parents in the saturated columns are skipped
+        config.deblend.maskLimits = {"SAT": 0.5}
+        task = DeblendAndMeasureTask(config=config)
+        mapper = afwTable.SchemaMapper(self.parents.schema)
+        mapper.addMinimalSchema(self.parents.schema, True)
+        schema = mapper.getOutputSchema()
+        task.makeSubtask("deblend", schema=schema)
+        return task, mapper
+
+    def makeSources(self, mapper):
+        """Copy the parents, and their footprints, which the deblender modifies"""
+        sources = afwTable.SourceCatalog(mapper.getOutputSchema())
+        sources.extend(self.parents, mapper=mapper)
+        for src in sources:
+            foot = src.getFootprint()
+            copy = afwDetection.Footprint(foot.getSpans(), foot.getPeaks().getSchema())
+            copy.getPeaks().extend(foot.getPeaks(), deep=True)
+            src.setFootprint(copy)
+        return sources
+
+    def testSigma1(self):
+        """The noise level read in strips is the one computed on the full calexp"""
+        for noiseSubsample in (1, 3):
+            task, mapper = self.makeTask(noiseSubsample)
+            self.assertEqual(task.readSigma1(self.dataRef, self.exposure.getBBox()),
+                             task.deblend.getSigma1(self.exposure))
+
+    def testCutouts(self):
+        """Deblending on cutouts read from disk gives the children obtained on the full calexp"""
+        for useNoiseMap in (False, True):
+            self.checkCutouts(useNoiseMap)
+
+    def checkCutouts(self, useNoiseMap):
+        task, mapper = self.makeTask(useNoiseMap=useNoiseMap)
+        full = task.deblendByParent(self.dataRef, self.dataRef.get("calexp"), self.makeSources(mapper))
+        cutouts = task.deblendByParent(self.dataRef, None, self.makeSources(mapper))
+        self.assertGreater(len(full), len(self.parents))
+        self.assertEqual(len(cutouts), len(full))
+        nChildKey = task.deblend.nChildKey
+        psfKey = task.deblend.psfKey
+        maskedKey = task.deblend.maskedKey
+        for src1, src2 in zip(full, cutouts):
+            self.assertEqual(src1.getId(), src2.getId())
+            self.assertEqual(src1.getParent(), src2.getParent())
+            self.assertEqual(src1.get(nChildKey), src2.get(nChildKey))
+            self.assertEqual(src1.get(psfKey), src2.get(psfKey))
+            self.assertEqual(src1.get(maskedKey), src2.get(maskedKey))
+            foot1, foot2 = src1.getFootprint(), src2.getFootprint()
+            self.assertEqual(foot1.getSpans(), foot2.getSpans())
+            self.assertEqual(foot1.isHeavy(), foot2.isHeavy())
+            if foot1.isHeavy():
+                self.assertFloatsEqual(foot1.getImageArray(), foot2.getImageArray())
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
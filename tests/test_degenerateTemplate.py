@@ -103,6 +103,16 @@ class DegenerateTemplateTestCase(lsst.utils.tests.TestCase):
         self.assertTrue(deb.deblendedParents[0].peaks[4].degenerate)
         self.assertTrue(deb.deblendedParents[0].peaks[5].degenerate)
 
+        # All of the degenerate templates are removed in a single pass
+        for weightTemplates in (False, True):
+            deb = deblend(fp0, afwimg, fakepsf, fakepsf_fwhm, removeDegenerateTemplates=True,
+                          greedyDegenerateTemplates=True, weightTemplates=weightTemplates,
+                          recordPluginStats=True)
+            self.assertEqual([pk.degenerate for pk in deb.deblendedParents[0].peaks],
+                             [False]*3 + [True]*3)
+            stats = deb.pluginStats['reconstructTemplates']
+            self.assertEqual((stats.nCalls, stats.nResets), (1, 0))
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 
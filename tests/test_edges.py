@@ -34,6 +34,7 @@ import lsst.afw.image as afwImage
 import lsst.meas.algorithms as measAlg
 from lsst.log import Log
 from lsst.meas.deblender.baseline import deblend
+from lsst.meas.deblender.plugins import _rampEdgePixels
 
 doPlot = False
 if doPlot:
@@ -364,6 +365,30 @@ class RampEdgeTestCase(lsst.utils.tests.TestCase):
             plt.savefig(fn)
             print('Wrote', fn)
 
+    def testRampEdgePixels(self):
+        """The vectorized ramp matches the maximum of the PSF-scaled edge pixels"""
+        rng = np.random.RandomState(2)
+        template = afwImage.ImageF(afwGeom.Box2I(afwGeom.Point2I(10, 20), afwGeom.Extent2I(30, 25)))
+        template.getArray()[:] = rng.normal(size=(25, 30))
+        edge = afwGeom.SpanSet.fromShape(9, afwGeom.Stencil.BOX, offset=(25, 32))
+        edge = edge.intersectNot(afwGeom.SpanSet.fromShape(8, afwGeom.Stencil.BOX, offset=(25, 32)))
+        S = 3
+        P = rng.uniform(-0.1, 1., size=(2*S + 1, 2*S + 1))
+        rbox = template.getBBox()
+        rbox.grow(S)
+        ramped = afwImage.ImageF(rbox)
+        _rampEdgePixels(template, edge, P, -S, -S, ramped)
+
+        expected = np.zeros(ramped.getArray().shape, dtype=np.float32)
+        ox0, oy0 = ramped.getX0(), ramped.getY0()
+        for span in edge:
+            y = span.getY()
+            for x in range(span.getX0(), span.getX1() + 1):
+                slc = (slice(y - S - oy0, y + S + 1 - oy0), slice(x - S - ox0, x + S + 1 - ox0))
+                value = template.getArray()[y - template.getY0(), x - template.getX0()]
+                expected[slc] = np.maximum(expected[slc], value*P)
+        self.assertFloatsAlmostEqual(ramped.getArray(), expected, rtol=1e-6)
+
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -32,7 +32,7 @@ import lsst.afw.image as afwImage
 from lsst.log import Log
 import lsst.meas.algorithms as measAlg
 from lsst.meas.deblender.plugins import _fitPsf
-from lsst.meas.deblender.baseline import DeblendedPeak, CachingPsf
+from lsst.meas.deblender.baseline import DeblendedPeak, CachingPsf, CachingFitStencil
 
 doPlot = False
 if doPlot:
@@ -170,6 +170,26 @@ class FitPsfTestCase(unittest.TestCase):
                 continue
             print('  ', k, getattr(pkres, k))
 
+    def testStencil(self):
+        """Cached stencils match the radius and ramp weights computed directly"""
+        R0, R1 = 4, 6
+        stencils = CachingFitStencil()
+        for cx, cy in [(20., 30.), (23.25, 33.5), (92., 50.)]:
+            xlo, ylo, RR, rw, disk = stencils.getStencil(R0, R1, cx, cy)
+            self.assertEqual(xlo, int(np.floor(cx - R1)))
+            self.assertEqual(ylo, int(np.floor(cy - R1)))
+            self.assertEqual(xlo + RR.shape[1] - 1, int(np.ceil(cx + R1)))
+            self.assertEqual(ylo + RR.shape[0] - 1, int(np.ceil(cy + R1)))
+            xx = np.arange(xlo, xlo + RR.shape[1])
+            yy = np.arange(ylo, ylo + RR.shape[0])
+            expectRR = ((xx - cx)**2)[np.newaxis, :] + ((yy - cy)**2)[:, np.newaxis]
+            np.testing.assert_allclose(RR, expectRR)
+            expectRw = np.clip(1. - (np.sqrt(expectRR) - R0)/(R1 - R0), 0, 1)
+            np.testing.assert_allclose(rw, expectRw)
+            np.testing.assert_array_equal(disk, expectRR <= R1**2)
+        # The two integer peaks share a stencil
+        self.assertEqual(len(stencils.cache), 2)
+
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
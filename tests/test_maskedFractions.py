@@ -0,0 +1,67 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as butils
+
+
+class MaskedFractionsTestCase(lsst.utils.tests.TestCase):
+
+    def testFractions(self):
+        """The single-pass fractions match intersectNot for each mask plane"""
+        mask = afwImage.Mask(afwGeom.Box2I(afwGeom.Point2I(10, 20), afwGeom.Extent2I(40, 30)))
+        planes = ["SAT", "EDGE", "NO_DATA"]
+        bitmasks = [mask.getPlaneBitMask(name) for name in planes]
+        rng = np.random.RandomState(3)
+        array = mask.getArray()
+        for bitmask in bitmasks:
+            array[rng.rand(*array.shape) < 0.2] |= bitmask
+        # Partly outside of the mask: those pixels count as unmasked
+        spans = afwGeom.SpanSet.fromShape(12, offset=(15, 25))
+
+        fractions = butils.getMaskedFractions(spans, mask, bitmasks)
+        self.assertEqual(len(fractions), len(bitmasks))
+        size = float(spans.getArea())
+        for bitmask, fraction in zip(bitmasks, fractions):
+            unmasked = spans.intersectNot(mask, bitmask)
+            self.assertAlmostEqual(fraction, (size - unmasked.getArea())/size)
+
+        self.assertEqual(butils.getMaskedFractions(afwGeom.SpanSet(), mask, bitmasks), [0.0]*len(bitmasks))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,68 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as butils
+
+
+class MergeSpanSetsTestCase(lsst.utils.tests.TestCase):
+
+    def testMerge(self):
+        """The bulk union matches successive pairwise unions"""
+        rng = np.random.RandomState(7)
+        spanSets = []
+        for i in range(30):
+            x, y = rng.randint(0, 50, 2)
+            spanSets.append(afwGeom.SpanSet.fromShape(int(rng.randint(1, 10)), offset=(int(x), int(y))))
+        # Contiguous and overlapping spans on the same row
+        spanSets.append(afwGeom.SpanSet([afwGeom.Span(100, 0, 4), afwGeom.Span(100, 5, 9)]))
+        spanSets.append(afwGeom.SpanSet([afwGeom.Span(100, 3, 12)]))
+        spanSets.append(afwGeom.SpanSet())
+
+        expected = afwGeom.SpanSet()
+        for spans in spanSets:
+            expected = expected.union(spans)
+        merged = butils.mergeSpanSets(spanSets)
+        self.assertEqual(merged, expected)
+        self.assertEqual(merged.getArea(), expected.getArea())
+        self.assertEqual([(s.getY(), s.getX0(), s.getX1()) for s in merged],
+                         [(s.getY(), s.getX0(), s.getX1()) for s in expected])
+
+        self.assertEqual(butils.mergeSpanSets([]).getArea(), 0)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,174 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.log
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.meas.algorithms as algorithms
+from lsst.meas.deblender.baseline import DeblenderResult, CachingPsfKernels
+from lsst.meas.deblender.plugins import _getMultibandDataCube, _fitPerSource
+
+
+class _Source(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.sed = np.ones((1, 3))
+        self.morph = np.ones((1, 5, 5))
+        self.fix_sed = np.array([False])
+        self.fix_morph = np.array([False])
+
+
+class _Blend(object):
+    """Blend in which every free source moves toward zero at its own rate
+
+    Like `scarlet.blend.Blend`, `fit` stops once the relative change of every free
+    source is below ``e_rel``, and ``it`` counts the iterations of all of the fits.
+    """
+
+    def __init__(self, rates):
+        self.sources = [_Source(rate) for rate in rates]
+        self.it = 0
+        self.converged = False
+
+    def fit(self, steps, e_rel):
+        for i in range(steps):
+            self.it += 1
+            free = [src for src in self.sources if not src.fix_sed[0]]
+            for src in free:
+                src.sed *= src.rate
+                src.morph *= src.rate
+            self.converged = all(1 - src.rate < e_rel for src in free)
+            if self.converged:
+                break
+
+
+class MultibandDataCubeTestCase(lsst.utils.tests.TestCase):
+
+    def testCube(self):
+        """The cube matches the pixels of each band, and bad or outside pixels have zero weight"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(10, 20), afwGeom.Extent2I(40, 30))
+        rng = np.random.RandomState(1)
+        maskedImages = []
+        for i in range(2):
+            mi = afwImage.MaskedImageF(bbox)
+            mi.getImage().getArray()[:] = rng.normal(size=(30, 40))
+            mi.getVariance().getArray()[:] = i + 1
+            maskedImages.append(mi)
+        sat = maskedImages[1].getMask().getPlaneBitMask("SAT")
+        maskedImages[1].getMask().getArray()[15, 20] = sat
+
+        foot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(8, offset=(30, 35)))
+        foot.addPeak(30, 35, 10.)
+        foot.addPeak(33, 35, 10.)
+        psf = algorithms.DoubleGaussianPsf(11, 11, 2.)
+        debResult = DeblenderResult(foot, maskedImages, [psf, psf], [4.7, 4.7],
+                                    lsst.log.Log.getLogger("test"), avgNoise=[1., 1.])
+
+        data, weights = _getMultibandDataCube(debResult, True, ["SAT"])
+        fpBBox = foot.getBBox()
+        self.assertEqual(data.shape, (2, fpBBox.getHeight(), fpBBox.getWidth()))
+        self.assertEqual(data.dtype, np.float32)
+        self.assertEqual(weights.dtype, np.float32)
+        self.assertTrue(data.flags["C_CONTIGUOUS"])
+        for i, mi in enumerate(maskedImages):
+            sub = mi.Factory(mi, fpBBox, afwImage.PARENT)
+            self.assertFloatsEqual(data[i], sub.getImage().getArray())
+
+        inside = afwImage.Mask(fpBBox)
+        foot.spans.setMask(inside, 1)
+        inside = inside.getArray() != 0
+        self.assertFloatsEqual(weights[0][~inside], 0)
+        self.assertFloatsEqual(weights[0][inside], 1)
+        x, y = 20 + bbox.getMinX() - fpBBox.getMinX(), 15 + bbox.getMinY() - fpBBox.getMinY()
+        self.assertEqual(weights[1][y, x], 0)
+        self.assertEqual(weights[1][y + 1, x], 0.5)
+
+        # the cube is cached
+        data2, weights2 = _getMultibandDataCube(debResult, True, ["SAT"])
+        self.assertIs(data2, data)
+
+    def testPsfKernels(self):
+        """Kernels are computed once per band and grid cell"""
+        psfs = [algorithms.DoubleGaussianPsf(11, 11, 2.), algorithms.DoubleGaussianPsf(11, 11, 3.)]
+        cache = CachingPsfKernels(gridSize=100)
+        kernels = cache.getKernels(psfs, afwGeom.Point2D(10, 10))
+        self.assertEqual(kernels.shape, (2, 11, 11))
+        self.assertFalse(kernels.flags.writeable)
+        self.assertFloatsAlmostEqual(kernels[1], psfs[1].computeKernelImage(afwGeom.Point2D(50, 50)).getArray())
+        self.assertIs(cache.getKernels(psfs, afwGeom.Point2D(90, 5)), kernels)
+        self.assertIsNot(cache.getKernels(psfs, afwGeom.Point2D(110, 5)), kernels)
+        self.assertEqual(len(cache), 2)
+
+        # only the kernels of the most recent PSFs are kept
+        otherPsfs = [algorithms.DoubleGaussianPsf(11, 11, 2.5), psfs[1]]
+        otherKernels = cache.getKernels(otherPsfs, afwGeom.Point2D(10, 10))
+        self.assertEqual(len(cache), 1)
+        self.assertIs(cache.getKernels(otherPsfs, afwGeom.Point2D(20, 20)), otherKernels)
+        self.assertIsNot(cache.getKernels(psfs, afwGeom.Point2D(10, 10)), kernels)
+        cache = CachingPsfKernels(gridSize=100, maxPsfs=2)
+        kernels = cache.getKernels(psfs, afwGeom.Point2D(10, 10))
+        cache.getKernels(otherPsfs, afwGeom.Point2D(10, 10))
+        self.assertIs(cache.getKernels(psfs, afwGeom.Point2D(10, 10)), kernels)
+        self.assertEqual(len(cache.cache), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+        cache = CachingPsfKernels()
+        kernels = cache.getKernels(psfs, afwGeom.Point2D(10, 10))
+        self.assertIs(cache.getKernels(psfs, afwGeom.Point2D(1000, 1000)), kernels)
+        self.assertFloatsAlmostEqual(kernels[0], psfs[0].computeKernelImage().getArray())
+
+    def testFitPerSource(self):
+        """Sources that converge early are frozen while the others keep being updated"""
+        blend = _Blend([1., 0.9999, 0.5])
+        iterations = _fitPerSource(blend, 100, 1e-3, 1e-3, 10)
+        self.assertEqual(list(iterations), [10, 10, 100])
+        self.assertTrue(all(src.fix_sed[0] and src.fix_morph[0] for src in blend.sources[:2]))
+        self.assertFalse(blend.sources[2].fix_sed[0])
+
+        self.assertEqual(blend.it, 100)
+
+        # Only counts the iterations that scarlet ran, and stops once the whole blend has
+        # converged, even if some of the sources are not frozen
+        blend = _Blend([1., 0.9995])
+        self.assertEqual(list(_fitPerSource(blend, 100, 1e-3, 1e-4, 7)), [1, 1])
+        self.assertEqual(blend.it, 1)
+        self.assertFalse(blend.sources[1].fix_sed[0])
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
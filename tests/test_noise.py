@@ -0,0 +1,122 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import math
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+from lsst.meas.deblender.noise import estimateSigma1, getSigma1, NoiseMap, SIGMA1_KEY
+
+
+class NoiseTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        mi = afwImage.MaskedImageF(afwGeom.Extent2I(64, 48))
+        mi.getImage().set(0)
+        rng = np.random.RandomState(3)
+        mi.getVariance().getArray()[:] = rng.uniform(1., 3., size=(48, 64))
+        # a masked region with a large variance, that must be ignored
+        mi.getVariance().getArray()[:10, :] = 100.
+        mi.getMask().getArray()[:10, :] = mi.getMask().getPlaneBitMask("SAT")
+        self.exposure = afwImage.makeExposure(mi)
+        self.maskPlanes = ["SAT", "INTRP", "NO_DATA"]
+
+    def testEstimate(self):
+        variance = self.exposure.getMaskedImage().getVariance().getArray()
+        sigma1 = estimateSigma1(self.exposure.getMaskedImage(), self.maskPlanes)
+        self.assertFloatsAlmostEqual(sigma1, math.sqrt(np.median(variance[10:, :])), rtol=1e-3)
+        sigma1 = estimateSigma1(self.exposure.getMaskedImage(), self.maskPlanes, subsample=2)
+        self.assertFloatsAlmostEqual(sigma1, math.sqrt(np.median(variance[10::2, ::2])), rtol=1e-6)
+
+    def testNaN(self):
+        """NaN variances are ignored with and without subsampling"""
+        variance = self.exposure.getMaskedImage().getVariance().getArray()
+        variance[20, :] = np.nan
+        expected = math.sqrt(np.median(np.concatenate([variance[10:20, :], variance[21:, :]])))
+        sigma1 = estimateSigma1(self.exposure.getMaskedImage(), self.maskPlanes)
+        self.assertFloatsAlmostEqual(sigma1, expected, rtol=1e-3)
+        sigma1 = estimateSigma1(self.exposure.getMaskedImage(), self.maskPlanes, subsample=2)
+        self.assertFloatsAlmostEqual(sigma1, math.sqrt(np.nanmedian(variance[10::2, ::2])), rtol=1e-6)
+        self.assertTrue(np.isfinite(sigma1))
+
+    def testCache(self):
+        # Nothing is written to the metadata unless the cache is used
+        sigma1 = getSigma1(self.exposure, self.maskPlanes)
+        self.assertFalse(self.exposure.getMetadata().exists(SIGMA1_KEY))
+        self.assertEqual(getSigma1(self.exposure, self.maskPlanes, useCache=True), sigma1)
+        self.assertEqual(self.exposure.getMetadata().get(SIGMA1_KEY), sigma1)
+        self.assertEqual(getSigma1(self.exposure, self.maskPlanes, useCache=True), sigma1)
+        # The cached value is not reused once the variance has changed
+        self.exposure.getMaskedImage().getVariance().getArray()[:] *= 4
+        self.assertFloatsAlmostEqual(getSigma1(self.exposure, self.maskPlanes, useCache=True),
+                                     2*sigma1, rtol=1e-6)
+        self.assertFloatsAlmostEqual(self.exposure.getMetadata().get(SIGMA1_KEY), 2*sigma1, rtol=1e-6)
+        # nor if it was computed with a different subsampling or mask
+        sigma1 = getSigma1(self.exposure, self.maskPlanes, useCache=True)
+        self.assertNotEqual(getSigma1(self.exposure, self.maskPlanes, subsample=2, useCache=True), sigma1)
+        self.assertNotEqual(getSigma1(self.exposure, ["NO_DATA"], useCache=True), sigma1)
+
+    def testNoiseMap(self):
+        """A map with 16x16 bins of an image whose variance is 1 on the left half and 9 on the right"""
+        mi = afwImage.MaskedImageF(afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(64, 40)))
+        variance = mi.getVariance().getArray()
+        variance[:, :32] = 1.
+        variance[:, 32:] = 9.
+        # a fully masked bin gets the median of the other bins
+        variance[:16, :16] = 100.
+        mi.getMask().getArray()[:16, :16] = mi.getMask().getPlaneBitMask("SAT")
+        noiseMap = NoiseMap(mi, self.maskPlanes, binSize=16)
+        self.assertEqual(noiseMap.sigmas.shape, (3, 4))
+        self.assertFloatsAlmostEqual(noiseMap.getSigma(110, 230), 1.)
+        self.assertFloatsAlmostEqual(noiseMap.getSigma(160, 239), 3.)
+        self.assertFloatsAlmostEqual(noiseMap.getSigma(100, 200), 3.)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(140, 210), afwGeom.Extent2I(10, 10))
+        self.assertFloatsAlmostEqual(noiseMap.getSigmaForBBox(bbox), 3.)
+
+        # the map computed one strip of bins at a time is the same
+        strips = []
+
+        def readStrip(bbox):
+            strips.append(bbox)
+            return mi.Factory(mi, bbox, afwImage.PARENT)
+        stripMap = NoiseMap.fromStrips(mi.getBBox(), readStrip, self.maskPlanes, binSize=16)
+        self.assertEqual(len(strips), 3)
+        self.assertEqual(strips[-1].getHeight(), 8)
+        self.assertFloatsEqual(stripMap.sigmas, noiseMap.sigmas)
+        self.assertFloatsAlmostEqual(stripMap.getSigma(100, 200), 3.)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,100 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.meas.algorithms as algorithms
+from lsst.meas.deblender import SourceDeblendConfig, SourceDeblendTask
+from lsst.meas.deblender.baseline import makeDeblenderPlugins
+
+
+class PluginStatsTestCase(lsst.utils.tests.TestCase):
+
+    def testSourceDeblendTask(self):
+        """Check that the per-plugin statistics are stored in the catalog and the metadata"""
+        mi = afwImage.MaskedImageF(afwGeom.Extent2I(64, 64))
+        mi.getVariance().set(1.0)
+        mi.getImage().set(0)
+        x, y = 30, 30
+        mi.getImage().set(x, y, 100.)
+        mi.getImage().set(x - 2, y - 2, 100.)
+        exposure = afwImage.makeExposure(mi)
+        exposure.setPsf(algorithms.DoubleGaussianPsf(21, 21, 3.))
+
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        config = SourceDeblendConfig()
+        config.recordPluginStats = True
+        task = SourceDeblendTask(schema, config=config)
+        names = task.getPluginNames()
+        for name in names:
+            self.assertIn('deblend_%s_time' % name, schema.getNames())
+            self.assertNotIn('deblend_%s_peakMemory' % name, schema.getNames())
+
+        catalog = afwTable.SourceCatalog(schema)
+        src = catalog.addNew()
+        foot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(3, offset=(x, y)))
+        foot.addPeak(x, y, 100.)
+        foot.addPeak(x - 2, y - 2, 100.)
+        src.setFootprint(foot)
+        task.run(exposure, catalog)
+
+        parent = catalog[0]
+        for name in names:
+            self.assertEqual(parent.get('deblend_%s_nCalls' % name), 1)
+            self.assertEqual(parent.get('deblend_%s_nResets' % name), 0)
+            self.assertGreaterEqual(parent.get('deblend_%s_time' % name), 0.)
+            self.assertEqual(task.metadata.get('%s_nCalls' % name), 1)
+        self.assertEqual(task.metadata.get('pluginStatsNParents'), 1)
+
+    def testPluginNames(self):
+        """The names follow the plugins built by baseline.deblend for each config"""
+        config = SourceDeblendConfig()
+        config.edgeHandling = 'ramp'
+        config.medianSmoothTemplate = False
+        config.weightTemplates = True
+        config.removeDegenerateTemplates = True
+        config.stencilQuantum = 0.125
+        task = SourceDeblendTask(afwTable.SourceTable.makeMinimalSchema(), config=config)
+        self.assertEqual(task.getPluginNames(),
+                         ['fitPsfs', 'buildSymmetricTemplates', 'rampFluxAtEdge', 'makeTemplatesMonotonic',
+                          'clipFootprintsToNonzero', 'weightTemplates', 'reconstructTemplates',
+                          'apportionFlux'])
+        fitPsfs = makeDeblenderPlugins(**task.getPluginKwargs())[0]
+        self.assertEqual(fitPsfs.kwargs['stencilQuantum'], 0.125)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,93 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.meas.algorithms as algorithms
+from lsst.meas.deblender.profiling import ProfilingSourceDeblendConfig, ProfilingSourceDeblendTask
+
+
+class ProfilingTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.profileDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profileDir, ignore_errors=True)
+
+    def testSlowestParents(self):
+        """Only the profile of the slowest parent is kept with profileMaxParents=1"""
+        mi = afwImage.MaskedImageF(afwGeom.Extent2I(128, 128))
+        mi.getVariance().set(1.0)
+        mi.getImage().set(0)
+        exposure = afwImage.makeExposure(mi)
+        exposure.setPsf(algorithms.DoubleGaussianPsf(21, 21, 3.))
+
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        config = ProfilingSourceDeblendConfig()
+        config.profileThreshold = 0.
+        config.profileMaxParents = 1
+        config.profileDir = self.profileDir
+        task = ProfilingSourceDeblendTask(schema, config=config)
+
+        catalog = afwTable.SourceCatalog(schema)
+        for x, y in [(30, 30), (90, 90)]:
+            mi.getImage().set(x, y, 100.)
+            mi.getImage().set(x - 2, y - 2, 100.)
+            src = catalog.addNew()
+            foot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(3, offset=(x, y)))
+            foot.addPeak(x, y, 100.)
+            foot.addPeak(x - 2, y - 2, 100.)
+            src.setFootprint(foot)
+        task.run(exposure, catalog)
+
+        with open(os.path.join(self.profileDir, "index.json")) as f:
+            index = json.load(f)
+        self.assertEqual(len(index), 1)
+        parentDir = index[0]["dir"]
+        self.assertEqual(len(index[0]["peaks"]), 2)
+        for name in ["profile.prof", "footprint.fits", "image-single.fits", "summary.json"]:
+            self.assertTrue(os.path.exists(os.path.join(parentDir, name)))
+        footprint = afwDetection.Footprint.readFits(os.path.join(parentDir, "footprint.fits"))
+        self.assertEqual(len(footprint.getPeaks()), 2)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,176 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.image as afwImage
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.deblender import MultibandDeblendConfig, MultibandDeblendTask
+
+try:
+    import scarlet
+except ImportError:
+    scarlet = None
+
+
+class _Peak(object):
+    """Minimal stand-in for the deblended peak of a single band"""
+
+    def __init__(self, footprint, value, skip=False):
+        self.skip = skip
+        self.deblendedAsPsf = False
+        self.strayFlux = None
+        self.hasRampedTemplate = False
+        self.patched = False
+        self.scarletIterations = None
+        if skip:
+            self.templateFootprint = None
+            self.templateImage = None
+            self.heavy = None
+        else:
+            self.templateFootprint = footprint
+            self.templateImage = afwImage.ImageF(footprint.getBBox())
+            self.templateImage.set(value)
+            mi = afwImage.MaskedImageF(footprint.getBBox())
+            mi.getImage().set(2*value)
+            self.heavy = afwDetection.makeHeavyFootprint(footprint, mi)
+
+    def getFluxPortion(self):
+        return self.heavy
+
+
+class _MultibandPeak(object):
+    def __init__(self, x, y, deblendedPeaks):
+        self.x = x
+        self.y = y
+        self.deblendedPeaks = deblendedPeaks
+
+
+class _Result(object):
+    def __init__(self, peaks):
+        self.peaks = peaks
+
+
+def _makeFootprint(radius, x, y):
+    footprint = afwDetection.Footprint(afwGeom.SpanSet.fromShape(radius, offset=(x, y)))
+    footprint.addPeak(x, y, 10.)
+    return footprint
+
+
+@unittest.skipIf(scarlet is None, "scarlet is not installed")
+class SingleOutputCatalogTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.bands = ["g", "r"]
+        self.schema = afwTable.SourceTable.makeMinimalSchema()
+        config = MultibandDeblendConfig()
+        config.singleOutputCatalog = True
+        config.saveTemplates = True
+        config.conserveFlux = True
+        config.propagateAllPeaks = True
+        self.task = MultibandDeblendTask(self.schema, config=config)
+        self.sources = afwTable.SourceCatalog(self.schema)
+        self.parent = self.sources.addNew()
+        parentFoot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(8, offset=(30, 30)))
+        parentFoot.addPeak(28, 30, 10.)
+        parentFoot.addPeak(34, 30, 10.)
+        self.parent.setFootprint(parentFoot)
+        # the first child is larger in r, and extends beyond the parent; the second one failed
+        self.childFootprints = {"g": _makeFootprint(3, 28, 30), "r": _makeFootprint(10, 28, 30)}
+        self.result = _Result([
+            _MultibandPeak(28, 30, {band: _Peak(self.childFootprints[band], 1. + i)
+                                    for i, band in enumerate(self.bands)}),
+            _MultibandPeak(34, 30, {band: _Peak(None, 0., skip=True) for band in self.bands}),
+        ])
+
+    def makeSideTables(self):
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        return ({band: afwTable.SourceCatalog(schema) for band in self.bands},
+                {band: afwTable.SourceCatalog(schema) for band in self.bands})
+
+    def testFamily(self):
+        """Children in the source catalog, and their pixels in the side tables"""
+        parentSpans = self.parent.getFootprint().getSpans()
+        fluxCatalogs, templateCatalogs = self.makeSideTables()
+        self.task._addSingleCatalogFamily(self.parent, self.result, self.bands, self.sources,
+                                          fluxCatalogs, templateCatalogs)
+        parentId = self.parent.getId()
+        self.assertEqual(len(self.sources), 3)
+        children = self.sources[1:]
+        self.assertEqual([child.getParent() for child in children], [parentId, parentId])
+        self.assertEqual(self.parent.get(self.task.nChildKey), 2)
+        self.assertTrue(self.parent.get(self.task.deblendSkippedKey))
+
+        # the shared footprint of a child is the union of its footprints in all bands
+        merged = self.childFootprints["g"].getSpans().union(self.childFootprints["r"].getSpans())
+        self.assertEqual(children[0].getFootprint().getSpans(), merged)
+        self.assertEqual(len(children[0].getFootprint().getPeaks()), 1)
+        # the failed child gets the footprint of the parent
+        self.assertEqual(children[1].getFootprint().getSpans(), parentSpans)
+        # and the parent includes all of its children
+        self.assertEqual(self.parent.getFootprint().getSpans(), parentSpans.union(merged))
+
+        for catalogs, scale in ((templateCatalogs, 1.), (fluxCatalogs, 2.)):
+            for i, band in enumerate(self.bands):
+                catalog = catalogs[band]
+                self.assertEqual([record.getId() for record in catalog],
+                                 [parentId] + [child.getId() for child in children])
+                self.assertEqual([record.getParent() for record in catalog[1:]], [parentId, parentId])
+                self.assertEqual(len(catalog[0].getFootprint().getPeaks()), 2)
+                heavy = catalog[1].getFootprint()
+                self.assertEqual(heavy.getSpans(), self.childFootprints[band].getSpans())
+                self.assertFloatsEqual(heavy.getImageArray(), scale*(1. + i))
+                self.assertFloatsEqual(catalog[2].getFootprint().getImageArray(), 0.)
+
+    def testNoSideTables(self):
+        """Failed children are propagated when neither templates nor fluxes are saved"""
+        config = MultibandDeblendConfig()
+        config.singleOutputCatalog = True
+        config.saveTemplates = False
+        config.conserveFlux = False
+        config.propagateAllPeaks = True
+        self.task.config = config
+        parentSpans = self.parent.getFootprint().getSpans()
+        self.task._addSingleCatalogFamily(self.parent, self.result, self.bands, self.sources, None, None)
+        self.assertEqual(len(self.sources), 3)
+        merged = self.childFootprints["g"].getSpans().union(self.childFootprints["r"].getSpans())
+        self.assertEqual(self.sources[1].getFootprint().getSpans(), merged)
+        self.assertEqual(self.sources[2].getFootprint().getSpans(), parentSpans)
+        self.assertEqual(self.parent.get(self.task.nChildKey), 2)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
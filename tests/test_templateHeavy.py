@@ -0,0 +1,63 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.meas.deblender.deblend import _makeTemplateHeavyFootprint
+
+
+class TemplateHeavyFootprintTestCase(lsst.utils.tests.TestCase):
+
+    def testHeavy(self):
+        """The template heavy matches makeHeavyFootprint on a masked image copy of the template"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(12, 7), afwGeom.Extent2I(21, 17))
+        image = afwImage.ImageF(bbox)
+        image.getArray()[:] = np.random.RandomState(4).normal(size=(17, 21))
+        foot = afwDet.Footprint(afwGeom.SpanSet.fromShape(6, offset=(22, 15)))
+        foot.addPeak(22, 15, 1.)
+
+        heavy = _makeTemplateHeavyFootprint(foot, image)
+        expected = afwDet.makeHeavyFootprint(foot, afwImage.MaskedImageF(image))
+        self.assertEqual(heavy.getSpans(), expected.getSpans())
+        self.assertEqual(len(heavy.getPeaks()), 1)
+        self.assertFloatsEqual(heavy.getImageArray(), expected.getImageArray())
+        self.assertFloatsEqual(heavy.getVarianceArray(), expected.getVarianceArray())
+        np.testing.assert_array_equal(heavy.getMaskArray(), expected.getMaskArray())
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
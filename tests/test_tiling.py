@@ -0,0 +1,142 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import print_function
+import unittest
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+import lsst.meas.algorithms as measAlg
+from lsst.meas.deblender.baseline import deblend
+from lsst.meas.deblender.tiling import getRampPadding, makeParentCutout, ParentCutoutIterator
+
+
+class ParentCutoutTestCase(lsst.utils.tests.TestCase):
+
+    def testCutoutMatchesFullImage(self):
+        '''
+        Deblend two blobs, one of them truncated by the edge of the footprint,
+        on the full image and on the padded parent cutout and check that the
+        children are identical.
+        '''
+        H, W = 200, 200
+        afwimg = afwImage.MaskedImageF(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(W, H)))
+        imgbb = afwimg.getBBox()
+        img = afwimg.getImage().getArray()
+        afwimg.getVariance().getArray()[:, :] = 1.
+
+        blob_psf = measAlg.DoubleGaussianPsf(201, 201, 15., 45., 0.03)
+        psf_fwhm = 5.
+        psf = measAlg.DoubleGaussianPsf(21, 21, psf_fwhm)
+
+        for x, y in [(100., 100.), (140., 100.)]:
+            bim = blob_psf.computeImage(afwGeom.Point2D(x, y))
+            bbb = bim.getBBox()
+            bbb.clip(imgbb)
+            bim = bim.Factory(bim, bbb)
+            img[bbb.getMinY():bbb.getMaxY()+1, bbb.getMinX():bbb.getMaxX()+1] += 1e6*bim.getArray()
+
+        thresh = afwDet.createThreshold(10., 'value', True)
+        fps = afwDet.FootprintSet(afwimg, thresh, 'DETECTED', 1).getFootprints()
+        self.assertEqual(len(fps), 1)
+        fp = fps[0]
+        self.assertGreater(len(fp.getPeaks()), 1)
+        # Clip the footprint so that the templates have flux at their edges
+        bbox = fp.getBBox()
+        bbox.grow(-10)
+        fp.clipTo(bbox)
+        fp.removeOrphanPeaks()
+
+        cutout = makeParentCutout(afwimg, fp, psf_fwhm, deep=True)
+        expectBBox = fp.getBBox()
+        expectBBox.grow(getRampPadding(psf_fwhm))
+        expectBBox.clip(imgbb)
+        self.assertEqual(cutout.getBBox(), expectBBox)
+
+        kwargs = dict(sigma1=1., rampFluxAtEdge=True)
+        full = deblend(afwDet.Footprint(fp), afwimg, psf, psf_fwhm, **kwargs)
+        tiled = deblend(afwDet.Footprint(fp), cutout, psf, psf_fwhm, **kwargs)
+
+        for pk1, pk2 in zip(full.deblendedParents[0].peaks, tiled.deblendedParents[0].peaks):
+            self.assertEqual(pk1.skip, pk2.skip)
+            self.assertEqual(pk1.hasRampedTemplate, pk2.hasRampedTemplate)
+            if pk1.skip:
+                continue
+            self.assertEqual(pk1.templateFootprint.getSpans(), pk2.templateFootprint.getSpans())
+            self.assertFloatsEqual(pk1.templateImage.getArray(), pk2.templateImage.getArray())
+            self.assertFloatsEqual(pk1.fluxPortion.getImage().getArray(),
+                                   pk2.fluxPortion.getImage().getArray())
+
+    def testIterator(self):
+        """The iterator returns the padded cutout of every parent with more than one peak"""
+        mi = afwImage.MaskedImageF(afwGeom.Box2I(afwGeom.Point2I(10, 20), afwGeom.Extent2I(100, 80)))
+        mi.getImage().getArray()[:] = np.arange(100*80).reshape(80, 100)
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        sources = afwTable.SourceCatalog(schema)
+        for x, y, nPeaks in [(30, 40, 2), (60, 50, 1), (105, 95, 3)]:
+            foot = afwDet.Footprint(afwGeom.SpanSet.fromShape(4, offset=(x, y)))
+            for i in range(nPeaks):
+                foot.addPeak(x + i, y, 100.)
+            sources.addNew().setFootprint(foot)
+        psf_fwhm = 3.
+
+        cutouts = list(ParentCutoutIterator.fromMaskedImage(mi, sources, psf_fwhm, deep=True))
+        self.assertEqual([src.getId() for src, cutout in cutouts], [sources[0].getId(), sources[2].getId()])
+        for src, cutout in cutouts:
+            expected = makeParentCutout(mi, src.getFootprint(), psf_fwhm)
+            self.assertEqual(cutout.getBBox(), expected.getBBox())
+            self.assertFloatsEqual(cutout.getImage().getArray(), expected.getImage().getArray())
+        # the last parent is clipped to the image
+        self.assertTrue(mi.getBBox().contains(cutouts[1][1].getBBox()))
+
+        # cutouts read with a function of the bounding box, while children are added to the catalog
+        bboxes = []
+
+        def readCutout(bbox):
+            bboxes.append(bbox)
+            return mi.Factory(mi, bbox, afwImage.PARENT)
+
+        for src, cutout in ParentCutoutIterator(sources, mi.getBBox(), lambda bbox: psf_fwhm, readCutout,
+                                                rampFluxAtEdge=False):
+            child = sources.addNew()
+            child.setParent(src.getId())
+            child.setFootprint(afwDet.Footprint(src.getFootprint()))
+        self.assertEqual(bboxes, [sources[0].getFootprint().getBBox(), sources[2].getFootprint().getBBox()])
+        self.assertEqual(len(sources), 5)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
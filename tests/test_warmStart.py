@@ -0,0 +1,87 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetection
+import lsst.afw.geom as afwGeom
+from lsst.meas.deblender.warmStart import ScarletWarmStart, getBlendKey
+
+
+class FakeSource(object):
+    """Minimal stand-in for a scarlet source: only the model arrays are needed"""
+
+    def __init__(self, nBands, size, value=0.):
+        self.sed = np.zeros((1, nBands)) + value
+        self.morph = np.zeros((1, size, size)) + value
+
+
+class WarmStartTestCase(lsst.utils.tests.TestCase):
+
+    def makeFootprint(self, x, y):
+        foot = afwDetection.Footprint(afwGeom.SpanSet.fromShape(5, offset=(x, y)))
+        foot.addPeak(x, y, 100.)
+        foot.addPeak(x + 2, y, 100.)
+        return foot
+
+    def testKey(self):
+        self.assertEqual(getBlendKey(self.makeFootprint(20, 20)), getBlendKey(self.makeFootprint(20, 20)))
+        self.assertNotEqual(getBlendKey(self.makeFootprint(20, 20)), getBlendKey(self.makeFootprint(21, 20)))
+
+    def testSaveAndApply(self):
+        key = getBlendKey(self.makeFootprint(20, 20))
+        converged = [FakeSource(3, 7, 1.), FakeSource(3, 9, 2.)]
+        with lsst.utils.tests.getTempFilePath(".npz") as filename:
+            store = ScarletWarmStart(filename)
+            store.set(key, converged)
+            store.save()
+            store = ScarletWarmStart(filename)
+        self.assertEqual(len(store), 1)
+
+        sources = [FakeSource(3, 7), FakeSource(3, 9)]
+        self.assertTrue(ScarletWarmStart.apply(sources, store.get(key)))
+        for src, expected in zip(sources, converged):
+            self.assertFloatsEqual(src.sed, expected.sed)
+            self.assertFloatsEqual(src.morph, expected.morph)
+
+        # Sources with a different box size or number of bands are not initialized
+        sources = [FakeSource(3, 7), FakeSource(3, 11)]
+        self.assertFalse(ScarletWarmStart.apply(sources, store.get(key)))
+        self.assertFloatsEqual(sources[0].morph, 0.)
+        self.assertFalse(ScarletWarmStart.apply([FakeSource(2, 7), FakeSource(2, 9)], store.get(key)))
+        self.assertFalse(ScarletWarmStart.apply(sources, store.get("missing")))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
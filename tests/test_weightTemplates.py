@@ -0,0 +1,131 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2016  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.log
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.meas.algorithms as measAlg
+from lsst.meas.deblender.baseline import DeblenderResult
+from lsst.meas.deblender.plugins import weightTemplates, _getTemplateGram, MAX_TEMPLATE_GRAM_CONDITION
+
+
+class WeightTemplatesTestCase(lsst.utils.tests.TestCase):
+
+    def checkWeights(self, degenerate=False):
+        """Check that the weights match a dense least-squares fit of the templates to the parent footprint
+
+        If ``degenerate``, the last template is almost a copy of the first one.
+        """
+        bbox = afwGeom.Box2I(afwGeom.Point2I(5, 10), afwGeom.Extent2I(60, 50))
+        rng = np.random.RandomState(3)
+        mi = afwImage.MaskedImageF(bbox)
+        mi.getImage().getArray()[:] = rng.normal(size=(50, 60))
+        mi.getVariance().getArray()[:] = 1.
+
+        foot = afwDet.Footprint(afwGeom.SpanSet.fromShape(20, offset=(35, 35)).clippedTo(bbox))
+        centers = [(25, 30), (45, 40), (30, 50)]
+        sizes = [8, 12, 25]
+        if degenerate:
+            centers[2] = centers[0]
+            sizes[2] = sizes[0]
+        for x, y in centers:
+            foot.addPeak(x, y, 10.)
+        psf = measAlg.DoubleGaussianPsf(11, 11, 2.)
+        debResult = DeblenderResult(foot, [mi], [psf], [4.7], lsst.log.Log.getLogger("test"),
+                                    avgNoise=[1.])
+        dp = debResult.deblendedParents[0]
+
+        # Templates, one of which extends beyond the parent footprint
+        dense = []
+        for pkres, (x, y), size in zip(dp.peaks, centers, sizes):
+            tbox = afwGeom.Box2I(afwGeom.Point2I(x - size, y - size),
+                                 afwGeom.Extent2I(2*size + 1, 2*size + 1))
+            tbox.clip(bbox)
+            timg = afwImage.ImageF(tbox)
+            if degenerate and pkres is dp.peaks[2]:
+                timg.getArray()[:] = dp.peaks[0].templateImage.getArray()
+                timg.getArray()[size, size] += 1e-4
+            else:
+                timg.getArray()[:] = rng.uniform(size=timg.getArray().shape)
+            tfoot = afwDet.Footprint(afwGeom.SpanSet(tbox))
+            pkres.setTemplate(timg, tfoot)
+            full = afwImage.ImageF(dp.bb)
+            afwDet.copyWithinFootprintImage(dp.fp, timg, full)
+            dense.append(full.getArray().ravel())
+        parentImage = afwImage.ImageF(dp.bb)
+        afwDet.copyWithinFootprintImage(dp.fp, dp.img, parentImage)
+        dense = np.array(dense).T
+        expected = np.linalg.lstsq(dense, parentImage.getArray().ravel(), rcond=-1)[0]
+        if degenerate:
+            self.assertGreater(np.linalg.cond(dense.T.dot(dense)), MAX_TEMPLATE_GRAM_CONDITION)
+
+        weightTemplates(debResult, lsst.log.Log.getLogger("test"))
+        self.assertFloatsAlmostEqual(np.array([pkres.templateWeight for pkres in dp.peaks]), expected,
+                                     rtol=1e-5)
+
+    def testWeights(self):
+        """The weights match a dense least-squares fit of the templates to the parent footprint"""
+        self.checkWeights()
+
+    def testDegenerateWeights(self):
+        """Nearly degenerate templates are fit directly to the pixels, as by a dense fit"""
+        self.checkWeights(degenerate=True)
+
+    def testGram(self):
+        """The pruned Gram matrix matches the dot products of the full templates"""
+        rng = np.random.RandomState(5)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(80, 60))
+        templates = []
+        full = []
+        for i in range(12):
+            x0, y0 = rng.randint(0, 70), rng.randint(0, 50)
+            tbox = afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Extent2I(rng.randint(1, 20),
+                                                                             rng.randint(1, 20)))
+            tbox.clip(bbox)
+            values = rng.uniform(size=(tbox.getHeight(), tbox.getWidth()))
+            templates.append((tbox, values))
+            image = np.zeros((60, 80))
+            image[tbox.getMinY():tbox.getMaxY() + 1, tbox.getMinX():tbox.getMaxX() + 1] = values
+            full.append(image.ravel())
+        templates.append((afwGeom.Box2I(), None))
+        full.append(np.zeros(60*80))
+        full = np.array(full)
+        self.assertFloatsAlmostEqual(_getTemplateGram(templates), full.dot(full.T), rtol=1e-12)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()